@@ -0,0 +1,31 @@
+import os
+from typing import Any, Callable, Dict, Tuple
+
+BACKEND = os.getenv("BACKEND", "openai")  # "fake" runs the pipeline without OpenAI/Exa keys
+
+
+def _openai_clients() -> Tuple[Any, Any]:
+    from exa_py import Exa
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY")), Exa(api_key=os.getenv("EXA_API_KEY"))
+
+
+def _fake_clients() -> Tuple[Any, Any]:
+    from fake_backend import create_fake_clients
+
+    return create_fake_clients()
+
+
+# Each backend provides an `AsyncOpenAI`-compatible client and an `Exa`-compatible search client
+BACKENDS: Dict[str, Callable[[], Tuple[Any, Any]]] = {
+    "openai": _openai_clients,
+    "fake": _fake_clients,
+}
+
+
+def create_clients(name: str = BACKEND) -> Tuple[Any, Any]:
+    """Return the (client, exa) pair for the named backend."""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name} (expected one of {', '.join(BACKENDS)})")
+    return BACKENDS[name]()
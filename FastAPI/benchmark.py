@@ -0,0 +1,224 @@
+"""
+End-to-end latency benchmark of the analysis pipeline.
+
+Drives N concurrent sessions through /session/start -> all L1 nodes -> /question/* -> /l2nodes/*
+and reports p50/p95/p99 per stage plus session throughput. By default the server runs in-process
+against the fake OpenAI/Exa backend (fake_backend.py), so what is measured is our own overhead
+on top of the configured backend latencies.
+
+Usage:
+python benchmark.py --sessions 20 --run-latency-ms 200
+python benchmark.py --url http://127.0.0.1:8001 --sessions 5   # an already running server
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+STAGES = ["session_start", "first_node", "l1_nodes", "question", "question_prompted", "l2_nodes", "session_total"]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def make_dataset(rows: int, seed: int) -> bytes:
+    """A synthetic CSV; every session gets its own content unless --same-dataset is set."""
+    rng = random.Random(seed)
+    lines = ["date,region,temperature,rainfall,humidity"]
+    for i in range(rows):
+        lines.append(f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d},region_{rng.randint(1, 20)},"
+                     f"{rng.gauss(18, 7):.1f},{rng.expovariate(0.2):.2f},{rng.uniform(20, 100):.0f}")
+    return ("\n".join(lines) + "\n").encode()
+
+
+class Timings:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def measure(self, stage: str, coro):
+        start = time.perf_counter()
+        try:
+            result = await coro
+        except Exception:
+            self.errors[stage] += 1
+            raise
+        self.samples[stage].append(time.perf_counter() - start)
+        return result
+
+
+async def _wait_for_l1(http: httpx.AsyncClient, hub_id: str, timings: Timings, start: float):
+    # Follow the hub's event stream until the L1 build reports it is done
+    first_node = False
+    event = None
+    async with http.stream("GET", f"/hubs/{hub_id}/events") as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event == "node" and not first_node:
+                    first_node = True
+                    timings.samples["first_node"].append(time.perf_counter() - start)
+                elif event == "error":
+                    raise RuntimeError(json.loads(line[len("data: "):])["detail"])
+                elif event == "done":
+                    break
+    timings.samples["l1_nodes"].append(time.perf_counter() - start)
+
+
+async def run_session(http: httpx.AsyncClient, dataset: bytes, timings: Timings):
+    session_start = time.perf_counter()
+
+    response = await timings.measure("session_start", http.post(
+        "/session/start", files={"file": ("bench.csv", dataset, "text/csv")}
+    ))
+    response.raise_for_status()
+    hub_id = response.json()["hub"]
+
+    try:
+        await _wait_for_l1(http, hub_id, timings, time.perf_counter())
+    except Exception:
+        timings.errors["l1_nodes"] += 1
+        raise
+
+    nodes = (await http.get(f"/hubs/{hub_id}/nodes")).json()
+    if not nodes:
+        timings.errors["l1_nodes"] += 1
+        raise RuntimeError(f"Hub {hub_id} has no nodes")
+    node = next((node for node in nodes if node["questions"]), nodes[0])
+
+    if node["questions"]:
+        response = await timings.measure("question", http.get(f"/question/{node['questions'][0]['id']}"))
+        response.raise_for_status()
+
+    response = await timings.measure("question_prompted", http.post(
+        f"/question/from/{node['id']}", json={"prompt": "Which variable matters most here?"}
+    ))
+    response.raise_for_status()
+
+    response = await timings.measure("l2_nodes", http.get(f"/l2nodes/{node['id']}"))
+    response.raise_for_status()
+
+    timings.samples["session_total"].append(time.perf_counter() - session_start)
+
+
+async def run_benchmark(base_url: str, sessions: int, rounds: int, rows: int, same_dataset: bool) -> Timings:
+    timings = Timings()
+    timeout = httpx.Timeout(None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as http:
+        wall_start = time.perf_counter()
+        for round_index in range(rounds):
+            datasets = [make_dataset(rows, 0 if same_dataset else round_index * sessions + i) for i in range(sessions)]
+            results = await asyncio.gather(*[run_session(http, dataset, timings) for dataset in datasets],
+                                           return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"session failed: {result!r}")
+        timings.wall = time.perf_counter() - wall_start
+        timings.server = (await http.get("/timings")).json()
+    return timings
+
+
+def report(timings: Timings, sessions: int, rounds: int):
+    print(f"\n{'stage':<18}{'n':>6}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage in STAGES:
+        values = timings.samples.get(stage, [])
+        if not values:
+            print(f"{stage:<18}{0:>6}{timings.errors.get(stage, 0):>6}")
+            continue
+        cells = [percentile(values, pct) * 1000 for pct in (50, 95, 99)] + [max(values) * 1000]
+        print(f"{stage:<18}{len(values):>6}{timings.errors.get(stage, 0):>6}" + "".join(f"{c:>10.1f}" for c in cells))
+
+    print(f"\n{'server stage':<18}{'phase':<16}{'n':>6}{'mean ms':>10}{'max ms':>10}")
+    for stage, phases in timings.server.items():
+        for phase, stat in phases.items():
+            if isinstance(stat, dict):
+                print(f"{stage:<18}{phase:<16}{stat['count']:>6}{stat['mean_ms']:>10.1f}{stat['max_ms']:>10.1f}")
+
+    completed = len(timings.samples.get("session_total", []))
+    print(f"\n{completed}/{sessions * rounds} sessions completed in {timings.wall:.2f}s "
+          f"({completed / timings.wall:.2f} sessions/s, {sessions} concurrent)")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _run_in_process(args) -> Timings:
+    # The modules read their configuration on import, so the environment has to be set first
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.setdefault("BACKEND", "fake")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.environ.setdefault("BLOB_DIR", os.path.join(workdir, "blobs"))
+    os.environ.setdefault("LLM_CACHE_PATH", os.path.join(workdir, "llm_cache.db"))
+    os.environ.setdefault("SEARCH_CACHE_PATH", os.path.join(workdir, "search_cache.db"))
+    os.environ["LLM_CACHE_ENABLED"] = "true" if args.cache else "false"
+    for option, env in [("api_latency_ms", "FAKE_API_LATENCY_MS"), ("run_latency_ms", "FAKE_RUN_LATENCY_MS"),
+                        ("search_latency_ms", "FAKE_SEARCH_LATENCY_MS"), ("summary_latency_ms", "FAKE_SUMMARY_LATENCY_MS"),
+                        ("latency_sigma", "FAKE_LATENCY_SIGMA"),
+                        ("failure_rate", "FAKE_FAILURE_RATE"), ("image_rate", "FAKE_IMAGE_RATE"),
+                        ("image_dir", "FAKE_IMAGE_DIR"), ("seed", "FAKE_SEED")]:
+        value = getattr(args, option)
+        if value is not None:
+            os.environ[env] = str(value)
+
+    import uvicorn
+    from main import app
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        return await run_benchmark(f"http://127.0.0.1:{port}", args.sessions, args.rounds, args.rows, args.same_dataset)
+    finally:
+        server.should_exit = True
+        await serve_task
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of an in-process one")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent sessions per round")
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--rows", type=int, default=1000, help="rows in each synthetic dataset")
+    parser.add_argument("--same-dataset", action="store_true", help="upload identical content in every session")
+    parser.add_argument("--cache", action="store_true", help="leave the LLM reply cache on")
+    fake = parser.add_argument_group("fake backend (in-process server only)")
+    fake.add_argument("--api-latency-ms", type=float)
+    fake.add_argument("--run-latency-ms", type=float)
+    fake.add_argument("--search-latency-ms", type=float)
+    fake.add_argument("--summary-latency-ms", type=float)
+    fake.add_argument("--latency-sigma", type=float)
+    fake.add_argument("--failure-rate", type=float)
+    fake.add_argument("--image-rate", type=float)
+    fake.add_argument("--image-dir")
+    fake.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    if args.url:
+        timings = asyncio.run(run_benchmark(args.url, args.sessions, args.rounds, args.rows, args.same_dataset))
+    else:
+        timings = asyncio.run(_run_in_process(args))
+    report(timings, args.sessions, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+
+from PIL import Image as PILImage
+
+BLOB_DIR = os.getenv("BLOB_DIR", "./blobs")  # root of the content-addressed store
+
+# Longest edge in pixels for each rendition; "full" keeps the original dimensions
+RENDITION_SIZES = {"thumb": 256, "display": 768, "full": None}
+RENDITION_FORMATS = {"webp": ("WEBP", "image/webp"), "png": ("PNG", "image/png")}
+WEBP_QUALITY = 80
+
+
+def blob_path(digest: str) -> str:
+    """Path of the blob with the given SHA-256 hex digest (fanned out by its first two characters)."""
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def put_blob(data: bytes) -> str:
+    """
+    Store `data` under its SHA-256 digest and return the digest.
+    Identical content is only written once; writes are atomic so readers never see partial files.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if os.path.exists(path):
+        return digest
+
+    _atomic_write(path, data)
+    return digest
+
+
+def put_file(path: str) -> str:
+    """
+    Move the file at `path` into the store (hashing it in chunks) and return its digest.
+    For artifacts too large to hold in memory; the file must be on the same filesystem as BLOB_DIR.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    target = blob_path(digest)
+    if os.path.exists(target):
+        os.unlink(path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    return digest
+
+
+def _atomic_write(path: str, data: bytes):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def rendition_path(digest: str, size: str, fmt: str) -> str:
+    """Path of a resized/re-encoded copy of a blob, cached next to the original."""
+    if size == "full" and fmt == "png":
+        return blob_path(digest)
+    return f"{blob_path(digest)}.{size}.{fmt}"
+
+
+def make_rendition(digest: str, size: str, fmt: str) -> str:
+    """Create the rendition if it is not cached yet and return its path."""
+    path = rendition_path(digest, size, fmt)
+    if os.path.exists(path):
+        return path
+
+    with PILImage.open(blob_path(digest)) as image:
+        max_edge = RENDITION_SIZES[size]
+        if max_edge:
+            image.thumbnail((max_edge, max_edge))
+        pil_format, _ = RENDITION_FORMATS[fmt]
+        buffer = BytesIO()
+        image.save(buffer, pil_format, **({"quality": WEBP_QUALITY} if fmt == "webp" else {}))
+
+    _atomic_write(path, buffer.getvalue())
+    return path
+
+
+def store_image(data: bytes) -> str:
+    """
+    Store a chart and pre-render the WebP thumbnail and display renditions the canvas asks for.
+    Returns the digest of the original.
+    """
+    digest = put_blob(data)
+    for size in ("thumb", "display"):
+        try:
+            make_rendition(digest, size, "webp")
+        except OSError:
+            # Not something Pillow can decode; the original is still served as-is
+            break
+    return digest
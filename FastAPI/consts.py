@@ -1,3 +1,5 @@
+import os
+
 INSTRUCTIONS = """
 You will use data as a database for a mind map of data. You will first use this data to perform basic analyses to derive correlations and distributions between different columns (variables) for the data. You will then return these to the user. The user will then ask for more open-ended analysis and to come up with creative meanings behind the data correlations and connections. Do not ask for Follow-up questions, or future directions. Just give the response to the instruction and only the response.
 You are an AI Data Scientist focusing on identifying valuable features in datasets and uncovering high-level causal relationships between variables. Techniques to utilize: Correlation Analysis: Compute correlation coefficients for numerical columns to identify relationships. Cross-tabulation: For categorical variables, create contingency tables. Time Series Analysis: Identify trends or seasonal patterns. Combine Columns: Suggest combinations of columns to derive more meaningful features.
@@ -16,4 +18,66 @@ SUGGESTED_QUESTION_PROMPT = f"Generate {NUM_QUESTIONS} followup questions that a
 LEVEL_ONE_HALF_PROMPT = "Use the previous responses in the thread conversation in order to answer the question. Limit the response to <= 300 characters. Cite any sources or papers when referring to external concepts/ideas."
 LEVEL_ONE_PROMPT_SUFFIX = "Be precise with your results. Any plots should be made with matplotlib and seaborn and should have clearly defined axes and should not be convoluted by using heat maps and alpha values for appropriate graph types. Plots should use histograms for continuous values, and bar graphs for discrete plots. Aggregation of values should also be used for very volatile data values over time."
 
-RETRIES = 5 # number of times to retry prompt before raising error
\ No newline at end of file
+L2_SUMMARY_FORMAT = f" Output a summary enclosed in {DELIMITER} and then a title based on this summary that is one sentence <= 50 characters also surrounded by {DELIMITER} (don't forget that both the summary and the title should be enclosed in {DELIMITER})."
+
+# Structured node mode: one run returns the whole node as JSON instead of separate title/question runs
+STRUCTURED_NODES = os.getenv("STRUCTURED_NODES", "false").lower() == "true"
+STRUCTURED_NODE_SUFFIX = f" Respond with a single JSON object with the fields \"body\" (your full answer), \"title\" (the key finding in one sentence <= 50 characters), \"surprising\" (1 to 10, how surprising rather than boring / generic the finding is) and \"questions\" ({NUM_QUESTIONS} followup questions a user might ask about the finding, focusing on clarifications of difficult terms or implications of causal relationships found)."
+
+# Appended to INITIAL_PROMPT and the L1 prompts when the upload could be profiled (see profiling.py)
+PROFILE_PROMPT = "\n\nThe dataset has already been profiled, use these statistics instead of recomputing column types, summary statistics, correlations, crosstabs or missingness:\n{profile}"
+
+RETRIES = 5 # number of times to retry prompt before raising error
+RETRY_BACKOFF_BASE = 1.0 # seconds, doubled per failed run (with full jitter)
+RETRY_BACKOFF_MAX = 30.0
+
+# Run polling (see _next_poll_delay in utils.py)
+POLL_MIN_INTERVAL = 0.25 # seconds between the first polls of a run
+POLL_MAX_INTERVAL = 5.0
+POLL_GROWTH = 1.5 # interval multiplier once a run takes longer than its stage usually does
+
+# Limits for the shared I/O scheduler (see scheduler.py)
+MAX_CONCURRENT_RUNS = int(os.getenv("MAX_CONCURRENT_RUNS", 32)) # node builders in flight across the process
+MAX_RUNS_PER_HUB = int(os.getenv("MAX_RUNS_PER_HUB", 5)) # node builders in flight for a single hub
+
+# Pre-created empty threads (see thread_pool.py)
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", 20)) # threads kept ready, 0 creates every thread on demand
+THREAD_POOL_MAX_AGE = int(os.getenv("THREAD_POOL_MAX_AGE", 60 * 60)) # seconds before an unused thread is discarded
+THREAD_POOL_REFILL_CONCURRENCY = int(os.getenv("THREAD_POOL_REFILL_CONCURRENCY", 4)) # thread creations in flight while refilling
+
+# Durable job queue (see jobs.py and worker.py)
+JOBS_IN_PROCESS = os.getenv("JOBS_IN_PROCESS", "true").lower() == "true" # run a worker inside the API process; set false when `python worker.py` processes do the work
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 16)) # jobs a worker runs at once
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3)) # attempts before a job is marked failed
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5)) # seconds between queue checks when idle
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", 60)) # seconds without a heartbeat before a running job is requeued
+JOB_HEARTBEAT_INTERVAL = JOB_STALE_AFTER / 4 # seconds between heartbeats of running jobs
+JOB_WAIT_TIMEOUT = float(os.getenv("JOB_WAIT_TIMEOUT", 300)) # seconds a request waits on a job before answering 504 (the job carries on)
+
+# Persistent cache of assistant replies (see llm_cache.py)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./llm_cache.db")
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 512 * 1024 * 1024)) # least recently used replies are evicted past this size
+
+# Persistent cache of Exa searches and summaries (see search_cache.py)
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true"
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "./search_cache.db")
+SEARCH_QUERY_TTL = int(os.getenv("SEARCH_QUERY_TTL", 24 * 60 * 60)) # seconds a query's result list is reused
+SEARCH_SUMMARY_TTL = int(os.getenv("SEARCH_SUMMARY_TTL", 30 * 24 * 60 * 60)) # seconds a page summary is reused
+
+# Node list responses (see encoding.py)
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", 1024)) # smaller bodies are sent uncompressed
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", 5)) # 1-9, lower is faster
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", 4)) # 0-11, used when the brotli package is installed
+
+# Reduction of large uploads before they reach the code interpreter (see reduction.py)
+DATASET_REDUCTION = os.getenv("DATASET_REDUCTION", "off").lower() # off, reservoir (uniform rows) or stratified (every value of a column kept)
+DATASET_REDUCE_ABOVE_BYTES = int(os.getenv("DATASET_REDUCE_ABOVE_BYTES", 64 * 1024 * 1024)) # smaller uploads are sent as they are
+DATASET_TARGET_ROWS = int(os.getenv("DATASET_TARGET_ROWS", 200_000)) # rows kept in the sample
+DATASET_STRATIFY_COLUMN = os.getenv("DATASET_STRATIFY_COLUMN", "") # stratified mode: empty picks the categorical column with the fewest values
+DATASET_STRATUM_MIN_ROWS = int(os.getenv("DATASET_STRATUM_MIN_ROWS", 1000)) # stratified mode: rows kept of every value, however rare
+DATASET_MAX_STRATA = int(os.getenv("DATASET_MAX_STRATA", 100)) # stratified mode: more values than this falls back to uniform sampling
+DATASET_SAMPLE_SEED = int(os.getenv("DATASET_SAMPLE_SEED", 0)) # the same upload always yields the same sample
+DATASET_REDUCED_FORMAT = os.getenv("DATASET_REDUCED_FORMAT", "parquet").lower() # parquet (typed, compact; needs pyarrow) or csv (untyped text, same delimiter as the upload)
+
+REDUCTION_PROMPT = "\n\nThe attached file is a reduced copy of the uploaded data: {summary} The profile above describes the full data."
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import json
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from blobstore import blob_path
+from database import Dataset, session_scope
+from profiling import profile_dataset
+from reduction import reduce_dataset
+from timings import stage_timings
+from utils import create_assistant_for_file, create_thread
+
+CHUNK_SIZE = 1024 * 1024  # bytes read at a time while hashing uploads
+
+
+def hash_file(file: BinaryIO) -> str:
+    """
+    SHA-256 of a file object, read in chunks so memory stays flat for multi-GB uploads.
+    The file is rewound afterwards so it can be streamed again.
+    """
+    file.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+# Registrations in flight, so concurrent uploads of the same file create one assistant
+_pending: Dict[str, asyncio.Task] = {}
+
+
+async def assistant_for_dataset(file: BinaryIO, file_name: str, digest: str) -> Tuple[str, str]:
+    """
+    Return (assistant ID, new thread ID) for the dataset with the given hash.
+    The file is only uploaded and an assistant only created the first time its content is seen;
+    later uploads reuse the registered assistant and just start a new thread.
+    """
+    with session_scope() as db:
+        dataset = db.get(Dataset, digest)
+
+    if dataset and dataset.assistant_id:
+        assistant_id = dataset.assistant_id
+    else:
+        assistant_id = await _registered_assistant(file, file_name, digest)
+
+    return assistant_id, await create_thread()
+
+
+async def _registered_assistant(file: BinaryIO, file_name: str, digest: str) -> str:
+    while True:
+        task = _pending.get(digest)
+        joined = task is not None
+        if not joined:
+            task = asyncio.create_task(_register_dataset(file, file_name, digest))
+            _pending[digest] = task
+            task.add_done_callback(lambda _: _pending.pop(digest, None))
+        try:
+            # Shielded so one cancelled request does not abort the registration others wait on
+            return await asyncio.shield(task)
+        except Exception:
+            # The shared registration reads the first request's upload, which is closed once that request
+            # ends; a request that joined it tries again with its own file
+            if not joined:
+                raise
+
+
+async def _register_dataset(file: BinaryIO, file_name: str, digest: str) -> str:
+    # Large files are replaced by a reduced copy, so the interpreter's runs stay fast (see reduction.py)
+    with session_scope() as db:
+        dataset = db.get(Dataset, digest)
+        profile = json.loads(dataset.profile) if dataset and dataset.profile else None
+    with stage_timings.timed("dataset", "reduce"):
+        reduction = await asyncio.to_thread(reduce_dataset, file, file_name, digest, profile)
+
+    if reduction:
+        artifact, provenance = reduction
+        with open(blob_path(artifact), "rb") as reduced:
+            openai_file_id, assistant_id = await create_assistant_for_file(reduced, provenance["file_name"])
+    else:
+        openai_file_id, assistant_id = await create_assistant_for_file(file, file_name)
+
+    with session_scope() as db:
+        dataset = _get_or_add_dataset(db, digest, file_name)
+        dataset.openai_file_id = openai_file_id
+        dataset.assistant_id = assistant_id
+        dataset.reduction = json.dumps(provenance) if reduction else None
+    return assistant_id
+
+
+def dataset_reduction(digest: str) -> Optional[dict]:
+    """Provenance of the reduced copy the dataset's assistant was given, None if it got the file itself."""
+    with session_scope() as db:
+        dataset = db.get(Dataset, digest)
+        reduction = dataset.reduction if dataset else None
+    return json.loads(reduction) if reduction else None
+
+
+def _get_or_add_dataset(db, digest: str, file_name: str) -> Dataset:
+    dataset = db.get(Dataset, digest)
+    if dataset is None:
+        dataset = Dataset(sha256=digest, file_name=file_name, created_at=datetime.now(timezone.utc).replace(tzinfo=None))
+        db.add(dataset)
+    return dataset
+
+
+async def ensure_profile(file: BinaryIO, file_name: str, digest: str):
+    """
+    Profile the dataset locally (see profiling.py) unless a profile is already stored for its hash.
+    Runs off the event loop; the file is rewound afterwards.
+    """
+    with session_scope() as db:
+        dataset = db.get(Dataset, digest)
+        if dataset is not None and dataset.profile is not None:
+            return
+
+    profile = await asyncio.to_thread(profile_dataset, file, file_name)
+    if profile is None:
+        return
+
+    with session_scope() as db:
+        _get_or_add_dataset(db, digest, file_name).profile = json.dumps(profile)
@@ -0,0 +1,126 @@
+"""
+Node list responses: payloads built straight from the ORM rows (no pydantic round-trip),
+serialized with orjson (or msgpack), compressed when large, and tagged with the hub's version
+so a client refreshing an unchanged hub gets a bodiless `304 Not Modified`.
+"""
+import gzip
+import hashlib
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import orjson
+from fastapi import Request, Response
+
+from consts import RESPONSE_BROTLI_QUALITY, RESPONSE_COMPRESS_MIN_BYTES, RESPONSE_GZIP_LEVEL
+from database import Hub, Node, NodeResponse
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # JSON only
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+NODE_FIELDS: Tuple[str, ...] = tuple(NodeResponse.model_fields)
+
+# Revalidate on every use; the ETag makes that cheap
+NODE_CACHE_CONTROL = "no-cache"
+
+
+def parse_fields(fields: Optional[str]) -> Tuple[str, ...]:
+    """
+    The sparse fieldset asked for with `fields=id,title,parent_node_id`, in NodeResponse order.
+    Every field when not given; raises ValueError naming unknown fields.
+    """
+    if not fields:
+        return NODE_FIELDS
+    wanted = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = wanted - set(NODE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))} (available: {', '.join(NODE_FIELDS)})")
+    return tuple(field for field in NODE_FIELDS if field in wanted)
+
+
+def node_payload(node: Node, fields: Sequence[str] = NODE_FIELDS) -> dict:
+    """The NodeResponse dict of a node, limited to `fields`."""
+    payload = {}
+    for field in fields:
+        if field == "images":
+            payload[field] = [{"id": image.id, "url": image.url} for image in node.images]
+        elif field == "questions":
+            payload[field] = [
+                {"id": question.id, "content": question.content, "answer_node_id": question.answer_node_id}
+                for question in node.questions
+            ]
+        else:
+            payload[field] = getattr(node, field)
+    return payload
+
+
+def weak_etag(*parts: object) -> str:
+    """Weak ETag of everything that shapes a response (versions, cursor, page size, fields, ...)."""
+    return f'W/"{hashlib.sha1(repr(parts).encode()).hexdigest()[:24]}"'
+
+
+def nodes_etag(hub: Hub, *parts: object) -> str:
+    """Weak ETag of a node list: the hub's version (bumped whenever its nodes change, see persistence.py) and `parts`."""
+    return weak_etag(hub.id, hub.version or 0, *parts)
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """A 304 response if the client already holds the representation tagged `etag`, else None."""
+    if_none_match = request.headers.get("if-none-match", "")
+    # Weak comparison: the W/ prefix is ignored on both sides
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if if_none_match.strip() == "*" or etag.removeprefix("W/") in tags:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": NODE_CACHE_CONTROL})
+    return None
+
+
+def _accepted_encodings(request: Request) -> Iterable[str]:
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") not in ("q=0", "q=0.0"):
+            yield name.strip().lower()
+
+
+def json_response(request: Request, payload, etag: Optional[str] = None, headers: Optional[dict] = None) -> Response:
+    return encoded_response(request, orjson.dumps(payload), "application/json", etag, headers)
+
+
+def msgpack_response(request: Request, payload, etag: Optional[str] = None, headers: Optional[dict] = None) -> Response:
+    """Callers check that msgpack is installed (`encoding.msgpack is not None`)."""
+    return encoded_response(request, msgpack.packb(payload), MSGPACK_MEDIA_TYPE, etag, headers)
+
+
+def encoded_response(request: Request, body: bytes, media_type: str, etag: Optional[str] = None,
+                     headers: Optional[dict] = None) -> Response:
+    """
+    Compress bodies of RESPONSE_COMPRESS_MIN_BYTES or more with the best encoding the client
+    accepts (brotli, then gzip).
+    """
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if etag:
+        headers["ETag"] = etag
+        headers["Cache-Control"] = NODE_CACHE_CONTROL
+
+    if len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+        accepted = set(_accepted_encodings(request))
+        if brotli is not None and "br" in accepted:
+            body = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+            headers["Content-Encoding"] = "br"
+        elif "gzip" in accepted:
+            body = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+            headers["Content-Encoding"] = "gzip"
+
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def nodes_response(request: Request, nodes: List[Node], fields: Sequence[str] = NODE_FIELDS,
+                   etag: Optional[str] = None, headers: Optional[dict] = None) -> Response:
+    return json_response(request, [node_payload(node, fields) for node in nodes], etag, headers)
@@ -0,0 +1,60 @@
+import asyncio
+import json
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Set, Tuple
+
+MAX_HISTORY_PER_HUB = 200  # events kept per hub so late subscribers can catch up
+MAX_HUBS_WITH_HISTORY = 1000  # hubs whose history is kept in memory (least recently used are dropped)
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}  # stop proxies from buffering streams
+
+
+def format_sse(event: str, data: Any) -> str:
+    """Encode a single server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class HubEvents:
+    """
+    In-process publish/subscribe bus for hub progress.
+
+    Node builders publish events as they go (stage progress and finished nodes),
+    and every open `/hubs/{hub_id}/events` stream receives them through its own queue.
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._history: "OrderedDict[str, Deque[Tuple[str, Any]]]" = OrderedDict()
+
+    def publish(self, hub_id: Optional[str], event: str, data: Any):
+        if hub_id is None:
+            return
+
+        history = self._history.setdefault(hub_id, deque(maxlen=MAX_HISTORY_PER_HUB))
+        history.append((event, data))
+        self._history.move_to_end(hub_id)
+        while len(self._history) > MAX_HUBS_WITH_HISTORY:
+            self._history.popitem(last=False)
+
+        for queue in self._subscribers.get(hub_id, ()):
+            queue.put_nowait((event, data))
+
+    def subscribe(self, hub_id: str) -> asyncio.Queue:
+        """Register a new listener; events published from now on are queued for it."""
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(hub_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, hub_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(hub_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[hub_id]
+
+    def history(self, hub_id: str):
+        """Events already published for the hub, oldest first."""
+        return list(self._history.get(hub_id, ()))
+
+
+hub_events = HubEvents()
@@ -0,0 +1,354 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from PIL import Image as PILImage, ImageDraw
+
+from consts import (DELIMITER, INITIAL_PROMPT, L2_OUTPUT, NUM_PROMPTS, NUM_QUESTIONS, STRUCTURED_NODE_SUFFIX,
+                    SUGGESTED_QUESTION_PROMPT)
+
+LOREM = ("The data shows a moderate positive correlation between the two variables, with a seasonal "
+         "peak in the summer months and a long tail of outliers in the upper decile.")
+
+
+@dataclass
+class FakeConfig:
+    """Behaviour of the stand-in backend. Latencies are medians of a log-normal distribution."""
+    api_latency_ms: float = 30  # plain API calls (threads, messages, files)
+    run_latency_ms: float = 3000  # a code interpreter run, from creation to completion
+    search_latency_ms: float = 150  # an Exa search, without contents
+    summary_latency_ms: float = 400  # summarizing the pages of a search (or of get_contents)
+    latency_sigma: float = 0.5  # spread of every distribution, 0 makes latencies fixed
+    failure_rate: float = 0.0  # fraction of runs that end as "failed"
+    image_rate: float = 0.5  # fraction of run replies that carry a chart
+    image_dir: Optional[str] = None  # PNGs to use as charts, generated ones otherwise
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "FakeConfig":
+        seed = os.getenv("FAKE_SEED")
+        return cls(
+            api_latency_ms=float(os.getenv("FAKE_API_LATENCY_MS", cls.api_latency_ms)),
+            run_latency_ms=float(os.getenv("FAKE_RUN_LATENCY_MS", cls.run_latency_ms)),
+            search_latency_ms=float(os.getenv("FAKE_SEARCH_LATENCY_MS", cls.search_latency_ms)),
+            summary_latency_ms=float(os.getenv("FAKE_SUMMARY_LATENCY_MS", cls.summary_latency_ms)),
+            latency_sigma=float(os.getenv("FAKE_LATENCY_SIGMA", cls.latency_sigma)),
+            failure_rate=float(os.getenv("FAKE_FAILURE_RATE", cls.failure_rate)),
+            image_rate=float(os.getenv("FAKE_IMAGE_RATE", cls.image_rate)),
+            image_dir=os.getenv("FAKE_IMAGE_DIR"),
+            seed=int(seed) if seed is not None else None,
+        )
+
+
+class _Backend:
+    """State shared by the fake OpenAI and Exa clients."""
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self._ids = itertools.count(1)
+        self.files: Dict[str, bytes] = {}
+        self.threads: Dict[str, List[SimpleNamespace]] = {}
+        self.runs: Dict[str, SimpleNamespace] = {}
+        self.images = self._load_images(config.image_dir)
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}_fake{next(self._ids)}"
+
+    def latency(self, median_ms: float) -> float:
+        if median_ms <= 0:
+            return 0.0
+        return self.random.lognormvariate(math.log(median_ms), self.config.latency_sigma) / 1000
+
+    async def api_call(self):
+        await asyncio.sleep(self.latency(self.config.api_latency_ms))
+
+    def _load_images(self, image_dir: Optional[str]) -> List[bytes]:
+        if image_dir:
+            images = []
+            for name in sorted(os.listdir(image_dir)):
+                if name.lower().endswith(".png"):
+                    with open(os.path.join(image_dir, name), "rb") as f:
+                        images.append(f.read())
+            if images:
+                return images
+        return [self._bar_chart(seed) for seed in range(4)]
+
+    @staticmethod
+    def _bar_chart(seed: int) -> bytes:
+        # A plain bar chart roughly the size of a matplotlib figure
+        rng = random.Random(seed)
+        image = PILImage.new("RGB", (800, 600), "white")
+        draw = ImageDraw.Draw(image)
+        for i in range(12):
+            height = rng.randint(50, 500)
+            draw.rectangle([60 + i * 60, 550 - height, 100 + i * 60, 550], fill=(31, 119, 180))
+        draw.line([50, 550, 780, 550], fill="black", width=2)
+        draw.line([50, 40, 50, 550], fill="black", width=2)
+        buffer = BytesIO()
+        image.save(buffer, "PNG")
+        return buffer.getvalue()
+
+    def reply_for(self, prompt: str) -> str:
+        """A reply in the shape the parsers in utils.py expect for the prompt."""
+        def delimited(items):
+            return " ".join(f"{DELIMITER}{item}{DELIMITER}" for item in items)
+
+        if prompt.endswith(STRUCTURED_NODE_SUFFIX):
+            return json.dumps({
+                "body": LOREM,
+                "title": "Rainfall peaks in summer",
+                "surprising": self.random.randint(1, 10),
+                "questions": [f"What drives finding number {i}?" for i in range(NUM_QUESTIONS)],
+            })
+        if prompt.startswith(INITIAL_PROMPT):
+            return delimited(f"Analyse the distribution of column {i} against column {i + 1}" for i in range(NUM_PROMPTS))
+        if prompt.startswith(SUGGESTED_QUESTION_PROMPT):
+            return delimited(f"What drives finding number {i}?" for i in range(NUM_QUESTIONS))
+        if "summary enclosed in" in prompt:
+            return delimited([LOREM, "How this source relates to the finding"])
+        return LOREM
+
+    def message(self, role: str, text: str, image_file_id: Optional[str] = None) -> SimpleNamespace:
+        content = [SimpleNamespace(type="text", text=SimpleNamespace(value=text, annotations=[]))]
+        if image_file_id:
+            content.insert(0, SimpleNamespace(type="image_file", image_file=SimpleNamespace(file_id=image_file_id)))
+        return SimpleNamespace(id=self.new_id("msg"), role=role, content=content, created_at=int(time.time()))
+
+
+class _Page:
+    """
+    Stands in for AsyncPaginator: awaiting it gives the first page (`.data`),
+    `async for` walks every matching item, like auto-pagination does.
+    """
+
+    def __init__(self, backend: _Backend, items: List[SimpleNamespace], limit: int):
+        self._backend = backend
+        self._items = items
+        self.data = items[:limit]
+
+    def __await__(self):
+        return self._fetch().__await__()
+
+    async def _fetch(self):
+        await self._backend.api_call()
+        return self
+
+    async def __aiter__(self):
+        await self._backend.api_call()
+        for item in self._items:
+            yield item
+
+
+class _Files:
+    def __init__(self, backend: _Backend):
+        self._backend = backend
+        self.with_raw_response = self
+
+    async def create(self, file, purpose: str):
+        await self._backend.api_call()
+        if isinstance(file, tuple):
+            file = file[1]
+        data = file if isinstance(file, bytes) else file.read()
+        file_id = self._backend.new_id("file")
+        self._backend.files[file_id] = data
+        return SimpleNamespace(id=file_id, bytes=len(data), purpose=purpose)
+
+    async def retrieve_content(self, file_id: str):
+        await self._backend.api_call()
+        data = self._backend.files.get(file_id)
+        return SimpleNamespace(status_code=200 if data is not None else 404, content=data)
+
+
+class _Assistants:
+    def __init__(self, backend: _Backend):
+        self._backend = backend
+
+    async def create(self, **kwargs):
+        await self._backend.api_call()
+        return SimpleNamespace(id=self._backend.new_id("asst"), **kwargs)
+
+
+class _Messages:
+    def __init__(self, backend: _Backend):
+        self._backend = backend
+
+    async def create(self, thread_id: str, role: str, content: str):
+        await self._backend.api_call()
+        message = self._backend.message(role, content)
+        self._backend.threads[thread_id].append(message)
+        return message
+
+    def list(self, thread_id: str, order: str = "desc", after: Optional[str] = None, limit: int = 20, **_):
+        messages = list(self._backend.threads[thread_id])
+        if order == "desc":
+            messages.reverse()
+        if after is not None:
+            ids = [message.id for message in messages]
+            messages = messages[ids.index(after) + 1:] if after in ids else []
+        return _Page(self._backend, messages, limit)
+
+
+class _RunStream:
+    """Stands in for AsyncAssistantStreamManager: the reply arrives as word deltas over the run."""
+
+    def __init__(self, runs: "_Runs", thread_id: str, assistant_id: str):
+        self._runs = runs
+        self._thread_id = thread_id
+        self._assistant_id = assistant_id
+        self._run = None
+
+    async def __aenter__(self):
+        self._run = await self._runs.create(thread_id=self._thread_id, assistant_id=self._assistant_id)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    async def text_deltas(self):
+        run = self._run
+        words = run.reply.split(" ")
+        step = max(run.completes_at - time.monotonic(), 0) / len(words)
+        if run.will_fail:
+            await asyncio.sleep(step * len(words))
+            return
+        for i, word in enumerate(words):
+            await asyncio.sleep(step)
+            yield word if i == 0 else " " + word
+
+    async def get_final_run(self):
+        await asyncio.sleep(max(self._run.completes_at - time.monotonic(), 0))
+        return await self._runs.retrieve(self._run.id, thread_id=self._thread_id)
+
+    async def get_final_messages(self):
+        run = await self.get_final_run()
+        return [run.message] if run.status == "completed" else []
+
+
+class _Runs:
+    def __init__(self, backend: _Backend):
+        self._backend = backend
+
+    async def create(self, thread_id: str, assistant_id: str, **_):
+        await self._backend.api_call()
+        backend = self._backend
+        messages = backend.threads[thread_id]
+        prompt = next((m.content[-1].text.value for m in reversed(messages) if m.role == "user"), "")
+        run = SimpleNamespace(
+            id=backend.new_id("run"),
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            status="queued",
+            completes_at=time.monotonic() + backend.latency(backend.config.run_latency_ms),
+            will_fail=backend.random.random() < backend.config.failure_rate,
+            reply=backend.reply_for(prompt),
+            with_image=backend.random.random() < backend.config.image_rate,
+            message=None,
+            usage=None,
+            prompt_tokens=sum(len(m.content[-1].text.value.split()) for m in messages) * 4 // 3,
+        )
+        backend.runs[run.id] = run
+        return run
+
+    async def retrieve(self, run_id: str, thread_id: str):
+        await self._backend.api_call()
+        run = self._backend.runs[run_id]
+        if run.status in ("queued", "in_progress"):
+            if time.monotonic() < run.completes_at:
+                run.status = "in_progress"
+            elif run.will_fail:
+                run.status = "failed"
+            else:
+                self._complete(run)
+        return run
+
+    def _complete(self, run):
+        backend = self._backend
+        image_file_id = None
+        if run.with_image:
+            image_file_id = backend.new_id("file")
+            backend.files[image_file_id] = backend.random.choice(backend.images)
+        run.message = backend.message("assistant", run.reply, image_file_id)
+        backend.threads[run.thread_id].append(run.message)
+        # Roughly 4 tokens per 3 words, like English text
+        completion_tokens = len(run.reply.split()) * 4 // 3
+        run.usage = SimpleNamespace(prompt_tokens=run.prompt_tokens, completion_tokens=completion_tokens,
+                                    total_tokens=run.prompt_tokens + completion_tokens)
+        run.status = "completed"
+
+    async def create_and_poll(self, thread_id: str, assistant_id: str, **_):
+        run = await self.create(thread_id=thread_id, assistant_id=assistant_id)
+        await asyncio.sleep(max(run.completes_at - time.monotonic(), 0))
+        return await self.retrieve(run.id, thread_id=thread_id)
+
+    def stream(self, thread_id: str, assistant_id: str, **_):
+        return _RunStream(self, thread_id, assistant_id)
+
+
+class _Threads:
+    def __init__(self, backend: _Backend):
+        self._backend = backend
+        self.messages = _Messages(backend)
+        self.runs = _Runs(backend)
+
+    async def create(self, **_):
+        await self._backend.api_call()
+        thread_id = self._backend.new_id("thread")
+        self._backend.threads[thread_id] = []
+        return SimpleNamespace(id=thread_id)
+
+
+class FakeAsyncOpenAI:
+    """In-process stand-in for the parts of `AsyncOpenAI` the pipeline uses (files, assistants, threads, runs)."""
+
+    def __init__(self, backend: _Backend):
+        self.files = _Files(backend)
+        self.beta = SimpleNamespace(assistants=_Assistants(backend), threads=_Threads(backend))
+
+
+class FakeExa:
+    """
+    In-process stand-in for `Exa.search`, `Exa.get_contents` and `Exa.search_and_contents`
+    (synchronous, like the SDK). A query always returns the same URLs.
+    """
+
+    def __init__(self, backend: _Backend):
+        self._backend = backend
+
+    def search(self, query: str, num_results: int = L2_OUTPUT, **_):
+        time.sleep(self._backend.latency(self._backend.config.search_latency_ms))
+        digest = hashlib.sha256(query.encode()).hexdigest()[:12]
+        results = [
+            SimpleNamespace(title=f"Study {i + 1} on {query[:40]}", url=f"https://example.org/articles/{digest}-{i}",
+                            summary=None)
+            for i in range(num_results)
+        ]
+        return SimpleNamespace(results=results)
+
+    def get_contents(self, urls: List[str], summary: bool = False, **_):
+        time.sleep(self._backend.latency(self._backend.config.summary_latency_ms))
+        return SimpleNamespace(results=[SimpleNamespace(title=None, url=url, summary=LOREM if summary else None)
+                                        for url in urls])
+
+    def search_and_contents(self, query: str, num_results: int = L2_OUTPUT, summary: bool = False, **_):
+        results = self.search(query, num_results).results
+        summaries = self.get_contents([result.url for result in results], summary=summary).results
+        for result, contents in zip(results, summaries):
+            result.summary = contents.summary
+        return SimpleNamespace(results=results)
+
+
+def create_fake_clients(config: Optional[FakeConfig] = None):
+    """A fake OpenAI client and Exa client sharing one backend."""
+    backend = _Backend(config or FakeConfig.from_env())
+    return FakeAsyncOpenAI(backend), FakeExa(backend)
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as _Session
+
+from consts import (JOB_HEARTBEAT_INTERVAL, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL, JOB_STALE_AFTER, JOB_WAIT_TIMEOUT,
+                    RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX)
+from database import Job, JobResponse, session_scope
+from metrics import registry
+
+# Priority classes, lower is claimed first
+PRIORITY_INTERACTIVE = 0  # a user is waiting on the answer
+PRIORITY_BULK = 10  # hub generation
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+FINISHED = (DONE, FAILED)
+
+_wakeup: Optional[asyncio.Event] = None  # set when a job is enqueued in this process
+_finished: Dict[str, asyncio.Event] = {}  # local waiters on a job, see wait_for
+_waiters: Dict[str, int] = {}  # how many coroutines wait on each event in _finished
+
+
+def queue_depth() -> Dict[tuple, int]:
+    """Jobs waiting or running, by status and priority (read when /metrics is scraped)."""
+    with session_scope() as db:
+        rows = (db.query(Job.status, Job.priority, func.count())
+                .filter(Job.status.in_((QUEUED, RUNNING)))
+                .group_by(Job.status, Job.priority)
+                .all())
+    return {(status, str(priority)): count for status, priority, count in rows}
+
+
+registry.collect("job_queue_depth", "Jobs queued or running in the durable queue.", queue_depth,
+                 ("status", "priority"))
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def add_job(db: _Session, kind: str, payload: dict, priority: int, hub_id: Optional[str] = None,
+            parent_id: Optional[str] = None, key: Optional[str] = None) -> Job:
+    """Add a job to the caller's transaction, so it is only queued if the surrounding work commits."""
+    now = _now()
+    job = Job(kind=kind, key=key, priority=priority, status=QUEUED, payload=json.dumps(payload), attempts=0,
+              hub_id=hub_id, parent_id=parent_id, run_after=now, created_at=now, updated_at=now)
+    db.add(job)
+    return job
+
+
+def enqueue(kind: str, payload: dict, priority: int, hub_id: Optional[str] = None,
+            parent_id: Optional[str] = None, key: Optional[str] = None) -> str:
+    """
+    Queue a job in its own transaction and return its ID. With a `key`, enqueueing a step that
+    is already queued (or was already run) returns the existing job instead of adding another;
+    one that failed for good is queued again.
+    """
+    try:
+        with session_scope() as db:
+            job = add_job(db, kind, payload, priority, hub_id, parent_id, key)
+        job_id = job.id
+    except IntegrityError:
+        with session_scope() as db:
+            job_id = db.query(Job.id).filter(Job.key == key).scalar()
+            db.execute(
+                update(Job).where(Job.id == job_id, Job.status == FAILED)
+                .values(status=QUEUED, attempts=0, error=None, worker_id=None, run_after=_now(), updated_at=_now())
+            )
+    notify()
+    return job_id
+
+
+def reserve(kind: str, payload: dict, priority: int, worker_id: str, hub_id: Optional[str] = None,
+            key: Optional[str] = None) -> Optional[Job]:
+    """
+    Take on a keyed job's work outside the queue (an answer streamed to the client). The job is
+    recorded as running under `worker_id`, so enqueueing or reserving the same `key` meanwhile, in
+    any process, waits on it instead of doing the work again. Returns None if the key is already
+    queued, running or done; a job that failed for good is taken over.
+    The caller keeps the job alive (see `keep_alive`) and ends it with `complete` or `fail`, which
+    hands it to the queue to be retried.
+    """
+    now = _now()
+    try:
+        with session_scope() as db:
+            job = add_job(db, kind, payload, priority, hub_id, key=key)
+            job.status, job.worker_id, job.attempts, job.heartbeat_at = RUNNING, worker_id, 1, now
+        return job
+    except IntegrityError:
+        with session_scope() as db:
+            taken = db.execute(
+                update(Job).where(Job.key == key, Job.status == FAILED)
+                .values(status=RUNNING, worker_id=worker_id, attempts=1, error=None, heartbeat_at=now, updated_at=now)
+            ).rowcount
+            return db.query(Job).filter(Job.key == key).first() if taken else None
+
+
+async def keep_alive(job_id: str):
+    """Send heartbeats for a reserved job until cancelled, so it is not taken for a crashed worker's."""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        heartbeat([job_id])
+
+
+def notify():
+    """Wake this process's worker (other processes pick the job up on their next poll)."""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+async def wait_for_work(timeout: float):
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    try:
+        await asyncio.wait_for(_wakeup.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    _wakeup.clear()
+
+
+def claim(worker_id: str) -> Optional[Job]:
+    """
+    Take the most urgent runnable job. The conditional UPDATE makes claiming safe between
+    processes without row locks: if another worker got there first, the next candidate is tried.
+    """
+    for _ in range(5):
+        with session_scope() as db:
+            now = _now()
+            job_id = db.execute(
+                select(Job.id)
+                .where(Job.status == QUEUED, Job.run_after <= now)
+                .order_by(Job.priority, Job.created_at)
+                .limit(1)
+            ).scalar()
+            if job_id is None:
+                return None
+            claimed = db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == QUEUED)
+                .values(status=RUNNING, worker_id=worker_id, attempts=Job.attempts + 1, heartbeat_at=now,
+                        updated_at=now)
+            ).rowcount
+            if claimed:
+                return db.get(Job, job_id)
+    return None
+
+
+def heartbeat(job_ids: List[str]):
+    if not job_ids:
+        return
+    with session_scope() as db:
+        db.execute(update(Job).where(Job.id.in_(job_ids), Job.status == RUNNING).values(heartbeat_at=_now()))
+
+
+def complete(job: Job, result: Any = None):
+    _finish(job, status=DONE, result=json.dumps(result))
+
+
+def fail(job: Job, error: str):
+    """Record a failed attempt: the job is retried with backoff until it runs out of attempts."""
+    if job.attempts < JOB_MAX_ATTEMPTS:
+        delay = min(RETRY_BACKOFF_BASE * 2 ** (job.attempts - 1), RETRY_BACKOFF_MAX)
+        with session_scope() as db:
+            db.execute(
+                update(Job).where(Job.id == job.id, Job.status == RUNNING)
+                .values(status=QUEUED, error=error, worker_id=None, run_after=_now() + timedelta(seconds=delay),
+                        updated_at=_now())
+            )
+        notify()
+        return
+    _finish(job, status=FAILED, error=error)
+
+
+def release(job_ids: List[str]):
+    """
+    Put jobs interrupted by a shutdown back in the queue right away (rather than once they look
+    stale); the interrupted attempt is not counted against them.
+    """
+    if not job_ids:
+        return
+    with session_scope() as db:
+        db.execute(
+            update(Job).where(Job.id.in_(job_ids), Job.status == RUNNING)
+            .values(status=QUEUED, worker_id=None, attempts=Job.attempts - 1, run_after=_now(), updated_at=_now())
+        )
+
+
+def _finish(job: Job, **values):
+    with session_scope() as db:
+        db.execute(update(Job).where(Job.id == job.id).values(updated_at=_now(), **values))
+    for name, value in values.items():
+        setattr(job, name, value)
+    event = _finished.get(job.id)
+    if event is not None:
+        event.set()
+
+
+def recover_stale() -> int:
+    """
+    Requeue running jobs whose worker stopped sending heartbeats (it crashed or was killed),
+    or fail them if they have used up their attempts. Returns the number of jobs touched.
+    """
+    cutoff = _now() - timedelta(seconds=JOB_STALE_AFTER)
+    with session_scope() as db:
+        stale = Job.status == RUNNING, Job.heartbeat_at < cutoff
+        failed = db.execute(
+            update(Job).where(*stale, Job.attempts >= JOB_MAX_ATTEMPTS)
+            .values(status=FAILED, error="worker lost", updated_at=_now())
+        ).rowcount
+        requeued = db.execute(
+            update(Job).where(*stale).values(status=QUEUED, worker_id=None, run_after=_now(), updated_at=_now())
+        ).rowcount
+    if requeued:
+        notify()
+    return failed + requeued
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    with session_scope() as db:
+        return db.get(Job, job_id)
+
+
+def job_for_key(key: str) -> Optional[Job]:
+    with session_scope() as db:
+        return db.query(Job).filter(Job.key == key).first()
+
+
+def job_response(job: Job) -> JobResponse:
+    with session_scope() as db:
+        children = dict(
+            db.query(Job.status, func.count()).filter(Job.parent_id == job.id).group_by(Job.status).all()
+        )
+    return JobResponse(
+        id=job.id, kind=job.kind, status=job.status, priority=job.priority, attempts=job.attempts,
+        hub_id=job.hub_id, parent_id=job.parent_id, result=json.loads(job.result) if job.result else None,
+        error=job.error, children=children, created_at=job.created_at, updated_at=job.updated_at,
+    )
+
+
+def hub_l1_job(hub_id: str) -> Optional[Job]:
+    """The job building the hub's L1 nodes (the latest one, should it have been queued again)."""
+    with session_scope() as db:
+        return (db.query(Job)
+                .filter(Job.hub_id == hub_id, Job.kind == "l1_init")
+                .order_by(Job.created_at.desc())
+                .first())
+
+
+def family_finished(root_id: str) -> bool:
+    """True once the job and every job it enqueued have finished."""
+    with session_scope() as db:
+        root = db.get(Job, root_id)
+        if root is None or root.status not in FINISHED:
+            return False
+        return not db.query(Job.id).filter(Job.parent_id == root_id, Job.status.notin_(FINISHED)).first()
+
+
+async def wait_for(job_id: str, timeout: float = JOB_WAIT_TIMEOUT) -> Job:
+    """
+    Wait until the job has finished, or for `timeout` seconds: the job is returned either way, so
+    check its status. Jobs run by this process wake the waiter directly; jobs run by another
+    worker process are noticed on the next poll of the table.
+    """
+    event = _finished.setdefault(job_id, asyncio.Event())
+    _waiters[job_id] = _waiters.get(job_id, 0) + 1
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            job = get_job(job_id)
+            if job is None or job.status in FINISHED or time.monotonic() >= deadline:
+                return job
+            try:
+                await asyncio.wait_for(event.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # The event is shared by everyone waiting on the job, the last one to leave drops it
+        _waiters[job_id] -= 1
+        if not _waiters[job_id]:
+            del _waiters[job_id]
+            _finished.pop(job_id, None)
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from blobstore import blob_path, put_blob
+from consts import LLM_CACHE_ENABLED, LLM_CACHE_MAX_BYTES, LLM_CACHE_PATH
+from metrics import registry
+
+ROOT_LINEAGE = ""  # lineage of a thread nothing has been asked in yet
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS replies (
+    key TEXT PRIMARY KEY,
+    texts TEXT NOT NULL,
+    image_hashes TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_replies_last_used ON replies (last_used);
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    lineage TEXT NOT NULL,
+    pending TEXT NOT NULL DEFAULT '[]'
+);
+"""
+
+
+class LLMCache:
+    """
+    Persistent cache of assistant replies.
+
+    A reply is keyed by the dataset's content hash, the lineage of the thread it was asked in
+    (the chain of cache keys of everything asked there before) and the prompt text, so a hit
+    is only possible when the assistant would have seen exactly the same conversation.
+
+    Replies served from the cache never reach the OpenAI thread. They are queued as "pending"
+    on the thread and written to it as plain messages before the next real run, so the
+    assistant still sees the whole conversation once the cache misses.
+    """
+
+    def __init__(self, path: str, max_bytes: int, enabled: bool = True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def register_thread(self, thread_id: str):
+        """Start tracking a freshly created (empty) thread."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._db().execute(
+                "INSERT OR IGNORE INTO threads (thread_id, lineage) VALUES (?, ?)", (thread_id, ROOT_LINEAGE)
+            )
+
+    def fork(self, source_thread_id: str, thread_id: str):
+        """Track a new thread holding a copy of another's conversation: same lineage, same pending exchanges."""
+        if not self.enabled:
+            return
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT lineage, pending FROM threads WHERE thread_id = ?", (source_thread_id,)).fetchone()
+            if row is None:
+                # The copied history is unknown to the cache as well
+                db.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
+            else:
+                db.execute(
+                    "INSERT OR REPLACE INTO threads (thread_id, lineage, pending) VALUES (?, ?, ?)", (thread_id, *row)
+                )
+
+    def key_for(self, dataset_sha256: Optional[str], thread_id: str, prompt: str) -> Optional[str]:
+        """Cache key for asking `prompt` in the thread, or None if the exchange cannot be cached."""
+        if not self.enabled or not dataset_sha256:
+            return None
+        with self._lock:
+            row = self._db().execute("SELECT lineage FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+        if row is None:
+            # Thread created before the cache saw it, its history is unknown
+            return None
+        return hashlib.sha256("\0".join((dataset_sha256, row[0], prompt)).encode()).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[Tuple[List[str], List[bytes]]]:
+        """Cached (texts, images) for the key, counting a hit or a miss."""
+        if key is None:
+            return None
+        with self._lock:
+            row = self._db().execute("SELECT texts, image_hashes FROM replies WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._db().execute("UPDATE replies SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        images = []
+        if row is not None:
+            try:
+                for digest in json.loads(row[1]):
+                    with open(blob_path(digest), "rb") as f:
+                        images.append(f.read())
+            except OSError:
+                # An image blob went missing, treat the entry as absent
+                row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0]), images
+
+    def put(self, key: Optional[str], texts: List[str], images: List[bytes]):
+        """Store a reply; images go to the blob store and the entry keeps their hashes."""
+        if key is None:
+            return
+        image_hashes = [put_blob(image) for image in images]
+        texts_json = json.dumps(texts)
+        size = len(texts_json) + sum(len(image) for image in images)
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO replies (key, texts, image_hashes, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, texts_json, json.dumps(image_hashes), size, time.time()),
+            )
+            self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache fits; blobs stay, they may back chart images
+        db = self._db()
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM replies").fetchone()[0]
+        while total > self.max_bytes:
+            row = db.execute("SELECT key, size FROM replies ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            db.execute("DELETE FROM replies WHERE key = ?", (row[0],))
+            total -= row[1]
+            self.evictions += 1
+
+    def advance(self, thread_id: str, key: Optional[str], prompt: str, reply: str, synced: bool):
+        """
+        Record that `prompt` was answered in the thread. `synced` is False when the reply came
+        from the cache, in which case the exchange is queued to be written to the thread later.
+        """
+        if key is None:
+            return
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT pending FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+            pending = json.loads(row[0]) if row else []
+            if not synced:
+                pending.append([prompt, reply])
+            db.execute(
+                "INSERT OR REPLACE INTO threads (thread_id, lineage, pending) VALUES (?, ?, ?)",
+                (thread_id, key, json.dumps(pending)),
+            )
+
+    def pending(self, thread_id: str) -> List[Tuple[str, str]]:
+        """Cached exchanges not yet written to the thread, oldest first."""
+        if not self.enabled:
+            return []
+        with self._lock:
+            row = self._db().execute("SELECT pending FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+        return [tuple(exchange) for exchange in json.loads(row[0])] if row else []
+
+    def clear_pending(self, thread_id: str):
+        with self._lock:
+            self._db().execute("UPDATE threads SET pending = '[]' WHERE thread_id = ?", (thread_id,))
+
+    def stats(self) -> dict:
+        entries, size = 0, 0
+        if self.enabled:
+            with self._lock:
+                entries, size = self._db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM replies").fetchone()
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES, LLM_CACHE_ENABLED)
+registry.collect("llm_cache_lookups_total", "Assistant reply cache lookups by result.",
+                 lambda: {("hit",): llm_cache.hits, ("miss",): llm_cache.misses}, ("result",), kind="counter")
@@ -1,20 +1,46 @@
+import asyncio
 import json
 import multiprocessing
+import os
+import socket
+import time
 import uuid
 from io import BytesIO
-from typing import BinaryIO, List, Optional
+from typing import AsyncIterator, BinaryIO, Callable, List, Literal, Optional, Union
 from uuid import UUID
 from pydantic import BaseModel
 
 import uvicorn
-from database import (Hub, Image, Node, NodeResponse, Question, Session,
-                      create_db_and_tables)
-from fastapi import (BackgroundTasks, Depends, FastAPI, File, Form,
-                     HTTPException, Response, UploadFile)
+from consts import JOB_POLL_INTERVAL, JOBS_IN_PROCESS, L2_OUTPUT
+from database import (Hub, Image, Job, JobResponse, Node, NodeResponse, Question, Session, SessionResponse,
+                      create_db_and_tables, get_db, session_scope)
+from datasets import assistant_for_dataset, dataset_reduction, ensure_profile, hash_file
+import encoding
+from encoding import (MSGPACK_MEDIA_TYPE, json_response, msgpack_response, nodes_etag, nodes_response, not_modified,
+                      parse_fields, weak_etag)
+from jobs import (DONE, FAILED, FINISHED, PRIORITY_BULK, PRIORITY_INTERACTIVE, add_job, complete, enqueue, fail,
+                  family_finished, get_job, hub_l1_job, job_for_key, job_response, keep_alive, notify, reserve,
+                  wait_for)
+from llm_cache import llm_cache
+from metrics import http_request_duration, registry
+from profiler import PROFILE_ENABLED, PROFILE_MAX_SECONDS, session_profiles
+from search_cache import search_cache
+from snapshots import export_session, import_snapshot, load_session, session_versions
+from timings import stage_timings
+from transcripts import transcript
+from events import SSE_HEADERS, format_sse, hub_events
+from blobstore import RENDITION_FORMATS, blob_path, make_rendition
+from fastapi import (Depends, FastAPI, File, Form,
+                     HTTPException, Query, Request, Response, UploadFile)
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session as _Session
-from utils import (ExaSearchResponse, create_assistant_for_file, get_db,
-                   l1_init, l2_init, create_level_one_half_node, create_level_one_half_node_prompted)
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from persistence import decode_cursor, encode_cursor, link_answer
+from tasks import answer_key, l2_key
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session as _Session, selectinload
+from worker import Worker
+from utils import (ExaSearchResponse,
+                   stream_level_one_half_node, stream_level_one_half_node_prompted, thread_pool)
 
 app = FastAPI()
 
@@ -30,14 +56,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Job-Id", "ETag"],
 )
 
 @app.on_event("startup")
 def startup_event():
     create_db_and_tables()
+
+@app.on_event("startup")
+async def warm_thread_pool():
+    thread_pool.refill()
+
+@app.on_event("startup")
+async def start_worker():
+    # Hub generation and question answers run from the job queue; a worker here keeps single-process setups working
+    if JOBS_IN_PROCESS:
+        app.state.worker = Worker()
+        app.state.worker_task = asyncio.create_task(app.state.worker.run())
+
+@app.on_event("shutdown")
+async def stop_worker():
+    if JOBS_IN_PROCESS:
+        await app.state.worker.stop()
+        await app.state.worker_task
+
 @app.post("/session/start")
 async def start_session(
-        background_tasks: BackgroundTasks,
         file: UploadFile = File(...),
         session_id: Optional[UUID] = Form(None),
         db: _Session = Depends(get_db),
@@ -47,13 +91,30 @@ async def start_session(
     - `file`: The file to be uploaded and associated with the hub.
     - `session_id`: Optional, if provided a new hub is created for the existing session.
 
+    The hub is built in the background by the job queue; `job` is the ID to pass to `/jobs/{job_id}`.
+
     Curl:
     curl -X POST "http://127.0.0.1:8001/session/start" \
     -F "file=@/Users/benkush/Downloads/usa_rain_prediction_dataset_2024_2025.csv" \
     -H "Content-Type: multipart/form-data"
     """
+    profiler = session_profiles.take()
+    try:
+        return await _start_session(file, session_id, db, profiler)
+    except BaseException:
+        if profiler is not None:
+            await _dump_profile(profiler, "session-start-failed")
+        raise
+
+
+async def _start_session(file: UploadFile, session_id: Optional[UUID], db: _Session, profiler):
     file_name = file.filename
-    file_content = file.file.read()  # This reads the binary content of the file
+
+    # Hash the upload chunk by chunk (it is spooled to disk by Starlette), never holding it all in memory
+    digest = await asyncio.to_thread(hash_file, file.file)
+
+    # Basic statistics are computed here once per dataset instead of in every L1 thread
+    await ensure_profile(file.file, file_name, digest)
 
     if session_id:
         # Find existing session by session_id
@@ -61,55 +122,126 @@ async def start_session(
         if not existing_session:
             raise HTTPException(status_code=404, detail="Session not found")
 
-        assistant_id, initial_thread = create_assistant_for_file(file_content)
-        new_hub = Hub(file_name=file_name, assistant_id=assistant_id, session_id=session_id)
+        assistant_id, initial_thread = await assistant_for_dataset(file.file, file_name, digest)
+        new_hub = Hub(file_name=file_name, assistant_id=assistant_id, dataset_sha256=digest, session_id=session_id,
+                      **_reduction_columns(digest))
         db.add(new_hub)
-        db.commit()
-        background_tasks.add_task(l1_init, new_hub, initial_thread)
+        job = _queue_hub_build(db, new_hub, initial_thread, profiler)
         return {
             "session": session_id,
-            "hub": new_hub.id
+            "hub": new_hub.id,
+            "job": job.id
         }
     else:
         # Create a new session and associate a new hub with it
         new_session = Session()
-        assistant_id, initial_thread = create_assistant_for_file(file_content)
-        new_hub = Hub(file_name=file_name, assistant_id=assistant_id, session=new_session)
+        assistant_id, initial_thread = await assistant_for_dataset(file.file, file_name, digest)
+        new_hub = Hub(file_name=file_name, assistant_id=assistant_id, dataset_sha256=digest, session=new_session,
+                      **_reduction_columns(digest))
         db.add(new_session)
         db.add(new_hub)
-        db.commit()
-        background_tasks.add_task(l1_init, new_hub, initial_thread)
+        job = _queue_hub_build(db, new_hub, initial_thread, profiler)
         return {
             "session": new_session.id,
-            "hub": new_hub.id
+            "hub": new_hub.id,
+            "job": job.id
         }
 
 
 
+def _reduction_columns(digest: str) -> dict:
+    # Provenance of the reduced copy the assistant analyses instead of the upload (see reduction.py)
+    reduction = dataset_reduction(digest)
+    if reduction is None:
+        return {}
+    return {"reduced_sha256": reduction["sha256"], "reduction": json.dumps(reduction)}
+
+
+def _queue_hub_build(db: _Session, hub: Hub, initial_thread: str, profiler) -> Job:
+    # The L1 build job commits together with the hub, so a hub never exists without one
+    db.flush()
+    job = add_job(db, "l1_init", {"hub_id": hub.id, "thread_id": initial_thread}, PRIORITY_BULK, hub_id=hub.id)
+    db.commit()
+    if profiler is not None:
+        # Subscribe before the job can start, so the end of the build cannot be missed
+        asyncio.create_task(_profile_until_done(profiler, hub.id, hub_events.subscribe(hub.id)))
+    notify()
+    return job
+
+
+async def _profile_until_done(profiler, hub_id: str, queue: asyncio.Queue):
+    try:
+        while True:
+            event, _ = await asyncio.wait_for(queue.get(), timeout=PROFILE_MAX_SECONDS)
+            if event == "done":
+                break
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        hub_events.unsubscribe(hub_id, queue)
+    await _dump_profile(profiler, f"session-start-{hub_id}")
+
+
+async def _dump_profile(profiler, name: str):
+    await asyncio.to_thread(profiler.stop)
+    session_profiles.last_path = await asyncio.to_thread(profiler.dump, name)
+    print(f"Profile written to {session_profiles.last_path}.svg")
+
+
+def _sse_response(events):
+    """Wrap an async iterator of (event, data) pairs into a server-sent event response."""
+    async def event_stream():
+        try:
+            async for event, data in events:
+                yield format_sse(event, data)
+        except Exception as e:
+            yield format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 @app.get("/question/{question_id}", response_model=NodeResponse)
-async def answer_question(question_id: str, db: _Session = Depends(get_db)):
+async def answer_question(question_id: str, stream: bool = False, db: _Session = Depends(get_db)):
     """
     Get the question and answer for a specific node.
+    - `stream`: Optional, if true the answer is sent as server-sent events: `token` events while the
+      assistant writes, then `title`, `questions` and finally the saved `node`.
+
+    A question is answered once: asking it again returns the same node (only the `node` event when
+    streaming), and requests made while the answer is being written wait for it.
     """
 
     question = db.query(Question).filter(Question.id == question_id).first()
     if not question:
         raise HTTPException(status_code=404, detail="Question not found")
 
+    if question.answer_node_id:
+        if stream:
+            return _sse_response(_answered(question.answer_node_id))
+        return _load_answer(db, question.answer_node_id)
+
     prev_node = db.query(Node).filter(Node.id == question.node_id).first()
     if not prev_node:
         raise HTTPException(status_code=404, detail="Node not found")
 
-    new_node = create_level_one_half_node(question, prev_node)
-    return new_node
+    payload = {"node_id": prev_node.id, "question_id": question.id}
+    if stream:
+        prev_node.hub  # load the hub now, the DB session is closed once streaming starts
+        return _sse_response(_stream_answer(payload, prev_node.hub_id,
+                                            lambda node_id: stream_level_one_half_node(question, prev_node, node_id)))
+
+    return await _answer_in_queue(payload, prev_node.hub_id, db)
 
 
 class QuestionRequest(BaseModel):
     prompt: str
 @app.post("/question/from/{node_id}", response_model=NodeResponse)
-async def answer_question(node_id: str, request: QuestionRequest, db: _Session = Depends(get_db)):
+async def answer_question(node_id: str, request: QuestionRequest, stream: bool = False, db: _Session = Depends(get_db)):
     """
     Get the question and answer for a specific node.
+    - `stream`: Optional, stream the answer as server-sent events (see `/question/{question_id}`).
+
+    Asking the same prompt (ignoring whitespace) from the same node again returns the same answer.
     """
 
     prompt = request.prompt
@@ -118,47 +250,477 @@ async def answer_question(node_id: str, request: QuestionRequest, db: _Session =
     if not prev_node:
         raise HTTPException(status_code=404, detail="Node not found")
 
-    new_node = create_level_one_half_node_prompted(prompt, prev_node)
-    return new_node
+    payload = {"node_id": prev_node.id, "prompt": prompt}
+    if stream:
+        prev_node.hub  # load the hub now, the DB session is closed once streaming starts
+        return _sse_response(_stream_answer(
+            payload, prev_node.hub_id, lambda node_id: stream_level_one_half_node_prompted(prompt, prev_node, node_id)))
+
+    return await _answer_in_queue(payload, prev_node.hub_id, db)
+
+
+async def _answer_in_queue(payload: dict, hub_id: str, db: _Session) -> Node:
+    # Answers go through the queue ahead of any hub generation, and are retried like every job.
+    # The job is keyed by the question or prompt, so repeated and concurrent requests share it.
+    job = await wait_for(enqueue("answer_question", payload, PRIORITY_INTERACTIVE, hub_id=hub_id,
+                                 key=answer_key(payload)))
+    _raise_unless_done(job, "answer the question")
+    return _load_answer(db, json.loads(job.result)["node_id"])
+
+
+def _raise_unless_done(job: Job, action: str):
+    """504 for a job still running after the wait (it carries on, poll `/jobs/{job_id}`), 502 for one that failed."""
+    if job.status not in FINISHED:
+        raise HTTPException(status_code=504, detail=f"Job {job.id} is still running, poll /jobs/{job.id}",
+                            headers={"X-Job-Id": job.id})
+    if job.status != DONE:
+        raise HTTPException(status_code=502, detail=f"Could not {action}: {job.error}")
+
+
+def _load_answer(db: _Session, node_id: str) -> Node:
+    return (
+        db.query(Node)
+        .options(selectinload(Node.images), selectinload(Node.questions))
+        .filter(Node.id == node_id)
+        .one()
+    )
+
+
+async def _answered(node_id: str) -> AsyncIterator:
+    with session_scope() as db:
+        node = _load_answer(db, node_id)
+    yield "node", NodeResponse.model_validate(node, from_attributes=True).model_dump()
+
+
+# Worker ID under which this process reserves the answers it streams (see jobs.reserve)
+STREAM_WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-stream"
+
+
+async def _stream_answer(payload: dict, hub_id: str, events: Callable[[str], AsyncIterator]) -> AsyncIterator:
+    """
+    Stream `events(node_id)` unless the same answer is already known or being written, in which
+    case only its `node` event is sent once it is saved. While streaming, the answer's job key is
+    reserved in the jobs table, so requests for the same answer from any process, streamed or
+    not, wait for this one instead of asking again.
+    """
+    key = answer_key(payload)
+    while True:
+        job = reserve("answer_question", payload, PRIORITY_INTERACTIVE, STREAM_WORKER_ID, hub_id=hub_id, key=key)
+        if job is not None:
+            break
+        job = await wait_for(job_for_key(key).id)
+        if job.status not in FINISHED:
+            raise TimeoutError(f"Job {job.id} is still running, poll /jobs/{job.id}")
+        if job.status == DONE:
+            async for event in _answered(json.loads(job.result)["node_id"]):
+                yield event
+            return
+        # It failed for good, so reserve it for this stream
+
+    heartbeats = asyncio.create_task(keep_alive(job.id))
+    try:
+        node = None
+        # The node is saved with the job's ID, so a retry by the queue does not save it twice
+        async for event, data in events(job.id):
+            if event == "node":
+                node = data
+            yield event, data
+        node_id = node["id"]
+        if "question_id" in payload:
+            node_id = link_answer(payload["question_id"], node_id)
+        complete(job, {"node_id": node_id})
+    except BaseException as e:
+        # The queue retries the answer for the requests sharing it, even if this client went away
+        fail(job, f"{type(e).__name__}: {e}" if isinstance(e, Exception) else "Stream was cancelled")
+        raise
+    finally:
+        heartbeats.cancel()
+
+@app.get("/session/{session_id}/snapshot", response_model=SessionResponse)
+async def export_session_snapshot(
+        session_id: str,
+        request: Request,
+        format: Literal["json", "msgpack"] = "json",
+        images: bool = False,
+):
+    """
+    The whole session in one response: its hubs, their nodes, questions and image references,
+    loaded in one eager query. POST it to `/session/import` to restore it as a new session.
+    - `format`: Optional, `msgpack` for a compact binary document (needs the msgpack package).
+    - `images`: Optional, embed the charts' bytes, for importing on a server that does not have them.
+
+    Responses carry an ETag built from the hubs' versions, like hub node lists.
+    """
+    if format == "msgpack" and encoding.msgpack is None:
+        raise HTTPException(status_code=406, detail="msgpack is not installed on this server")
+
+    versions = await asyncio.to_thread(session_versions, session_id)
+    if versions is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    etag = weak_etag("snapshot", session_id, versions, format, images)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    session = await asyncio.to_thread(load_session, session_id)
+    snapshot = await asyncio.to_thread(export_session, session, images, format == "msgpack")
+    if format == "msgpack":
+        return msgpack_response(request, snapshot, etag)
+    return json_response(request, snapshot, etag)
+
+
+@app.post("/session/import")
+async def import_session_snapshot(request: Request):
+    """
+    Restore a snapshot from `/session/{session_id}/snapshot` (JSON, or msgpack with
+    `Content-Type: application/msgpack`) as a new session, without regenerating anything.
+    Returns the new session ID and the new ID of each hub of the snapshot.
+    """
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE):
+            if encoding.msgpack is None:
+                raise HTTPException(status_code=415, detail="msgpack is not installed on this server")
+            snapshot = encoding.msgpack.unpackb(body)
+        else:
+            snapshot = json.loads(body)
+        session_id, hub_ids = await asyncio.to_thread(import_snapshot, snapshot)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"session": session_id, "hubs": hub_ids}
+
+
+MAX_PAGE_SIZE = 500
+
 
 @app.get("/hubs/{hub_id}/nodes", response_model=List[NodeResponse])
-async def get_hub_nodes(hub_id: str, db: _Session = Depends(get_db)):
+async def get_hub_nodes(
+        hub_id: str,
+        request: Request,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        since: Optional[str] = None,
+        fields: Optional[str] = None,
+        db: _Session = Depends(get_db),
+):
     """
-    Get all nodes for the given hub ID.
+    Get all nodes for the given hub ID, in the order they were saved.
+    - `limit`: Optional, maximum number of nodes to return.
+    - `since`: Optional, cursor from a previous response; only nodes saved after it are returned.
+    - `fields`: Optional, comma-separated fields to return, e.g. `id,title,parent_node_id` for the canvas layout.
+
+    The `X-Next-Cursor` header holds the cursor to pass as `since` for the next page / refresh.
+    Responses carry an ETag: send it back as `If-None-Match` to get `304` while the hub is unchanged.
     """
-    print(hub_id)
+    try:
+        selected = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     # Fetch the hub by hub_id
     hub = db.query(Hub).filter(Hub.id == hub_id).first()
 
     if not hub:
         raise HTTPException(status_code=404, detail="Hub not found")
 
-    # Fetch all nodes associated with this hub
-    nodes = db.query(Node).filter(Node.hub_id == hub_id).all()
+    etag = nodes_etag(hub, limit, since, selected)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    # Fetch the nodes with the images and questions asked for in one go (no per-node lazy loads)
+    query = db.query(Node).filter(Node.hub_id == hub_id)
+    if "images" in selected:
+        query = query.options(selectinload(Node.images))
+    if "questions" in selected:
+        query = query.options(selectinload(Node.questions))
+
+    if since:
+        try:
+            seq, node_id = decode_cursor(since)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        query = query.filter(or_(
+            Node.seq > seq,
+            and_(Node.seq == seq, Node.id > node_id),
+        ))
+
+    # Commit order, so nodes saved after a cursor was handed out are never behind it
+    query = query.order_by(Node.seq, Node.id)
+    if limit:
+        query = query.limit(limit)
+    nodes = query.all()
+
+    next_cursor = encode_cursor(nodes[-1]) if nodes else since
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+
+    return nodes_response(request, nodes, selected, etag, headers)
+
+@app.get("/hubs/{hub_id}/events")
+async def stream_hub_events(hub_id: str, db: _Session = Depends(get_db)):
+    """
+    Server-sent event stream of the hub being built.
+    Nodes that already exist are sent first, then every `node` event as soon as it is committed,
+    along with progress events (`prompts_generated`, `run_started`, `image_fetched`) and a final `done`.
 
-    # If no nodes are found, return an empty list
-    if not nodes:
-        nodes = []
+    Curl:
+    curl -N "http://127.0.0.1:8001/hubs/<hub_id>/events"
+    """
+    hub = db.query(Hub).filter(Hub.id == hub_id).first()
+    if not hub:
+        raise HTTPException(status_code=404, detail="Hub not found")
 
-    # Serialize and return the nodes
-    return nodes
+    # Subscribe before reading what already exists so nothing falls in between
+    queue = hub_events.subscribe(hub_id)
+    history = hub_events.history(hub_id)
+    existing_nodes = (
+        db.query(Node)
+        .options(selectinload(Node.images), selectinload(Node.questions))
+        .filter(Node.hub_id == hub_id)
+        .order_by(Node.created_at, Node.id)
+        .all()
+    )
+    existing = [NodeResponse.model_validate(node, from_attributes=True).model_dump() for node in existing_nodes]
+
+    async def event_stream():
+        sent_nodes = set()
+        try:
+            for node in existing:
+                sent_nodes.add(node["id"])
+                yield format_sse("node", node)
+
+            for event, data in history:
+                if event == "node":
+                    if data["id"] in sent_nodes:
+                        continue
+                    sent_nodes.add(data["id"])
+                yield format_sse(event, data)
+                if event == "done":
+                    return
+
+            # A hub built before a restart (or by another process) has no `done` in this process's history
+            finished = _hub_finished(hub_id)
+            if finished:
+                for event, data in _hub_nodes_after(hub_id, sent_nodes) + finished:
+                    yield format_sse(event, data)
+                return
+
+            idle = 0.0
+            while True:
+                if JOBS_IN_PROCESS:
+                    try:
+                        events = [await asyncio.wait_for(queue.get(), timeout=KEEP_ALIVE_INTERVAL)]
+                    except asyncio.TimeoutError:
+                        # Quiet for a while: the build may have been finished by a worker in another process
+                        events = _hub_progress(hub_id, sent_nodes)
+                        idle = KEEP_ALIVE_INTERVAL if not events else 0.0
+                    else:
+                        idle = 0.0
+                else:
+                    # Workers in other processes publish on their own bus, so follow what they write instead
+                    await asyncio.sleep(JOB_POLL_INTERVAL)
+                    events = _hub_progress(hub_id, sent_nodes)
+                    idle = idle + JOB_POLL_INTERVAL if not events else 0.0
+
+                if idle >= KEEP_ALIVE_INTERVAL:
+                    idle = 0.0
+                    yield ": keep-alive\n\n"
+
+                for event, data in events:
+                    if event == "node":
+                        if data["id"] in sent_nodes:
+                            continue
+                        sent_nodes.add(data["id"])
+                    yield format_sse(event, data)
+                    if event == "done":
+                        return
+        finally:
+            hub_events.unsubscribe(hub_id, queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+KEEP_ALIVE_INTERVAL = 15  # seconds of silence before an SSE comment keeps proxies from closing the stream
+
+
+def _hub_progress(hub_id: str, sent_nodes: set) -> List[tuple]:
+    # Hub events rebuilt from the database: nodes not sent yet, then the end of the L1 build
+    return _hub_nodes_after(hub_id, sent_nodes) + _hub_finished(hub_id)
+
+
+def _hub_nodes_after(hub_id: str, sent_nodes: set) -> List[tuple]:
+    with session_scope() as db:
+        nodes = (
+            db.query(Node)
+            .options(selectinload(Node.images), selectinload(Node.questions))
+            .filter(Node.hub_id == hub_id, Node.id.notin_(sent_nodes))
+            .order_by(Node.created_at, Node.id)
+            .all()
+        )
+        return [("node", NodeResponse.model_validate(node, from_attributes=True).model_dump()) for node in nodes]
+
+
+def _hub_finished(hub_id: str) -> List[tuple]:
+    """The closing events of the hub's L1 build if it is over, else nothing."""
+    job = hub_l1_job(hub_id)
+    # Hubs are created together with their build job, so one without (an imported snapshot) has nothing left to build
+    if job is None:
+        return [("done", {})]
+    if not family_finished(job.id):
+        return []
+    return ([("error", {"detail": job.error})] if job.status == FAILED else []) + [("done", {})]
+
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job_status(job_id: str):
+    """
+    Status of a background job (`queued`, `running`, `done` or `failed`), its result once done,
+    and how many of the jobs it enqueued (e.g. a hub's L1 nodes) are in each status.
+    """
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
 
-@app.get("/l2nodes/{l1_node_id}", response_model=List[NodeResponse])
-async def create_level_two_node(l1_node_id: str, db: _Session = Depends(get_db)):
+@app.get("/nodes/{node_id}/transcript")
+async def get_node_transcript(node_id: str, db: _Session = Depends(get_db)):
+    """
+    The conversation behind a node, from the local mirror of its thread (no OpenAI call).
+    Images are referenced by OpenAI file ID and, when downloaded, by blob store hash.
     """
-    Create a new level two node and return the response.
+    node = db.get(Node, node_id)
+    if not node:
+        raise HTTPException(status_code=404, detail="Node not found")
+    return transcript(node.thread_id)
+
+MAX_L2_MORE = 10
+
+
+@app.get("/l2nodes/{l1_node_id}", response_model=Union[List[NodeResponse], JobResponse])
+async def create_level_two_node(
+        l1_node_id: str,
+        request: Request,
+        response: Response,
+        more: int = Query(0, ge=0, le=MAX_L2_MORE),
+        wait: bool = True,
+        fields: Optional[str] = None,
+        db: _Session = Depends(get_db),
+):
     """
+    Get the level two nodes of a node (related sources found with Exa), oldest first.
+    The node is expanded the first time only; afterwards its saved L2 nodes are returned as they are.
+    - `more`: Optional, number of new sources to add; sources already expanded are skipped.
+    - `wait`: Optional, if false and the node has to be expanded, respond right away with `202` and
+      the job (poll `/jobs/{job_id}`, then call again without `more` for the nodes).
+    - `fields`: Optional, comma-separated fields to return (see `/hubs/{hub_id}/nodes`).
+
+    Expansions run in the job queue; the `X-Job-Id` header names the job whenever one was needed.
+    Saved L2 nodes carry an ETag like hub node lists.
+    """
+    try:
+        selected = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     # Retrieve the L1 node from the database
     l1_node = db.get(Node, l1_node_id)
+    if not l1_node:
+        raise HTTPException(status_code=404, detail="Node not found")
+
+    if not more:
+        etag = nodes_etag(l1_node.hub, "l2", l1_node_id, selected)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        children = _l2_children(db, l1_node_id)
+        if children:
+            return nodes_response(request, children, selected, etag)
+    else:
+        children = _l2_children(db, l1_node_id)
+
+    # Keyed by the number of L2 nodes wanted, so concurrent requests for the same growth share a job
+    total = len(children) + (more or L2_OUTPUT)
+    job_id = enqueue("l2_expand", {"node_id": l1_node_id, "total": total}, PRIORITY_INTERACTIVE,
+                     hub_id=l1_node.hub_id, key=l2_key(l1_node_id, total))
+    response.headers["X-Job-Id"] = job_id
+    if not wait:
+        response.status_code = 202
+        return job_response(get_job(job_id))
+
+    job = await wait_for(job_id)
+    _raise_unless_done(job, "expand the node")
+    db.refresh(l1_node.hub)
+    etag = nodes_etag(l1_node.hub, "l2", l1_node_id, selected)
+    return nodes_response(request, _l2_children(db, l1_node_id), selected, etag, {"X-Job-Id": job_id})
+
+
+def _l2_children(db: _Session, node_id: str) -> List[Node]:
+    return (
+        db.query(Node)
+        .options(selectinload(Node.images), selectinload(Node.questions))
+        .filter(Node.parent_node_id == node_id)
+        .order_by(Node.created_at, Node.id)
+        .all()
+    )
+
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template, not the raw path, so IDs do not explode the series
+        route = request.scope.get("route")
+        http_request_duration.observe(time.perf_counter() - start, method=request.method,
+                                      route=route.path if route else "unmatched", status=status)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: request and pipeline stage histograms, runs in flight, pool/queue depth, tokens."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/profile/session-start")
+async def profile_next_session_start():
+    """
+    Profile the next `/session/start` until its hub's L1 build is done (needs PROFILE_ENABLED=true).
+    A flame graph (`.svg`) and folded stacks (`.folded`) are written to PROFILE_DIR.
+    """
+    if not PROFILE_ENABLED:
+        raise HTTPException(status_code=403, detail="Profiling is disabled, set PROFILE_ENABLED=true")
+    session_profiles.arm()
+    return {"armed": True, "last_profile": session_profiles.last_path}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters and size of the persistent assistant reply cache."""
+    return llm_cache.stats()
+
+
+@app.get("/cache/search/stats")
+async def search_cache_stats():
+    """Hit rates of the Exa query and summary caches."""
+    return search_cache.stats()
 
-    # FOR DEBUGGING:
-    # l1_node = db.query(Node).filter(Node.parent_node_id == None).first()
 
-    response = l2_init(l1_node.hub, l1_node)
-    nodes = db.query(Node).filter(Node.id.in_(response)).all()
+@app.get("/threads/pool")
+async def thread_pool_stats():
+    """Pre-created threads ready to be taken, and how often callers found one."""
+    return thread_pool.stats()
 
-    # Serialize and return the nodes
-    return nodes
+
+@app.get("/timings")
+async def get_timings(hub_id: Optional[str] = None):
+    """
+    Time spent per stage (initial, l1, title, questions, l1_5, l2_query, l2) and phase
+    (queue, in_progress, message_fetch, image_download).
+    - `hub_id`: Optional, only the timings of that hub.
+    """
+    return stage_timings.summary(hub_id)
 
 
 @app.get("/runfull")
@@ -168,9 +730,10 @@ async def runfull():
     process.start()
 
 # FOR DEBUGGING
-def run_utils_main( db: Session = next(get_db())):
+def run_utils_main():
     import requests
-    single_node = db.query(Node).filter(Node.parent_node_id == None).first()
+    with session_scope() as db:
+        single_node = db.query(Node).filter(Node.parent_node_id == None).first()
     response = requests.post(f"http://localhost:8000/l2nodes", params={"l1_node_id": single_node.id})
     if response.status_code == 200:
         print("L2 node created successfully:", response.json())
@@ -179,20 +742,48 @@ def run_utils_main( db: Session = next(get_db())):
     return
 
 
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
 @app.get("/images/{image_id}")
-async def get_image(image_id: str, db: Session = Depends(get_db)):
+async def get_image(image_id: str, request: Request, size: Literal["thumb", "display", "full"] = "full",
+                    db: Session = Depends(get_db)):
+    """
+    Serve a chart.
+    - `size`: Optional, `thumb` or `display` for downscaled renditions, `full` (default) for the original.
+    WebP is returned when the `Accept` header allows it, PNG otherwise.
+    """
     # Fetch the image from the database
     image = read_image_from_db(image_id, db)
-    if image:
-        # If the image data is in hex format, convert it to binary
-        if isinstance(image.data, str) and image.data.startswith("0x"):
-            image_data = bytes.fromhex(image.data[2:])  # Remove "0x" and convert hex to binary
-        else:
-            image_data = image.data  # Already binary data
+    if not image:
+        raise HTTPException(status_code=404, detail="Image not found")
 
-        return Response(content=image_data, media_type="image/png")
+    if image.sha256:
+        fmt = "webp" if "image/webp" in request.headers.get("accept", "") else "png"
+
+        # Blob store images never change, so the content hash is a strong ETag
+        etag = f'"{image.sha256}-{size}.{fmt}"'
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL, "Vary": "Accept"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        try:
+            path = await asyncio.to_thread(make_rendition, image.sha256, size, fmt)
+        except OSError:
+            # Pillow could not decode the original, serve it untouched. Those bytes are not what the
+            # ETag above names, so they are neither tagged nor cached: the next request tries again
+            path, fmt = blob_path(image.sha256), "png"
+            headers = {"Cache-Control": "no-cache", "Vary": "Accept"}
+        return FileResponse(path, media_type=RENDITION_FORMATS[fmt][1], headers=headers)
+
+    # If the image data is in hex format, convert it to binary
+    if isinstance(image.data, str) and image.data.startswith("0x"):
+        image_data = bytes.fromhex(image.data[2:])  # Remove "0x" and convert hex to binary
     else:
-        raise HTTPException(status_code=404, detail="Image not found")
+        image_data = image.data  # Already binary data
+
+    return Response(content=image_data, media_type="image/png")
 
 
 def read_image_from_db(image_id: str, db: Session) -> Image:
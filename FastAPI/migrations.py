@@ -0,0 +1,139 @@
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+# Bookkeeping table, kept out of the models' metadata so create_all never touches it
+_version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", _version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+)
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl_type: str):
+    # Databases created after the column was added to the models already have it
+    if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
+def _create_index(conn: Connection, name: str, table: str, *columns: str):
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+
+def _initial_schema(conn: Connection, metadata: MetaData):
+    # Creates every table that does not exist yet; tables from before versioning are patched below
+    metadata.create_all(bind=conn)
+
+
+def _image_blob_hash(conn: Connection, metadata: MetaData):
+    _add_column(conn, "images", "sha256", "VARCHAR")
+    _create_index(conn, "ix_images_sha256", "images", "sha256")
+
+
+def _node_created_at(conn: Connection, metadata: MetaData):
+    _add_column(conn, "nodes", "created_at", "TIMESTAMP")
+    _create_index(conn, "ix_nodes_hub_id_created_at_id", "nodes", "hub_id", "created_at", "id")
+
+
+def _foreign_key_indexes(conn: Connection, metadata: MetaData):
+    _create_index(conn, "ix_hubs_session_id", "hubs", "session_id")
+    _create_index(conn, "ix_nodes_hub_id", "nodes", "hub_id")
+    _create_index(conn, "ix_nodes_parent_node_id", "nodes", "parent_node_id")
+    _create_index(conn, "ix_images_node_id", "images", "node_id")
+    _create_index(conn, "ix_questions_node_id", "questions", "node_id")
+
+
+def _dataset_registry(conn: Connection, metadata: MetaData):
+    metadata.tables["datasets"].create(bind=conn, checkfirst=True)
+    _add_column(conn, "hubs", "dataset_sha256", "VARCHAR")
+    _create_index(conn, "ix_hubs_dataset_sha256", "hubs", "dataset_sha256")
+
+
+def _dataset_profile(conn: Connection, metadata: MetaData):
+    _add_column(conn, "datasets", "profile", "TEXT")
+
+
+def _thread_messages(conn: Connection, metadata: MetaData):
+    metadata.tables["thread_messages"].create(bind=conn, checkfirst=True)
+
+
+def _jobs(conn: Connection, metadata: MetaData):
+    metadata.tables["jobs"].create(bind=conn, checkfirst=True)
+
+
+def _question_answers(conn: Connection, metadata: MetaData):
+    _add_column(conn, "questions", "answer_node_id", "VARCHAR REFERENCES nodes (id)")
+    _create_index(conn, "ix_questions_answer_node_id", "questions", "answer_node_id")
+
+
+def _l2_sources(conn: Connection, metadata: MetaData):
+    _add_column(conn, "nodes", "source_url", "TEXT")
+    _add_column(conn, "nodes", "l2_query", "TEXT")
+
+
+def _hub_version(conn: Connection, metadata: MetaData):
+    _add_column(conn, "hubs", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _dataset_reduction(conn: Connection, metadata: MetaData):
+    _add_column(conn, "datasets", "reduction", "TEXT")
+    _add_column(conn, "hubs", "reduced_sha256", "VARCHAR")
+    _add_column(conn, "hubs", "reduction", "TEXT")
+
+
+def _node_seq(conn: Connection, metadata: MetaData):
+    _add_column(conn, "nodes", "seq", "INTEGER")
+    # Existing nodes are numbered in creation order within their hub (untimed legacy nodes first), and hub
+    # versions move past them. NULLs are compared explicitly, a string stand-in is not a timestamp on Postgres
+    conn.execute(text(
+        "UPDATE nodes SET seq = (SELECT COUNT(*) FROM nodes AS earlier WHERE earlier.hub_id = nodes.hub_id AND ("
+        " (earlier.created_at IS NULL AND nodes.created_at IS NOT NULL)"
+        " OR earlier.created_at < nodes.created_at"
+        " OR ((earlier.created_at = nodes.created_at OR (earlier.created_at IS NULL AND nodes.created_at IS NULL))"
+        " AND earlier.id <= nodes.id)))"
+    ))
+    conn.execute(text("UPDATE hubs SET version = version + (SELECT COUNT(*) FROM nodes WHERE nodes.hub_id = hubs.id)"))
+    _create_index(conn, "ix_nodes_hub_id_seq_id", "nodes", "hub_id", "seq", "id")
+
+
+def _node_thread_shared(conn: Connection, metadata: MetaData):
+    _add_column(conn, "nodes", "thread_shared", "BOOLEAN NOT NULL DEFAULT FALSE")
+
+
+# Append only: each entry runs once per database, in order, in its own transaction
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection, MetaData], None]]] = [
+    (1, "initial schema", _initial_schema),
+    (2, "images.sha256 for the blob store", _image_blob_hash),
+    (3, "nodes.created_at for keyset pagination", _node_created_at),
+    (4, "indexes on foreign keys", _foreign_key_indexes),
+    (5, "dataset registry", _dataset_registry),
+    (6, "datasets.profile", _dataset_profile),
+    (7, "thread transcript mirror", _thread_messages),
+    (8, "background job queue", _jobs),
+    (9, "questions.answer_node_id", _question_answers),
+    (10, "nodes.source_url and nodes.l2_query for incremental L2 expansion", _l2_sources),
+    (11, "hubs.version for conditional GETs", _hub_version),
+    (12, "reduced dataset provenance", _dataset_reduction),
+    (13, "nodes.seq for commit-ordered pagination", _node_seq),
+    (14, "nodes.thread_shared for imported nodes", _node_thread_shared),
+]
+
+
+def migrate(engine: Engine, metadata: MetaData) -> int:
+    """Apply every migration the database has not seen yet and return the resulting version."""
+    _version_metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        current = conn.execute(select(schema_version.c.version).order_by(schema_version.c.version.desc())).scalar() or 0
+
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        with engine.begin() as conn:
+            apply(conn, metadata)
+            conn.execute(schema_version.insert().values(version=version, description=description))
+        print(f"Applied migration {version}: {description}")
+        current = version
+
+    return current
@@ -0,0 +1,108 @@
+import base64
+import uuid
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import update
+
+from database import Hub, Image, Node, Question, session_scope
+from timings import stage_timings
+
+
+def new_id() -> str:
+    """Client-side primary key, so rows never need a refresh round-trip to learn their id."""
+    return str(uuid.uuid4())
+
+
+def build_node(prompt: str, text: str, title: str, thread_id: str, hub_id: str,
+               parent_node_id: Optional[str] = None, image_hashes: Iterable[str] = (),
+               questions: Iterable[str] = (), node_id: Optional[str] = None,
+               source_url: Optional[str] = None) -> Node:
+    """
+    Build a node graph (node + images + questions) in memory, with every id and image URL
+    already assigned. Nothing touches the database until `save_nodes`.
+    A fixed `node_id` makes the write idempotent for job steps that may run twice.
+    """
+    images = []
+    for digest in image_hashes:
+        image = Image(id=new_id(), sha256=digest)
+        image.generate_url()
+        images.append(image)
+
+    # Collections are set explicitly so they stay readable after the session closes
+    node = Node(
+        id=node_id or new_id(),
+        prompt=prompt,
+        text=text,
+        title=title,
+        thread_id=thread_id,
+        hub_id=hub_id,
+        parent_node_id=parent_node_id,
+        source_url=source_url,
+        images=images,
+        questions=[Question(id=new_id(), content=content) for content in questions],
+    )
+
+    return node
+
+
+def save_nodes(nodes: List[Node]) -> List[Node]:
+    """
+    Write one or more node graphs in a single transaction (one commit, one fsync).
+    Passing several nodes at once lets SQLAlchemy batch the INSERTs per table.
+    """
+    with stage_timings.timed("db", "commit_nodes"), session_scope() as db:
+        hub_ids = {node.hub_id for node in nodes}
+        bump_hub_versions(db, hub_ids)
+        # The bump locks the hub rows until this transaction commits, so another writer to the same hubs
+        # gets a later version and becomes visible after these nodes: the versions order the nodes as
+        # readers see them appear, which a clock read before the commit does not (see encode_cursor)
+        versions = dict(db.query(Hub.id, Hub.version).filter(Hub.id.in_(list(hub_ids))))
+        created_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        for node in nodes:
+            node.created_at = created_at
+            node.seq = versions.get(node.hub_id)
+        db.add_all(nodes)
+    return nodes
+
+
+def bump_hub_versions(db, hub_ids: Iterable[str]):
+    """Mark the hubs' node lists as changed, in the caller's transaction (invalidates their ETags)."""
+    db.execute(update(Hub).where(Hub.id.in_(list(hub_ids))).values(version=Hub.version + 1))
+
+
+def link_answer(question_id: str, node_id: str) -> str:
+    """
+    Record `node_id` as the answer to the question unless it already has one, and return the
+    node that answers it. The first answer saved wins, so a question always resolves to one node.
+    """
+    with session_scope() as db:
+        linked = db.execute(
+            update(Question)
+            .where(Question.id == question_id, Question.answer_node_id.is_(None))
+            .values(answer_node_id=node_id)
+        ).rowcount
+        if linked:
+            # The question's answer_node_id is part of its node's payload
+            hub_id = db.query(Node.hub_id).join(Question, Question.node_id == Node.id).filter(
+                Question.id == question_id).scalar()
+            bump_hub_versions(db, [hub_id])
+        return db.query(Question.answer_node_id).filter(Question.id == question_id).scalar()
+
+
+def encode_cursor(node: Node) -> str:
+    """
+    Opaque pagination cursor pointing just after `node`, by its `seq` (see save_nodes): a node
+    committed after the cursor was handed out always sorts after it, so polling never skips one.
+    """
+    raw = f"{node.seq}|{node.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    """Inverse of `encode_cursor`; raises ValueError for malformed cursors."""
+    try:
+        seq, node_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return int(seq), node_id
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
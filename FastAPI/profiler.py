@@ -0,0 +1,143 @@
+"""
+Opt-in sampling profiler for a single session start.
+
+A background thread samples the Python stacks of every thread at a fixed interval and folds them
+into "frame;frame;frame count" lines, the input format of flamegraph.pl and speedscope. A plain
+SVG flame graph is written next to the folded stacks so no extra tooling is needed to look at it.
+
+Everything on the event loop is sampled, including other requests served at the same time,
+which is what hot spots under production load look like.
+"""
+import html
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() == "true"  # allow arming the profiler over HTTP
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))  # seconds between samples
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 300))  # stop sampling after this long regardless
+
+# Leaf frames of threads parked waiting for work (idle pool threads would otherwise dominate the graph)
+IDLE_LEAVES = {("threading.py", "wait"), ("thread.py", "_worker"), ("queue.py", "get")}
+
+SVG_WIDTH = 1600
+SVG_ROW_HEIGHT = 16
+SVG_MIN_WIDTH = 0.5  # frames narrower than this (in pixels) are not drawn
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample_loop, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + PROFILE_MAX_SECONDS
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def svg(self, title: str) -> str:
+        """An icicle-style flame graph (callers on top), one rectangle per frame, widths by sample count."""
+        tree: Dict = {"count": 0, "children": {}}
+        for stack, count in self.stacks.items():
+            node = tree
+            node["count"] += count
+            for frame in stack.split(";"):
+                node = node["children"].setdefault(frame, {"count": 0, "children": {}})
+                node["count"] += count
+
+        rects: List[str] = []
+        total = max(tree["count"], 1)
+
+        def draw(node, x: float, depth: int):
+            for name, child in sorted(node["children"].items()):
+                width = child["count"] / total * SVG_WIDTH
+                if width >= SVG_MIN_WIDTH:
+                    y = (depth + 1) * SVG_ROW_HEIGHT
+                    label = html.escape(name)
+                    share = child["count"] / total
+                    hue = 20 + hash(name.split(" ")[0]) % 40
+                    rects.append(
+                        f'<g><title>{label} ({child["count"]} samples, {share:.1%})</title>'
+                        f'<rect x="{x:.1f}" y="{y}" width="{width:.1f}" height="{SVG_ROW_HEIGHT - 1}" '
+                        f'fill="hsl({hue},90%,60%)"/>'
+                        + (f'<text x="{x + 2:.1f}" y="{y + SVG_ROW_HEIGHT - 4}" font-size="11">'
+                           f'{label[:int(width / 7)]}</text>' if width > 30 else "")
+                        + "</g>"
+                    )
+                    draw(child, x, depth + 1)
+                x += width
+
+        draw(tree, 0.0, 0)
+        depth = max((stack.count(";") + 1 for stack in self.stacks), default=0)
+        height = (depth + 2) * SVG_ROW_HEIGHT
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" height="{height}" font-family="monospace">'
+            f'<text x="4" y="12" font-size="12">{html.escape(title)} ({self.samples} samples every '
+            f'{self.interval * 1000:g} ms)</text>' + "".join(rects) + "</svg>\n"
+        )
+
+    def dump(self, name: str) -> str:
+        """Write `<name>.folded` and `<name>.svg` to PROFILE_DIR and return the path without extension."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, name)
+        with open(path + ".folded", "w") as f:
+            f.write(self.folded())
+        with open(path + ".svg", "w") as f:
+            f.write(self.svg(name))
+        return path
+
+
+class SessionProfiles:
+    """Arm once, and the next /session/start is profiled until its hub's L1 build is done."""
+
+    def __init__(self):
+        self._armed = False
+        self.last_path: Optional[str] = None
+
+    def arm(self):
+        self._armed = True
+
+    def take(self) -> Optional[SamplingProfiler]:
+        """A running profiler if the profiler was armed (disarming it), None otherwise."""
+        if not self._armed:
+            return None
+        self._armed = False
+        profiler = SamplingProfiler()
+        profiler.start()
+        return profiler
+
+
+session_profiles = SessionProfiles()
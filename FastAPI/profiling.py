@@ -0,0 +1,231 @@
+import os
+import warnings
+from collections import Counter
+from itertools import combinations
+from typing import BinaryIO, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+PROFILE_CHUNK_ROWS = 100_000  # rows read at a time, so memory stays flat for large files
+MAX_NUMERIC_COLUMNS = 50  # numeric columns in the correlation matrix
+MAX_TRACKED_VALUES = 1000  # distinct values counted per categorical column
+MAX_CROSSTAB_CATEGORIES = 20  # only columns with at most this many values are cross-tabulated
+MAX_CROSSTAB_COLUMNS = 10  # categorical columns considered for crosstabs (all pairs are tabulated)
+TOP_VALUES = 5
+TOP_CORRELATIONS = 10
+TOP_CROSSTABS = 3
+DATETIME_MIN_PARSED = 0.9  # share of values that must parse for a text column to count as dates
+PROFILE_MAX_CHARS = 4000  # budget for the profile in a prompt
+
+CSV_SEPARATORS = {".csv": ",", ".tsv": "\t", ".txt": None}
+
+
+def profile_dataset(file: BinaryIO, file_name: str) -> Optional[dict]:
+    """
+    Column types, summary statistics, missingness, the correlation matrix of the numeric columns
+    and the strongest crosstabs of the categorical ones, computed locally in one chunked pass.
+    Returns None for files that are not delimited text. The file is rewound afterwards.
+    """
+    extension = os.path.splitext(file_name or "")[1].lower()
+    if extension not in CSV_SEPARATORS:
+        return None
+
+    file.seek(0)
+    try:
+        reader = pd.read_csv(file, sep=CSV_SEPARATORS[extension], chunksize=PROFILE_CHUNK_ROWS,
+                             engine="python" if CSV_SEPARATORS[extension] is None else "c")
+        profiler = None
+        for chunk in reader:
+            if profiler is None:
+                profiler = _Profiler(chunk)
+            profiler.add(chunk)
+    except (ValueError, UnicodeDecodeError, pd.errors.ParserError) as e:
+        print(f"Could not profile {file_name}: {e}")
+        return None
+    finally:
+        file.seek(0)
+
+    return profiler.result() if profiler else None
+
+
+class _Profiler:
+    """Accumulates the profile chunk by chunk; column types are decided on the first chunk."""
+
+    def __init__(self, first_chunk: pd.DataFrame):
+        self.rows = 0
+        self.columns = [str(column) for column in first_chunk.columns]
+        self.missing = Counter()
+
+        self.numeric = [c for c in self.columns if pd.api.types.is_numeric_dtype(first_chunk[c])
+                        and not pd.api.types.is_bool_dtype(first_chunk[c])][:MAX_NUMERIC_COLUMNS]
+        self.datetime = [c for c in self.columns if c not in self.numeric and _looks_like_dates(first_chunk[c])]
+        self.categorical = [c for c in self.columns if c not in self.numeric and c not in self.datetime]
+
+        k = len(self.numeric)
+        self.n = np.zeros((k, k))  # rows where both columns are present
+        self.sx = np.zeros((k, k))  # sum of column i over those rows
+        self.sxx = np.zeros((k, k))  # sum of squares of column i over those rows
+        self.sxy = np.zeros((k, k))
+        self.minimum = np.full(k, np.inf)
+        self.maximum = np.full(k, -np.inf)
+
+        self.values: Dict[str, Counter] = {c: Counter() for c in self.categorical}
+        self.truncated = set()
+        self.date_range: Dict[str, List] = {}
+
+        crosstab_columns = [c for c in self.categorical
+                            if first_chunk[c].nunique() <= MAX_CROSSTAB_CATEGORIES][:MAX_CROSSTAB_COLUMNS]
+        self.crosstabs: Dict[tuple, pd.DataFrame] = {pair: None for pair in combinations(crosstab_columns, 2)}
+
+    def add(self, chunk: pd.DataFrame):
+        chunk.columns = [str(column) for column in chunk.columns]
+        self.rows += len(chunk)
+        self.missing.update(chunk.isna().sum().to_dict())
+
+        if self.numeric:
+            values = chunk[self.numeric].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+            present = ~np.isnan(values)
+            mask = present.astype(float)
+            filled = np.where(present, values, 0.0)
+            # Pairwise-complete sums for every pair of columns at once
+            self.n += mask.T @ mask
+            self.sx += filled.T @ mask
+            self.sxx += (filled ** 2).T @ mask
+            self.sxy += filled.T @ filled
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                self.minimum = np.fmin(self.minimum, np.nanmin(values, axis=0, initial=np.inf))
+                self.maximum = np.fmax(self.maximum, np.nanmax(values, axis=0, initial=-np.inf))
+
+        for column in self.categorical:
+            counts = self.values[column]
+            counts.update(chunk[column].dropna().astype(str).value_counts().to_dict())
+            if len(counts) > MAX_TRACKED_VALUES:
+                self.values[column] = Counter(dict(counts.most_common(MAX_TRACKED_VALUES)))
+                self.truncated.add(column)
+
+        for column in self.datetime:
+            dates = _parse_dates(chunk[column]).dropna()
+            if len(dates):
+                low, high = self.date_range.get(column, (dates.min(), dates.max()))
+                self.date_range[column] = [min(low, dates.min()), max(high, dates.max())]
+
+        for (a, b), table in self.crosstabs.items():
+            pair = chunk[[a, b]].dropna().astype(str)
+            counts = pd.crosstab(pair[a], pair[b])
+            self.crosstabs[(a, b)] = counts if table is None else table.add(counts, fill_value=0)
+
+    def result(self) -> dict:
+        columns = []
+        numeric_index = {c: i for i, c in enumerate(self.numeric)}
+        for column in self.columns:
+            info = {"name": column, "missing": round(self.missing[column] / self.rows, 4) if self.rows else 0.0}
+            if column in numeric_index:
+                i = numeric_index[column]
+                count = self.n[i, i]
+                mean = self.sx[i, i] / count if count else None
+                variance = self.sxx[i, i] / count - mean ** 2 if count else None
+                info.update(type="numeric", mean=_round(mean), std=_round(np.sqrt(max(variance, 0)) if count else None),
+                            min=_round(self.minimum[i]), max=_round(self.maximum[i]))
+            elif column in self.date_range or column in self.datetime:
+                low, high = self.date_range.get(column, (None, None))
+                info.update(type="datetime", min=str(low) if low is not None else None,
+                            max=str(high) if high is not None else None)
+            else:
+                counts = self.values.get(column, Counter())
+                total = sum(counts.values())
+                info.update(
+                    type="categorical",
+                    distinct=f"{len(counts)}+" if column in self.truncated else len(counts),
+                    top=[[value, round(count / total, 4)] for value, count in counts.most_common(TOP_VALUES)],
+                )
+            columns.append(info)
+
+        return {
+            "rows": self.rows,
+            "columns": columns,
+            "correlation_matrix": {"columns": self.numeric, "values": self._correlations().round(4).tolist()},
+            "crosstabs": self._top_crosstabs(),
+        }
+
+    def _correlations(self) -> np.ndarray:
+        n, sx, sxx, sxy = self.n, self.sx, self.sxx, self.sxy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            covariance = n * sxy - sx * sx.T
+            spread = np.sqrt((n * sxx - sx ** 2) * (n * sxx.T - sx.T ** 2))
+            correlations = covariance / spread
+        return np.nan_to_num(correlations, nan=0.0)
+
+    def _top_crosstabs(self) -> List[dict]:
+        scored = []
+        for (a, b), table in self.crosstabs.items():
+            # Columns that turned out to have many values overall are not worth a table
+            if table is None or table.shape[0] > MAX_CROSSTAB_CATEGORIES or table.shape[1] > MAX_CROSSTAB_CATEGORIES:
+                continue
+            scored.append((_cramers_v(table.to_numpy()), a, b, table))
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [
+            {"a": a, "b": b, "cramers_v": round(v, 4), "table": table.astype(int).to_dict(orient="index")}
+            for v, a, b, table in scored[:TOP_CROSSTABS]
+        ]
+
+
+def _looks_like_dates(series: pd.Series) -> bool:
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return False
+    sample = series.dropna().head(200)
+    return len(sample) > 0 and _parse_dates(sample).notna().mean() >= DATETIME_MIN_PARSED
+
+
+def _parse_dates(series: pd.Series) -> pd.Series:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return pd.to_datetime(series, errors="coerce", format="mixed")
+
+
+def _cramers_v(table: np.ndarray) -> float:
+    total = table.sum()
+    if total == 0 or min(table.shape) < 2:
+        return 0.0
+    expected = np.outer(table.sum(axis=1), table.sum(axis=0)) / total
+    with np.errstate(divide="ignore", invalid="ignore"):
+        chi2 = np.nansum((table - expected) ** 2 / expected)
+    return float(np.sqrt(chi2 / (total * (min(table.shape) - 1))))
+
+
+def _round(value) -> Optional[float]:
+    if value is None or not np.isfinite(value):
+        return None
+    return float(round(value, 4))
+
+
+def format_profile(profile: dict) -> str:
+    """Compact text version of a profile for prompts, cut to PROFILE_MAX_CHARS."""
+    lines = [f"Rows: {profile['rows']}", "Columns:"]
+    for column in profile["columns"]:
+        missing = f"missing {column['missing']:.1%}"
+        if column["type"] == "numeric":
+            lines.append(f"- {column['name']} (numeric): mean {column['mean']}, std {column['std']}, "
+                         f"min {column['min']}, max {column['max']}, {missing}")
+        elif column["type"] == "datetime":
+            lines.append(f"- {column['name']} (datetime): {column['min']} to {column['max']}, {missing}")
+        else:
+            top = ", ".join(f"{value} ({share:.0%})" for value, share in column["top"])
+            lines.append(f"- {column['name']} (categorical, {column['distinct']} values): top {top}, {missing}")
+
+    matrix = profile["correlation_matrix"]
+    names, values = matrix["columns"], matrix["values"]
+    pairs = sorted(((values[i][j], names[i], names[j]) for i, j in combinations(range(len(names)), 2)),
+                   key=lambda pair: abs(pair[0]), reverse=True)[:TOP_CORRELATIONS]
+    if pairs:
+        lines.append("Strongest correlations (Pearson): " + ", ".join(f"{a} ~ {b} r={r:.2f}" for r, a, b in pairs))
+
+    for crosstab in profile["crosstabs"]:
+        lines.append(f"Crosstab {crosstab['a']} x {crosstab['b']} (Cramer's V {crosstab['cramers_v']:.2f}): "
+                     + "; ".join(f"{row}: " + ", ".join(f"{col}={count}" for col, count in cells.items())
+                                 for row, cells in crosstab["table"].items()))
+
+    text = "\n".join(lines)
+    return text if len(text) <= PROFILE_MAX_CHARS else text[:PROFILE_MAX_CHARS] + "\n..."
@@ -0,0 +1,250 @@
+"""
+Optional reduction of large uploads before they reach the code interpreter.
+
+Every L1 run loads the uploaded file with pandas, so a multi-GB CSV is slow (or impossible) to
+analyse however fast our side is. Files above DATASET_REDUCE_ABOVE_BYTES are read once in
+chunks and replaced by a sample of DATASET_TARGET_ROWS rows, with empty, constant and ID-like
+columns pruned, written as Parquet with typed columns (DATASET_REDUCED_FORMAT=csv writes plain
+delimited text instead). What was done is returned as provenance, recorded on the dataset and the
+hub, and told to the assistant.
+"""
+import os
+import tempfile
+from collections import Counter
+from typing import BinaryIO, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from blobstore import BLOB_DIR, blob_path, put_file
+from consts import (DATASET_MAX_STRATA, DATASET_REDUCE_ABOVE_BYTES, DATASET_REDUCED_FORMAT, DATASET_REDUCTION,
+                    DATASET_SAMPLE_SEED, DATASET_STRATIFY_COLUMN, DATASET_STRATUM_MIN_ROWS, DATASET_TARGET_ROWS)
+from profiling import CSV_SEPARATORS, PROFILE_CHUNK_ROWS
+
+try:
+    import pyarrow  # noqa: F401 (pandas writes Parquet through it)
+except ImportError:  # Parquet cannot be written, see _output_format
+    pyarrow = None
+
+METHODS = ("reservoir", "stratified")
+FORMATS = ("parquet", "csv")
+ID_MIN_ROWS = 1000  # a column is only called ID-like when it is unique over at least this many sampled rows
+CATEGORY_MAX_SHARE = 0.5  # text columns with fewer distinct values than this share of rows are stored as categories
+_KEY = "__sample_key__"  # random key of each row while sampling
+# The interpreter may not see the file's name, so the format is spelled out in prompts
+_FORMAT_NOTES = {"parquet": " It is a Parquet file with typed columns: read it with pandas.read_parquet."}
+
+
+def reduce_dataset(file: BinaryIO, file_name: str, digest: str, profile: Optional[dict]) -> Optional[Tuple[str, dict]]:
+    """
+    Sample and prune a large delimited file into the blob store.
+    Returns (artifact digest, provenance), or None when the file is to be uploaded as it is:
+    reduction is off, the file is small or not delimited text, or it could not be parsed.
+    `profile` is the file's profile (see profiling.py), whose full-data statistics decide which
+    columns are empty or constant. The file is rewound afterwards.
+    """
+    if DATASET_REDUCTION not in METHODS:
+        return None
+    stem, extension = os.path.splitext(file_name or "")
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    if extension.lower() not in CSV_SEPARATORS or size <= DATASET_REDUCE_ABOVE_BYTES:
+        return None
+
+    output_format = _output_format()
+    separator = CSV_SEPARATORS[extension.lower()]
+    stratify = _stratify_column(profile) if DATASET_REDUCTION == "stratified" else None
+    sampler = _Sampler(DATASET_TARGET_ROWS, stratify)
+    try:
+        reader = pd.read_csv(file, sep=separator, chunksize=PROFILE_CHUNK_ROWS,
+                             engine="python" if separator is None else "c")
+        for chunk in reader:
+            sampler.add(chunk)
+    except (ValueError, UnicodeDecodeError, pd.errors.ParserError) as e:
+        print(f"Could not reduce {file_name}: {e}")
+        return None
+    finally:
+        file.seek(0)
+    if sampler.kept is None:
+        return None
+
+    sample = sampler.result()
+    dropped = _columns_to_drop(sample, profile, keep=sampler.stratify)
+    sample = _typed(sample.drop(columns=list(dropped)), profile)
+
+    # The extension tells the interpreter how to read the file
+    artifact_name = f"{stem}.parquet" if output_format == "parquet" else f"{stem}.sample{extension}"
+    artifact = _write(sample, output_format, separator or ",")
+    provenance = {
+        "method": "stratified" if sampler.stratify else "reservoir",
+        "file_name": artifact_name,
+        "sha256": artifact,
+        "bytes": os.path.getsize(blob_path(artifact)),
+        "format": output_format,
+        "rows": len(sample),
+        "columns": [str(column) for column in sample.columns],
+        "dropped": dropped,
+        "seed": DATASET_SAMPLE_SEED,
+        "source": {"file_name": file_name, "sha256": digest, "bytes": size, "rows": sampler.rows},
+    }
+    if sampler.stratify:
+        kept = sample[sampler.stratify].astype(str).value_counts(dropna=False)
+        provenance["stratify"] = sampler.stratify
+        provenance["strata"] = {value: [rows, int(kept.get(value, 0))] for value, rows in sampler.strata.items()}
+    elif stratify:
+        provenance["stratify_fallback"] = f"{stratify} has more than {DATASET_MAX_STRATA} values"
+    return artifact, provenance
+
+
+def format_reduction(provenance: dict) -> str:
+    """One or two sentences on how the attached file was derived from the upload, for prompts."""
+    source = provenance["source"]
+    text = f"{provenance['rows']} of {source['rows']} rows"
+    if provenance.get("stratify"):
+        text += (f", sampled per value of {provenance['stratify']} (rare values are over-represented; "
+                 f"weight by the file/sample row counts {provenance['strata']} for totals)")
+    else:
+        text += ", sampled uniformly at random"
+    if provenance["dropped"]:
+        text += "; columns removed: " + ", ".join(f"{column} ({reason})" for column, reason in provenance["dropped"].items())
+    return text + "." + _FORMAT_NOTES.get(provenance.get("format"), "")
+
+
+def _output_format() -> str:
+    if DATASET_REDUCED_FORMAT not in FORMATS:
+        raise ValueError(f"DATASET_REDUCED_FORMAT must be one of {', '.join(FORMATS)}, not {DATASET_REDUCED_FORMAT!r}")
+    if DATASET_REDUCED_FORMAT == "parquet" and pyarrow is None:
+        # A broken install (pyarrow is in requirements.txt): say so rather than silently losing the types
+        print("pyarrow is not installed, writing the reduced dataset as untyped CSV (set DATASET_REDUCED_FORMAT=csv "
+              "to choose this explicitly)")
+        return "csv"
+    return DATASET_REDUCED_FORMAT
+
+
+def _stratify_column(profile: Optional[dict]) -> Optional[str]:
+    if DATASET_STRATIFY_COLUMN or not profile:
+        return DATASET_STRATIFY_COLUMN or None
+    candidates = [
+        (column["distinct"], column["name"]) for column in profile["columns"]
+        if column["type"] == "categorical" and isinstance(column["distinct"], int)
+        and 2 <= column["distinct"] <= DATASET_MAX_STRATA
+    ]
+    return min(candidates)[1] if candidates else None
+
+
+class _Sampler:
+    """
+    Bottom-k sampling: every row gets a random key and the `target` rows with the smallest keys
+    are kept, which is a uniform sample whatever the chunking. Stratified, each value of the
+    `stratify` column also keeps its own DATASET_STRATUM_MIN_ROWS smallest keys, so rare values
+    survive. Memory stays at about `target` rows plus one chunk.
+    """
+
+    def __init__(self, target: int, stratify: Optional[str]):
+        self.target = target
+        self.stratify = stratify
+        self.rng = np.random.default_rng(DATASET_SAMPLE_SEED)
+        self.rows = 0
+        self.strata: Counter = Counter()
+        self.kept: Optional[pd.DataFrame] = None
+
+    def add(self, chunk: pd.DataFrame):
+        chunk.columns = [str(column) for column in chunk.columns]
+        # Index by row number in the file, so the sample can be put back in file order
+        chunk.index = pd.RangeIndex(self.rows, self.rows + len(chunk))
+        chunk[_KEY] = self.rng.random(len(chunk))
+        self.rows += len(chunk)
+
+        if self.stratify:
+            if self.stratify not in chunk.columns:
+                self.stratify = None
+            else:
+                self.strata.update(chunk[self.stratify].astype(str).value_counts(dropna=False).to_dict())
+                if len(self.strata) > DATASET_MAX_STRATA:
+                    self.stratify, self.strata = None, Counter()
+
+        candidates = chunk if self.kept is None else pd.concat([self.kept, chunk])
+        kept = candidates.nsmallest(self.target, _KEY)
+        if self.stratify:
+            rare = (candidates.sort_values(_KEY)
+                    .groupby(candidates[self.stratify].astype(str), sort=False)
+                    .head(DATASET_STRATUM_MIN_ROWS))
+            kept = candidates.loc[kept.index.union(rare.index)]
+        self.kept = kept
+
+    def result(self) -> pd.DataFrame:
+        return self.kept.sort_index().drop(columns=_KEY).reset_index(drop=True)
+
+
+def _columns_to_drop(sample: pd.DataFrame, profile: Optional[dict], keep: Optional[str]) -> Dict[str, str]:
+    """
+    {column: reason} for columns without analytical value. Emptiness and constancy come from the
+    full-data profile when there is one; ID-likeness (every sampled value distinct) from the sample.
+    """
+    profiled = {column["name"]: column for column in (profile or {}).get("columns", [])}
+    dropped = {}
+    for column in sample.columns:
+        if column == keep:
+            continue
+        values = sample[column]
+        info = profiled.get(column)
+        if info is not None:
+            empty = info["missing"] >= 1.0
+            constant = (info.get("min") is not None and info.get("min") == info.get("max")
+                        or info["type"] == "categorical" and info["distinct"] == 1 and info["missing"] == 0)
+        else:
+            empty = values.isna().all()
+            constant = values.nunique(dropna=False) <= 1
+        present = values.dropna()
+        id_like = (
+            len(present) >= ID_MIN_ROWS and not pd.api.types.is_float_dtype(values)
+            and (info is None or info["type"] != "datetime")
+            and present.nunique() == len(present)
+        )
+        if empty:
+            dropped[column] = "empty"
+        elif constant:
+            dropped[column] = "constant"
+        elif id_like:
+            dropped[column] = "ID-like"
+    # Never prune everything
+    return dropped if len(dropped) < len(sample.columns) else {}
+
+
+def _typed(sample: pd.DataFrame, profile: Optional[dict]) -> pd.DataFrame:
+    """Give every column a concrete type (chunks may have been parsed differently), as small as it safely fits."""
+    types = {column["name"]: column["type"] for column in (profile or {}).get("columns", [])}
+    for column in sample.columns:
+        values = sample[column]
+        kind = types.get(column)
+        if kind == "numeric" or (kind is None and pd.api.types.is_numeric_dtype(values)):
+            if pd.api.types.is_bool_dtype(values):
+                continue
+            values = pd.to_numeric(values, errors="coerce")
+            if values.notna().all() and (values % 1 == 0).all():
+                values = pd.to_numeric(values.astype("int64"), downcast="integer")
+        elif kind == "datetime":
+            values = pd.to_datetime(values, errors="coerce", format="mixed")
+        elif values.nunique() <= CATEGORY_MAX_SHARE * len(values):
+            values = values.astype(str).where(values.notna()).astype("category")
+        else:
+            values = values.astype("string")
+        sample[column] = values
+    return sample
+
+
+def _write(sample: pd.DataFrame, output_format: str, separator: str) -> str:
+    """Write the sample next to the blob store (so it can be moved in) and return its digest."""
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=BLOB_DIR, prefix=".tmp-")
+    os.close(fd)
+    try:
+        if output_format == "parquet":
+            sample.to_parquet(path, index=False)
+        else:
+            sample.to_csv(path, index=False, sep=separator)
+        return put_file(path)
+    except BaseException:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple
+
+from consts import MAX_CONCURRENT_RUNS, MAX_RUNS_PER_HUB
+from metrics import registry
+
+
+class IOScheduler:
+    """
+    Process-wide scheduler for network-bound node builders.
+
+    Work is run as asyncio tasks on the server's event loop, bounded by a global
+    limit and a per-hub limit, so a burst of new sessions queues up instead of
+    flooding the OpenAI API (or the box) with concurrent runs.
+    """
+
+    def __init__(self, max_concurrency: int, max_per_hub: int):
+        self.max_concurrency = max_concurrency
+        self.max_per_hub = max_per_hub
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._hubs: Dict[str, asyncio.Semaphore] = {}
+        self._hub_refs: Dict[str, int] = {}
+        self.waiting = 0  # jobs submitted but not yet started
+        self.running = 0  # jobs currently holding a slot
+
+    def _hub_semaphore(self, hub_id: str) -> asyncio.Semaphore:
+        if hub_id not in self._hubs:
+            self._hubs[hub_id] = asyncio.Semaphore(self.max_per_hub)
+            self._hub_refs[hub_id] = 0
+        self._hub_refs[hub_id] += 1
+        return self._hubs[hub_id]
+
+    def _release_hub(self, hub_id: str):
+        # Drop the per-hub semaphore once nothing references it anymore
+        self._hub_refs[hub_id] -= 1
+        if self._hub_refs[hub_id] == 0:
+            del self._hubs[hub_id]
+            del self._hub_refs[hub_id]
+
+    async def run(self, hub_id: str, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Wait for a free slot for `hub_id`, then await `func(*args, **kwargs)`."""
+        hub_semaphore = self._hub_semaphore(hub_id)
+        self.waiting += 1
+        started = False
+        try:
+            async with hub_semaphore, self._global:
+                self.waiting -= 1
+                started = True
+                self.running += 1
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.running -= 1
+        finally:
+            if not started:
+                self.waiting -= 1
+            self._release_hub(hub_id)
+
+    def submit(self, hub_id: str, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> asyncio.Task:
+        """Schedule `func` as a background task and return the task handle."""
+        return asyncio.create_task(self.run(hub_id, func, *args, **kwargs))
+
+    async def starmap(self, hub_id: str, func: Callable[..., Awaitable[Any]], args_list: Iterable[Tuple]) -> List[Any]:
+        """Async counterpart of `Pool.starmap`: run `func` for every argument tuple and return the results in order."""
+        tasks = [self.submit(hub_id, func, *args) for args in args_list]
+        return list(await asyncio.gather(*tasks))
+
+
+scheduler = IOScheduler(MAX_CONCURRENT_RUNS, MAX_RUNS_PER_HUB)
+registry.collect("scheduler_jobs", "Node builders in the shared scheduler, waiting for a slot or running.",
+                 lambda: {("waiting",): scheduler.waiting, ("running",): scheduler.running}, ("state",))
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from consts import SEARCH_CACHE_ENABLED, SEARCH_CACHE_PATH, SEARCH_QUERY_TTL, SEARCH_SUMMARY_TTL
+from metrics import registry
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    key TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    results TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS summaries (
+    url TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+
+def normalize_query(query: str) -> str:
+    """
+    Lower-case words without punctuation, single-spaced: generated queries that only differ in
+    casing, quoting or spacing map to the same entry. Word order is kept, since it carries meaning
+    ("A vs B", where a negation applies).
+    """
+    return " ".join(re.findall(r"\w+", query.lower()))
+
+
+class SearchCache:
+    """
+    Persistent two-level cache for Exa searches.
+
+    Queries (normalized, see normalize_query) map to the titles and URLs they returned, for
+    SEARCH_QUERY_TTL seconds. Summaries are kept per URL for SEARCH_SUMMARY_TTL seconds, so a
+    new query whose results overlap an earlier one only has the new URLs summarized.
+    """
+
+    def __init__(self, path: str, query_ttl: float, summary_ttl: float, enabled: bool = True):
+        self.path = path
+        self.query_ttl = query_ttl
+        self.summary_ttl = summary_ttl
+        self.enabled = enabled
+        self.query_hits = 0
+        self.query_misses = 0
+        self.summary_hits = 0
+        self.summary_misses = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    @staticmethod
+    def _key(query: str, num_results: int) -> str:
+        return hashlib.sha256(f"{num_results}\0{normalize_query(query)}".encode()).hexdigest()
+
+    def get_results(self, query: str, num_results: int) -> Optional[List[dict]]:
+        """Cached [{"title", "url"}] for the query, or None if absent or expired."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._db().execute(
+                "SELECT results FROM queries WHERE key = ? AND fetched_at > ?",
+                (self._key(query, num_results), time.time() - self.query_ttl),
+            ).fetchone()
+        if row is None:
+            self.query_misses += 1
+            return None
+        self.query_hits += 1
+        return json.loads(row[0])
+
+    def put_results(self, query: str, num_results: int, results: List[dict]):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO queries (key, query, results, fetched_at) VALUES (?, ?, ?, ?)",
+                (self._key(query, num_results), query, json.dumps(results), time.time()),
+            )
+
+    def get_summaries(self, urls: List[str]) -> Dict[str, str]:
+        """Unexpired summaries for whichever of the URLs have one."""
+        if not self.enabled or not urls:
+            return {}
+        with self._lock:
+            rows = self._db().execute(
+                f"SELECT url, summary FROM summaries WHERE url IN ({','.join('?' * len(urls))}) AND fetched_at > ?",
+                (*urls, time.time() - self.summary_ttl),
+            ).fetchall()
+        summaries = dict(rows)
+        self.summary_hits += len(summaries)
+        self.summary_misses += len(set(urls) - summaries.keys())
+        return summaries
+
+    def put_summaries(self, summaries: Dict[str, str]):
+        if not self.enabled or not summaries:
+            return
+        now = time.time()
+        with self._lock:
+            self._db().executemany(
+                "INSERT OR REPLACE INTO summaries (url, summary, fetched_at) VALUES (?, ?, ?)",
+                [(url, summary, now) for url, summary in summaries.items()],
+            )
+
+    def stats(self) -> dict:
+        queries, summaries = 0, 0
+        if self.enabled:
+            with self._lock:
+                db = self._db()
+                queries = db.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+                summaries = db.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+
+        def rate(hits, misses):
+            return round(hits / (hits + misses), 4) if hits + misses else None
+
+        return {
+            "enabled": self.enabled,
+            "query_hits": self.query_hits,
+            "query_misses": self.query_misses,
+            "query_hit_rate": rate(self.query_hits, self.query_misses),
+            "summary_hits": self.summary_hits,
+            "summary_misses": self.summary_misses,
+            "summary_hit_rate": rate(self.summary_hits, self.summary_misses),
+            "queries": queries,
+            "summaries": summaries,
+        }
+
+
+search_cache = SearchCache(SEARCH_CACHE_PATH, SEARCH_QUERY_TTL, SEARCH_SUMMARY_TTL, SEARCH_CACHE_ENABLED)
+registry.collect("search_cache_lookups_total", "Exa cache lookups by level and result.",
+                 lambda: {("query", "hit"): search_cache.query_hits, ("query", "miss"): search_cache.query_misses,
+                          ("summary", "hit"): search_cache.summary_hits,
+                          ("summary", "miss"): search_cache.summary_misses},
+                 ("level", "result"), kind="counter")
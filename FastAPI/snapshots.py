@@ -0,0 +1,177 @@
+"""
+Whole-session snapshots: a session's hubs, nodes, questions and image references in one document,
+and the import that restores such a document as a new session.
+
+The document is the SessionResponse shape (session -> hubs -> nodes) plus what is needed to
+restore it faithfully: creation times, L2 sources, the hub's dataset and reduction, and the
+images' blob keys.
+With `images=True` the charts' bytes are embedded too, so the snapshot can be imported on a
+server whose blob store does not have them. Legacy charts stored inline in the database have no
+blob to refer to, so their bytes are always embedded.
+"""
+import base64
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import selectinload
+
+from blobstore import blob_path, put_blob
+from database import Dataset, Hub, Image, Node, Question, Session, session_scope
+from encoding import node_payload
+from persistence import new_id
+
+SNAPSHOT_FORMAT = 1
+
+
+def load_session(session_id: str) -> Optional[Session]:
+    """The session with its whole tree, eager-loaded (one SELECT per level, no per-node loads)."""
+    with session_scope() as db:
+        return (
+            db.query(Session)
+            .options(
+                selectinload(Session.hubs).selectinload(Hub.nodes).selectinload(Node.images),
+                selectinload(Session.hubs).selectinload(Hub.nodes).selectinload(Node.questions),
+            )
+            .filter(Session.id == session_id)
+            .first()
+        )
+
+
+def export_session(session: Session, images: bool = False, binary: bool = False) -> dict:
+    """
+    The snapshot document of a loaded session. Embedded image bytes are raw for binary formats
+    (msgpack) and base64 for JSON.
+    """
+    hubs = []
+    for hub in sorted(session.hubs, key=lambda hub: hub.id):
+        nodes = []
+        for node in sorted(hub.nodes, key=lambda node: (node.created_at or datetime.min, node.id)):
+            payload = node_payload(node)
+            payload["created_at"] = node.created_at.isoformat() if node.created_at else None
+            payload["source_url"] = node.source_url
+            payload["l2_query"] = node.l2_query
+            payload["images"] = [_export_image(image, images, binary) for image in node.images]
+            nodes.append(payload)
+        hubs.append({
+            "id": hub.id,
+            "file_name": hub.file_name,
+            "assistant_id": hub.assistant_id,
+            "dataset_sha256": hub.dataset_sha256,
+            "reduced_sha256": hub.reduced_sha256,
+            "reduction": hub.reduction,
+            "nodes": nodes,
+        })
+    return {"format": SNAPSHOT_FORMAT, "id": session.id, "hubs": hubs}
+
+
+def _export_image(image: Image, embed: bool, binary: bool) -> dict:
+    exported = {"id": image.id, "url": image.url, "sha256": image.sha256}
+    if embed or not image.sha256:
+        data = _image_bytes(image)
+        if data is not None:
+            exported["data"] = data if binary else base64.b64encode(data).decode()
+    return exported
+
+
+def _image_bytes(image: Image) -> Optional[bytes]:
+    if image.sha256:
+        path = blob_path(image.sha256)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+    # Legacy inline images, stored as hex or raw bytes (deferred, so read on their own)
+    with session_scope() as db:
+        data = db.query(Image.data).filter(Image.id == image.id).scalar()
+    if isinstance(data, str) and data.startswith("0x"):
+        return bytes.fromhex(data[2:])
+    return data
+
+
+def import_snapshot(snapshot: dict) -> Tuple[str, Dict[str, str]]:
+    """
+    Restore a snapshot as a new session and return (session ID, {snapshot hub ID: new hub ID}).
+    Every row gets a new ID, with parent and answer links remapped, so the same snapshot can be
+    imported any number of times. Assistants and threads are referenced, not copied: an imported
+    node shares the original's thread until it is first asked about, when it gets its own copy of
+    the conversation (see utils._own_thread).
+    Raises ValueError for documents that are not snapshots.
+    """
+    if not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Not a format {SNAPSHOT_FORMAT} session snapshot")
+
+    try:
+        ids = {node["id"]: new_id() for hub in snapshot["hubs"] for node in hub["nodes"]}
+        with session_scope() as db:
+            known_datasets = {sha256 for (sha256,) in db.query(Dataset.sha256).filter(
+                Dataset.sha256.in_([hub.get("dataset_sha256") for hub in snapshot["hubs"]]))}
+            session = Session(id=new_id())
+            db.add(session)
+            hub_ids = {}
+            for hub_data in snapshot["hubs"]:
+                hub = Hub(
+                    id=new_id(),
+                    file_name=hub_data["file_name"],
+                    assistant_id=hub_data["assistant_id"],
+                    dataset_sha256=hub_data.get("dataset_sha256") if hub_data.get("dataset_sha256") in known_datasets else None,
+                    session_id=session.id,
+                    reduced_sha256=hub_data.get("reduced_sha256"),
+                    reduction=hub_data.get("reduction"),
+                )
+                hub_ids[hub_data["id"]] = hub.id
+                nodes = [_import_node(node, hub.id, ids) for node in hub_data["nodes"]]
+                # Snapshot order is creation order; the hub's version starts past the last node
+                for seq, node in enumerate(nodes, 1):
+                    node.seq = seq
+                hub.version = len(nodes)
+                db.add(hub)
+                db.add_all(nodes)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed snapshot: {e!r}") from e
+    return session.id, hub_ids
+
+
+def _import_node(data: dict, hub_id: str, ids: Dict[str, str]) -> Node:
+    created_at = data.get("created_at")
+    return Node(
+        id=ids[data["id"]],
+        prompt=data.get("prompt"),
+        text=data.get("text"),
+        title=data.get("title"),
+        thread_id=data.get("thread_id"),
+        thread_shared=data.get("thread_id") is not None,
+        parent_node_id=ids.get(data.get("parent_node_id")),
+        hub_id=hub_id,
+        created_at=datetime.fromisoformat(created_at) if created_at else None,
+        source_url=data.get("source_url"),
+        l2_query=data.get("l2_query"),
+        images=[_import_image(image) for image in data.get("images", [])],
+        questions=[
+            Question(id=new_id(), content=question["content"],
+                     answer_node_id=ids.get(question.get("answer_node_id")))
+            for question in data.get("questions", [])
+        ],
+    )
+
+
+def _import_image(data: dict) -> Image:
+    embedded = data.get("data")
+    if isinstance(embedded, str):
+        embedded = base64.b64decode(embedded)
+    if not embedded and not data.get("sha256"):
+        raise ValueError(f"Image {data.get('id')} has neither a blob hash nor embedded bytes")
+    image = Image(id=new_id(), sha256=put_blob(embedded) if embedded else data.get("sha256"))
+    image.generate_url()
+    return image
+
+
+def session_versions(session_id: str) -> Optional[List[Tuple[str, int]]]:
+    """
+    What a snapshot's ETag is built from: the version of each of the session's hubs.
+    None if there is no such session.
+    """
+    with session_scope() as db:
+        if db.get(Session, session_id) is None:
+            return None
+        return [tuple(row) for row in db.query(Hub.id, Hub.version).filter(Hub.session_id == session_id).order_by(Hub.id)]
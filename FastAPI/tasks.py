@@ -0,0 +1,124 @@
+import hashlib
+from typing import Any, Awaitable, Callable, Dict
+
+from sqlalchemy.orm import joinedload
+
+from database import Hub, Job, Node, Question, session_scope
+from events import hub_events
+from jobs import PRIORITY_BULK, enqueue, family_finished
+from persistence import link_answer
+from scheduler import scheduler
+from utils import (_profile_context, create_level_one_half_node, create_level_one_half_node_prompted,
+                   l1_create_node, l1_prompts, l2_init)
+
+# Every handler is safe to run again for the same job: a retry after a crash must not duplicate nodes.
+# Nodes are written with the job's ID, so a step whose node already exists is skipped.
+
+
+def _load_hub(hub_id: str) -> Hub:
+    with session_scope() as db:
+        hub = db.get(Hub, hub_id)
+    if hub is None:
+        raise LookupError(f"Hub {hub_id} not found")
+    return hub
+
+
+def _load_node(node_id: str) -> Node:
+    with session_scope() as db:
+        node = db.query(Node).options(joinedload(Node.hub)).filter(Node.id == node_id).first()
+    if node is None:
+        raise LookupError(f"Node {node_id} not found")
+    return node
+
+
+def _node_exists(node_id: str) -> bool:
+    with session_scope() as db:
+        return db.get(Node, node_id) is not None
+
+
+async def l1_init(job: Job, payload: dict) -> dict:
+    """Generate the hub's L1 prompts, then queue one `l1_node` job per prompt."""
+    hub = _load_hub(payload["hub_id"])
+    prompts = await l1_prompts(hub, payload["thread_id"], _profile_context(hub))
+    for index, prompt in enumerate(prompts):
+        # Keyed by position, so a rerun of this job does not queue the same node twice
+        enqueue("l1_node", {"hub_id": hub.id, "prompt": prompt}, PRIORITY_BULK, hub_id=hub.id, parent_id=job.id,
+                key=f"{job.id}:l1_node:{index}")
+    return {"prompts": prompts}
+
+
+async def l1_node(job: Job, payload: dict) -> dict:
+    if _node_exists(job.id):
+        return {"node_id": job.id}
+    hub = _load_hub(payload["hub_id"])
+    # The worker's concurrency bounds jobs overall; the scheduler still caps the runs of one hub
+    node = await scheduler.run(hub.id, l1_create_node, hub, payload["prompt"], _profile_context(hub), node_id=job.id)
+    # Findings scored as unsurprising are dropped
+    return {"node_id": node.id if node else None}
+
+
+def answer_key(payload: dict) -> str:
+    """
+    Idempotency key of an `answer_question` job: one per suggested question, and one per prompt
+    (ignoring whitespace) asked from a node. Asking again yields the same job and so the same node.
+    """
+    if "question_id" in payload:
+        return f"answer_question:{payload['question_id']}"
+    prompt = " ".join(payload["prompt"].split())
+    return f"answer_prompt:{payload['node_id']}:{hashlib.sha256(prompt.encode()).hexdigest()}"
+
+
+async def answer_question(job: Job, payload: dict) -> dict:
+    """An L1.5 node answering a suggested question (`question_id`) or a free-form `prompt`."""
+    question_id = payload.get("question_id")
+    if question_id is None:
+        if not _node_exists(job.id):
+            node = _load_node(payload["node_id"])
+            await create_level_one_half_node_prompted(payload["prompt"], node, node_id=job.id)
+        return {"node_id": job.id}
+
+    with session_scope() as db:
+        question = db.get(Question, question_id)
+    if question is None:
+        raise LookupError(f"Question {question_id} not found")
+    # Already answered, e.g. by a streamed request
+    if question.answer_node_id:
+        return {"node_id": question.answer_node_id}
+    if not _node_exists(job.id):
+        await create_level_one_half_node(question, _load_node(payload["node_id"]), node_id=job.id)
+    return {"node_id": link_answer(question_id, job.id)}
+
+
+def l2_key(node_id: str, total: int) -> str:
+    """Idempotency key of expanding a node to `total` L2 nodes: requests for the same growth share a job."""
+    return f"l2_expand:{node_id}:{total}"
+
+
+async def l2_expand(job: Job, payload: dict) -> dict:
+    """Grow a node's L2 nodes to `total`; a rerun only adds what an earlier attempt did not save."""
+    node = _load_node(payload["node_id"])
+    with session_scope() as db:
+        existing = db.query(Node.id).filter(Node.parent_node_id == node.id).count()
+    missing = payload["total"] - existing
+    node_ids = await l2_init(node.hub, node, missing) if missing > 0 else []
+    return {"node_ids": node_ids}
+
+
+HANDLERS: Dict[str, Callable[[Job, dict], Awaitable[Any]]] = {
+    "l1_init": l1_init,
+    "l1_node": l1_node,
+    "answer_question": answer_question,
+    "l2_expand": l2_expand,
+}
+
+
+def on_finished(job: Job):
+    """Announce the end of a hub's L1 build once its `l1_init` job and every node job are finished."""
+    if job.kind not in ("l1_init", "l1_node"):
+        return
+    root_id = job.id if job.kind == "l1_init" else job.parent_id
+    if root_id is None or not family_finished(root_id):
+        return
+    if job.kind == "l1_init" and job.status == "failed":
+        hub_events.publish(job.hub_id, "error", {"detail": job.error})
+    hub_events.publish(job.hub_id, "done", {})
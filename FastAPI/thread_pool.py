@@ -0,0 +1,75 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Set, Tuple
+
+
+class ThreadPool:
+    """
+    Empty assistant threads created ahead of time, so taking one costs no API round-trip.
+
+    Threads are not tied to an assistant, so any caller can use any of them. The pool is
+    refilled in the background (at most `refill_concurrency` creations in flight) whenever
+    a thread is taken; threads older than `max_age` seconds are dropped instead of handed out.
+    With `target_size` 0 every thread is created on demand.
+    """
+
+    def __init__(self, create: Callable[[], Awaitable[str]], target_size: int, max_age: float,
+                 refill_concurrency: int):
+        self._create = create
+        self.target_size = target_size
+        self.max_age = max_age
+        self.refill_concurrency = refill_concurrency
+        self._threads: Deque[Tuple[str, float]] = deque()  # (thread ID, creation time), oldest first
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    async def take(self) -> str:
+        """A fresh empty thread: from the pool if one is ready, created on the spot otherwise."""
+        self._drop_expired()
+        if self._threads:
+            thread_id, _ = self._threads.popleft()
+            self.hits += 1
+        else:
+            self.misses += 1
+            thread_id = await self._create()
+        self.refill()
+        return thread_id
+
+    def refill(self):
+        """Start as many background creations as the pool is short of (must run on the event loop)."""
+        self._drop_expired()
+        needed = self.target_size - len(self._threads) - len(self._tasks)
+        for _ in range(min(needed, self.refill_concurrency - len(self._tasks))):
+            task = asyncio.create_task(self._add_one())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _add_one(self):
+        try:
+            thread_id = await self._create()
+        except Exception as e:
+            # Leave the pool short; the next take() tries again
+            print(f"Could not pre-create a thread: {e}")
+            return
+        self._threads.append((thread_id, time.monotonic()))
+        # Chain the next creation once this slot frees up
+        asyncio.get_running_loop().call_soon(self.refill)
+
+    def _drop_expired(self):
+        cutoff = time.monotonic() - self.max_age
+        while self._threads and self._threads[0][1] < cutoff:
+            self._threads.popleft()
+            self.expired += 1
+
+    def stats(self) -> dict:
+        return {
+            "ready": len(self._threads),
+            "refilling": len(self._tasks),
+            "target_size": self.target_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+        }
@@ -0,0 +1,118 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from metrics import assistant_tokens, registry, stage_duration
+
+MAX_HUBS_WITH_TIMINGS = 1000  # hubs whose timings are kept in memory (least recently used are dropped)
+EWMA_WEIGHT = 0.2  # weight of the newest run when updating the expected run duration
+
+
+class _Stat:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 1) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 1),
+            "total_ms": round(self.total * 1000, 1),
+        }
+
+
+class StageTimings:
+    """
+    Where assistant time goes, by stage (the kind of prompt: initial, l1, title, questions, ...)
+    and phase (queue, in_progress, message_fetch, image_download), overall and per hub.
+    Also keeps the expected run duration per stage, which the run poller adapts to, the runs in
+    flight and the tokens used per hub. Every timing is exported as a histogram (see metrics.py).
+    """
+
+    def __init__(self):
+        self._totals: Dict[Tuple[str, str], _Stat] = {}
+        self._hubs: "OrderedDict[str, Dict[Tuple[str, str], _Stat]]" = OrderedDict()
+        self._expected_run: Dict[str, float] = {}
+        self._hub_tokens: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        self.in_flight: Dict[str, int] = {}  # assistant runs currently queued or in progress, per stage
+
+    def record(self, stage: str, phase: str, seconds: float, hub_id: Optional[str] = None):
+        self._totals.setdefault((stage, phase), _Stat()).add(seconds)
+        stage_duration.observe(seconds, stage=stage, phase=phase)
+        if hub_id is None:
+            return
+
+        stats = self._hubs.setdefault(hub_id, {})
+        stats.setdefault((stage, phase), _Stat()).add(seconds)
+        self._hubs.move_to_end(hub_id)
+        while len(self._hubs) > MAX_HUBS_WITH_TIMINGS:
+            self._hubs.popitem(last=False)
+
+    def record_usage(self, stage: str, usage, hub_id: Optional[str] = None):
+        """Count the tokens of a finished run (`run.usage`, absent while a run is in progress)."""
+        if usage is None:
+            return
+        counts = {"prompt": usage.prompt_tokens, "completion": usage.completion_tokens}
+        for kind, count in counts.items():
+            assistant_tokens.inc(count, stage=stage, kind=kind)
+        if hub_id is None:
+            return
+
+        tokens = self._hub_tokens.setdefault(hub_id, {"prompt": 0, "completion": 0})
+        for kind, count in counts.items():
+            tokens[kind] += count
+        self._hub_tokens.move_to_end(hub_id)
+        while len(self._hub_tokens) > MAX_HUBS_WITH_TIMINGS:
+            self._hub_tokens.popitem(last=False)
+
+    @contextmanager
+    def running(self, stage: str):
+        """Count a run as in flight for the duration of the block."""
+        self.in_flight[stage] = self.in_flight.get(stage, 0) + 1
+        try:
+            yield
+        finally:
+            self.in_flight[stage] -= 1
+
+    @contextmanager
+    def timed(self, stage: str, phase: str, hub_id: Optional[str] = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, phase, time.perf_counter() - start, hub_id)
+
+    def observe_run(self, stage: str, seconds: float):
+        """Fold the duration of a finished run (queue + in_progress) into the stage's expectation."""
+        previous = self._expected_run.get(stage)
+        self._expected_run[stage] = seconds if previous is None else previous + EWMA_WEIGHT * (seconds - previous)
+
+    def expected_run(self, stage: str) -> Optional[float]:
+        return self._expected_run.get(stage)
+
+    def summary(self, hub_id: Optional[str] = None) -> dict:
+        stats = self._totals if hub_id is None else self._hubs.get(hub_id, {})
+        summary: Dict[str, dict] = {}
+        for (stage, phase), stat in sorted(stats.items()):
+            summary.setdefault(stage, {})[phase] = stat.as_dict()
+        if hub_id is None:
+            for stage, seconds in self._expected_run.items():
+                summary.setdefault(stage, {})["expected_run_ms"] = round(seconds * 1000, 1)
+        elif hub_id in self._hub_tokens:
+            summary["tokens"] = dict(self._hub_tokens[hub_id])
+        return summary
+
+
+stage_timings = StageTimings()
+registry.collect("assistant_runs_in_flight", "Assistant runs queued or in progress, per stage.",
+                 lambda: dict(stage_timings.in_flight), ("stage",))
@@ -0,0 +1,56 @@
+import json
+from typing import List, Optional
+
+from sqlalchemy import func
+
+from database import ThreadMessage, session_scope
+
+
+def text_part(text: str) -> dict:
+    return {"type": "text", "text": text}
+
+
+def image_part(file_id: str, sha256: Optional[str] = None) -> dict:
+    # sha256 is the blob store key when the image was downloaded
+    return {"type": "image", "file_id": file_id, "sha256": sha256}
+
+
+def mirror_messages(thread_id: str, messages: List[ThreadMessage]):
+    """
+    Append messages to the local copy of a thread, in order. Messages already mirrored are skipped,
+    so a run's messages can be recorded again after a retry.
+    """
+    with session_scope() as db:
+        position = db.query(func.max(ThreadMessage.position)).filter(ThreadMessage.thread_id == thread_id).scalar()
+        position = -1 if position is None else position
+        for message in messages:
+            if db.get(ThreadMessage, message.id) is not None:
+                continue
+            position += 1
+            message.thread_id = thread_id
+            message.position = position
+            db.add(message)
+
+
+def new_message(message_id: str, role: str, parts: List[dict]) -> ThreadMessage:
+    return ThreadMessage(id=message_id, role=role, content=json.dumps(parts))
+
+
+def last_message_id(thread_id: str) -> Optional[str]:
+    """Cursor of the mirror: the newest message we have for the thread (None if we have none)."""
+    with session_scope() as db:
+        return (db.query(ThreadMessage.id)
+                .filter(ThreadMessage.thread_id == thread_id)
+                .order_by(ThreadMessage.position.desc())
+                .limit(1)
+                .scalar())
+
+
+def transcript(thread_id: str) -> List[dict]:
+    """The mirrored thread, oldest first, without any API call."""
+    with session_scope() as db:
+        messages = (db.query(ThreadMessage)
+                    .filter(ThreadMessage.thread_id == thread_id)
+                    .order_by(ThreadMessage.position)
+                    .all())
+        return [{"id": m.id, "role": m.role, "content": json.loads(m.content)} for m in messages]
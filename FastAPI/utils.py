@@ -1,23 +1,38 @@
-import multiprocessing
-import os
+import asyncio
+import random
 import re
+import time
 import uuid
+import weakref
 from io import BytesIO
 from dotenv import load_dotenv, find_dotenv
-from openai import OpenAI
-from exa_py import Exa
-from pydantic import BaseModel
-from typing import BinaryIO, Tuple, List, Optional
+from openai import BadRequestError, RateLimitError
+from pydantic import BaseModel, Field, ValidationError
+from typing import Any, AsyncIterator, BinaryIO, Dict, Tuple, List, Optional
 import json
-from sqlalchemy.orm import Session
 
-from database import Hub, Node, Image, Question, get_db
+from backends import create_clients
+from blobstore import put_blob, store_image
+from database import Dataset, Hub, Node, Question, NodeResponse, session_scope
+from events import hub_events
+from llm_cache import llm_cache
+from metrics import registry
+from persistence import build_node, save_nodes
+from profiling import format_profile
+from reduction import format_reduction
+from scheduler import scheduler
+from search_cache import search_cache
+from thread_pool import ThreadPool
+from timings import stage_timings
+from transcripts import image_part, last_message_id, mirror_messages, new_message, text_part, transcript
 from consts import INSTRUCTIONS, LEVEL_ONE_PROMPT_SUFFIX, ONE_LINER, INITIAL_PROMPT, SURPRISING, \
-    SUGGESTED_QUESTION_PROMPT, L2_OUTPUT, DELIMITER, RETRIES, LEVEL_ONE_HALF_PROMPT
+    SUGGESTED_QUESTION_PROMPT, L2_OUTPUT, DELIMITER, RETRIES, LEVEL_ONE_HALF_PROMPT, \
+    L2_SUMMARY_FORMAT, STRUCTURED_NODES, STRUCTURED_NODE_SUFFIX, PROFILE_PROMPT, POLL_MIN_INTERVAL, \
+    POLL_MAX_INTERVAL, POLL_GROWTH, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, THREAD_POOL_SIZE, THREAD_POOL_MAX_AGE, \
+    THREAD_POOL_REFILL_CONCURRENCY, REDUCTION_PROMPT
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-exa = Exa(api_key=os.getenv("EXA_API_KEY"))
+client, exa = create_clients()
 
 class Response:
     def __init__(self, text_list: List[str], image_list: List[str]):
@@ -38,105 +53,390 @@ class ExaSearchResponse(BaseModel):
     total_results: int
 
 
-def create_assistant_for_file(file: BinaryIO) -> Tuple[str, str]:
+# Everything a node needs from the assistant, returned by a single structured run
+class NodeContent(BaseModel):
+    body: str
+    title: str
+    surprising: Optional[int] = Field(None, ge=1, le=10)
+    questions: List[str] = []
+
+
+# JSON schema the run is constrained to in structured mode (strict mode wants every field required)
+NODE_CONTENT_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "node_content",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "body": {"type": "string"},
+                "title": {"type": "string"},
+                "surprising": {"type": "integer"},
+                "questions": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["body", "title", "surprising", "questions"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Set once the API refuses a response format for our assistants; the prompt still asks for JSON
+_response_format_rejected = False
+registry.collect("response_format_rejected", "1 once the API refused structured response formats and runs "
+                 "fall back to prompt-only JSON.", lambda: int(_response_format_rejected))
+
+
+def _run_options(response_format: Optional[dict]) -> dict:
+    if response_format is None or _response_format_rejected:
+        return {}
+    return {"response_format": response_format}
+
+
+async def create_assistant_for_file(file: BinaryIO, file_name: str) -> Tuple[str, str]:
     """
-    This function creates a file object and uses it to generate an assistant
-    with access to the Code Interpreter tool. It also creates a new thread.
+    This function uploads the file and uses it to generate an assistant
+    with access to the Code Interpreter tool.
 
     Args:
-    file (str): The file path or file content to be uploaded.
+    file (BinaryIO): The file object to be uploaded, streamed from its current position.
+    file_name (str): The name the file is uploaded under (the extension tells the interpreter how to read it).
 
     Returns:
-    Tuple[str, str]: A tuple containing the thread ID and assistant ID.
+    Tuple[str, str]: A tuple containing the uploaded file ID and assistant ID.
     """
 
 
     # Upload the file
-    uploaded_file = client.files.create(
-        file=file,
-        purpose='assistants'
-    )
+    with stage_timings.timed("dataset", "file_upload"):
+        uploaded_file = await client.files.create(
+            file=(file_name, file),
+            purpose='assistants'
+        )
 
     # Create the assistant with the uploaded file and Code Interpreter tool
-    assistant = client.beta.assistants.create(
-        instructions=INSTRUCTIONS,
-        model="gpt-4o",
-        tools=[{"type": "code_interpreter"}],
-        tool_resources={
-            "code_interpreter": {
-                "file_ids": [uploaded_file.id]
+    with stage_timings.timed("dataset", "assistant_create"):
+        assistant = await client.beta.assistants.create(
+            instructions=INSTRUCTIONS,
+            model="gpt-4o",
+            tools=[{"type": "code_interpreter"}],
+            tool_resources={
+                "code_interpreter": {
+                    "file_ids": [uploaded_file.id]
+                }
             }
-        }
-    )
+        )
+
+    return uploaded_file.id, assistant.id
+
+
+async def _new_thread() -> str:
+    thread = await client.beta.threads.create()
+    llm_cache.register_thread(thread.id)
+    return thread.id
+
+
+thread_pool = ThreadPool(_new_thread, THREAD_POOL_SIZE, THREAD_POOL_MAX_AGE, THREAD_POOL_REFILL_CONCURRENCY)
+registry.collect("thread_pool_ready", "Pre-created threads ready to be taken.", lambda: thread_pool.stats()["ready"])
+registry.collect("thread_pool_takes_total", "Threads taken from the pool (hit) or created on demand (miss).",
+                 lambda: {("hit",): thread_pool.hits, ("miss",): thread_pool.misses}, ("result",), kind="counter")
+
+
+async def create_thread() -> str:
+    """A new (empty) assistant thread, taken from the warm pool when one is ready."""
+    return await thread_pool.take()
+
+
+# Assistant ID -> content hash of its dataset. Only found datasets are kept: the row of an assistant
+# looked up too early (or brought in later by a snapshot import) would otherwise stay missing
+_assistant_datasets: Dict[str, str] = {}
+ASSISTANT_DATASETS_MAX = 1024
+
+
+def _dataset_for_assistant(assistant_id: str) -> Optional[str]:
+    # Content hash of the dataset behind an assistant (None for assistants created before the registry)
+    digest = _assistant_datasets.get(assistant_id)
+    if digest is None:
+        with session_scope() as db:
+            digest = db.query(Dataset.sha256).filter(Dataset.assistant_id == assistant_id).limit(1).scalar()
+        if digest is not None:
+            if len(_assistant_datasets) >= ASSISTANT_DATASETS_MAX:
+                _assistant_datasets.clear()
+            _assistant_datasets[assistant_id] = digest
+    return digest
+
+
+def _cached_reply(assistant_id: str, thread_id: str, message: str) -> Tuple[Optional[str], Optional[Response]]:
+    """Cache key for the exchange and the cached reply, if there is one."""
+    key = llm_cache.key_for(_dataset_for_assistant(assistant_id), thread_id, message)
+    cached = llm_cache.get(key)
+    if cached is None:
+        return key, None
+
+    texts, images = cached
+    llm_cache.advance(thread_id, key, message, "\n".join(texts), synced=False)
+    return key, Response(text_list=texts, image_list=images)
+
+
+async def _post_message(thread_id: str, role: str, content: str):
+    # Add a message to the thread and to its local mirror
+    message = await client.beta.threads.messages.create(thread_id=thread_id, role=role, content=content)
+    await asyncio.to_thread(mirror_messages, thread_id, [new_message(message.id, role, [text_part(content)])])
+
+
+def _mirror_run_messages(thread_id: str, messages: list, reply: Response):
+    """Mirror the messages a run produced; the reply's images are keyed by their blob hash."""
+    records = []
+    for message in messages:
+        parts = []
+        for content in message.content:
+            if hasattr(content, "image_file"):
+                parts.append(image_part(content.image_file.file_id))
+            else:
+                parts.append(text_part(content.text.value))
+        records.append((message, parts))
+
+    # The last message is the reply, whose images were downloaded (in order, unless one failed)
+    images = [part for part in records[-1][1] if part["type"] == "image"]
+    if len(images) == len(reply.image_list):
+        for part, data in zip(images, reply.image_list):
+            part["sha256"] = put_blob(data)
+
+    mirror_messages(thread_id, [new_message(message.id, message.role, parts) for message, parts in records])
+
 
-    # Create a new thread
-    thread = client.beta.threads.create()
+async def _sync_thread(thread_id: str):
+    """Write replies that were served from the cache to the thread before it is run for real."""
+    pending = await asyncio.to_thread(llm_cache.pending, thread_id)
+    for prompt, reply in pending:
+        await _post_message(thread_id, "user", prompt)
+        await _post_message(thread_id, "assistant", reply or "(chart)")
+    if pending:
+        await asyncio.to_thread(llm_cache.clear_pending, thread_id)
 
-    # Return thread ID and assistant ID
-    return assistant.id, thread.id
 
+def _remember_reply(key: Optional[str], thread_id: str, message: str, response: Response):
+    llm_cache.put(key, response.text_list, response.image_list)
+    llm_cache.advance(thread_id, key, message, "\n".join(response.text_list), synced=True)
 
-def _message_and_wait_for_reply(assistant_id: str, thread_id: str, message: str) -> Response:
+
+RUN_PENDING_STATUSES = ("queued", "in_progress", "cancelling")
+
+
+def _retry_after(error: RateLimitError) -> Optional[float]:
+    # Seconds the API asked us to wait, None if it did not say
+    try:
+        return float(error.response.headers["retry-after"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _next_poll_delay(stage: str, elapsed: float, previous_delay: Optional[float]) -> float:
+    """
+    Poll fast at first, sleep through most of the run this stage usually takes,
+    then back off geometrically while the run overruns.
+    """
+    expected = stage_timings.expected_run(stage)
+    if expected is not None and elapsed < expected * 0.8:
+        return min(max(expected * 0.8 - elapsed, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+    if previous_delay is None:
+        return POLL_MIN_INTERVAL
+    return min(previous_delay * POLL_GROWTH, POLL_MAX_INTERVAL)
+
+
+async def _create_and_poll_run(assistant_id: str, thread_id: str, stage: str, hub_id: Optional[str], **options):
+    """
+    Create a run and poll it until it leaves the pending states, with an adaptive interval
+    (see `_next_poll_delay`). Records the time spent queued and in progress.
+    """
+    run = await client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id, **options)
+    created = time.perf_counter()
+    started = None
+    delay = None
+    wait = None  # set after a rate limited poll, replaces the next interval
+
+    with stage_timings.running(stage):
+        while run.status in RUN_PENDING_STATUSES:
+            delay = _next_poll_delay(stage, time.perf_counter() - created, delay)
+            await asyncio.sleep(delay if wait is None else wait)
+            wait = None
+            try:
+                run = await client.beta.threads.runs.retrieve(run.id, thread_id=thread_id)
+            except RateLimitError as e:
+                wait = _retry_after(e)
+                if wait is None:
+                    wait = POLL_MAX_INTERVAL
+                continue
+            if started is None and run.status != "queued":
+                started = time.perf_counter()
+
+    finished = time.perf_counter()
+    started = started or finished
+    stage_timings.record(stage, "queue", started - created, hub_id)
+    stage_timings.record(stage, "in_progress", finished - started, hub_id)
+    stage_timings.record_usage(stage, getattr(run, "usage", None), hub_id)
+    if run.status == "completed":
+        stage_timings.observe_run(stage, finished - created)
+    return run
+
+
+def _retry_backoff(attempt: int) -> float:
+    # Full jitter: anywhere between 0 and the exponential bound
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+async def _message_and_wait_for_reply(assistant_id: str, thread_id: str, message: str, hub_id: Optional[str] = None,
+                                      response_format: Optional[dict] = None, stage: str = "other") -> Response:
     """
     Sends a message to the assistant in a specified thread, waits for the assistant's response,
-    and returns the assistant's reply.
+    and returns the assistant's reply. Polling is awaited on the event loop, so other requests
+    keep being served while the run is in progress.
 
     Args:
     assistant_id (str): The ID of the assistant.
     thread_id (str): The ID of the thread to send the message in.
     message (str): The content of the message to send.
+    hub_id (str, optional): Hub to publish progress events for.
+    response_format (dict, optional): Output format the run is constrained to.
+    stage (str, optional): Kind of prompt, used to tag timings and adapt polling.
 
     Returns:
     str, bool: The response from the assistant, if it is a file
     """
 
+    # The same prompt in the same conversation about the same dataset was answered before
+    key, cached = await asyncio.to_thread(_cached_reply, assistant_id, thread_id, message)
+    if cached is not None:
+        return cached
+
+    await _sync_thread(thread_id)
+
     # Send a message to the thread
-    client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=message
-    )
+    await _post_message(thread_id, "user", message)
     tries = 0
+    wait = None  # Retry-After of a rate limited attempt, used instead of the backoff
     while tries < RETRIES:
+        if tries:
+            # Failed runs are retried with jittered exponential backoff, or when the API asked to
+            await asyncio.sleep(_retry_backoff(tries) if wait is None else wait)
+            wait = None
         tries += 1
 
         # Run the assistant and wait for the response
-        run = client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id,
-            assistant_id=assistant_id,
-        )
+        hub_events.publish(hub_id, "run_started", {"thread_id": thread_id, "attempt": tries})
+        try:
+            run = await _create_and_poll_run(assistant_id, thread_id, stage, hub_id, **_run_options(response_format))
+        except BadRequestError as e:
+            if not _run_options(response_format) or not _is_response_format_error(e):
+                raise
+            _reject_response_format()
+            continue
+        except RateLimitError as e:
+            wait = _retry_after(e)
+            continue
         # Check if the run is completed and fetch the messages
         if run.status == 'completed':
-            # Retrieve the list of messages from the thread
-            messages_page = client.beta.threads.messages.list(
-                thread_id=thread_id,
-                order="asc"
-            )
+            # Retrieve only the messages after the newest one we have mirrored (i.e. what the run wrote)
+            with stage_timings.timed(stage, "message_fetch", hub_id):
+                messages_page = client.beta.threads.messages.list(
+                    thread_id=thread_id,
+                    order="asc",
+                    after=last_message_id(thread_id),
+                )
 
-            # Convert the SyncCursorPage object to a list
-            messages = list(messages_page)
+                # Collect the AsyncCursorPage pages into a list
+                messages = [message async for message in messages_page]
 
             # Return the last message content (assuming the assistant's reply is the last one)
             if messages:
-                contents = messages[-1].content
-                images = []
-                texts = []
-
-                for content in contents:
-                    if hasattr(content, "image_file"):
-                        file_id = content.image_file.file_id
-                        resp = client.files.with_raw_response.retrieve_content(file_id)
-                        if resp.status_code == 200:
-                            images.append(resp.content)
-                    else:
-                        text = content.text.value
-                        texts.append(text)
-
-                return Response(text_list=texts, image_list=images)
+                response = await _read_reply(messages[-1], thread_id, hub_id, stage)
+                await asyncio.to_thread(_mirror_run_messages, thread_id, messages, response)
+                await asyncio.to_thread(_remember_reply, key, thread_id, message, response)
+                return response
 
     raise Exception(f"Failed to receive response for message: {message}")
 
 
+def _is_response_format_error(error: BadRequestError) -> bool:
+    # Only a refusal of the response format turns structured outputs off; other 400s (a thread
+    # with an active run, a bad ID, ...) are errors of that one call
+    return error.param == "response_format" or "response_format" in str(error.code or "")
+
+
+def _reject_response_format():
+    global _response_format_rejected
+    _response_format_rejected = True
+
+
+async def _read_reply(reply, thread_id: str, hub_id: Optional[str] = None, stage: str = "other") -> Response:
+    # Split an assistant message into its text parts and downloaded images
+    images = []
+    texts = []
+
+    for content in reply.content:
+        if hasattr(content, "image_file"):
+            file_id = content.image_file.file_id
+            with stage_timings.timed(stage, "image_download", hub_id):
+                resp = await client.files.with_raw_response.retrieve_content(file_id)
+            if resp.status_code == 200:
+                images.append(resp.content)
+                hub_events.publish(hub_id, "image_fetched", {"thread_id": thread_id, "file_id": file_id})
+        else:
+            text = content.text.value
+            texts.append(text)
+
+    return Response(text_list=texts, image_list=images)
+
+
+async def _stream_message_and_reply(assistant_id: str, thread_id: str, message: str, response_format: Optional[dict] = None,
+                                    stage: str = "other") -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Streaming counterpart of `_message_and_wait_for_reply`. Yields ("token", text) for every
+    text delta as the assistant produces it, then a final ("reply", Response) once the run is done.
+    Runs are not retried, since tokens have already been handed to the caller.
+    A cached reply is yielded as a single token.
+    """
+    key, cached = await asyncio.to_thread(_cached_reply, assistant_id, thread_id, message)
+    if cached is not None:
+        yield "token", "\n".join(cached.text_list)
+        yield "reply", cached
+        return
+
+    await _sync_thread(thread_id)
+
+    await _post_message(thread_id, "user", message)
+
+    options = _run_options(response_format)
+    start = time.perf_counter()
+    with stage_timings.running(stage):
+        while True:
+            try:
+                async with client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id,
+                                                           **options) as stream:
+                    async for text in stream.text_deltas:
+                        yield "token", text
+
+                    run = await stream.get_final_run()
+                    messages = await stream.get_final_messages()
+                break
+            except BadRequestError as e:
+                # Raised when the run is created, before any token was handed out
+                if not options or not _is_response_format_error(e):
+                    raise
+                _reject_response_format()
+                options = {}
+    stage_timings.record(stage, "in_progress", time.perf_counter() - start)
+    stage_timings.record_usage(stage, getattr(run, "usage", None))
+
+    if run.status != 'completed' or not messages:
+        raise Exception(f"Failed to receive response for message: {message}")
+
+    response = await _read_reply(messages[-1], thread_id, stage=stage)
+    await asyncio.to_thread(_mirror_run_messages, thread_id, messages, response)
+    await asyncio.to_thread(_remember_reply, key, thread_id, message, response)
+    yield "reply", response
+
+
 def _parse_one_liner(one_liner, node):
     try:
         formatted_one_liner = re.sub(r'(\w+):', r'"\1":', one_liner[0])  # Add quotes around keys
@@ -153,181 +453,370 @@ def _parse_one_liner(one_liner, node):
 
 
  # Get interesting questions for a given Node (if any)
-def _generate_questions(node: Node, assistant_id: str, thread_id: str):
-    response = _message_and_wait_for_reply(assistant_id, thread_id, SUGGESTED_QUESTION_PROMPT)
-    suggested_questions = re.findall(rf'{DELIMITER}(.*?){DELIMITER}', response.text_list[0])
-    for question_text in suggested_questions:
-        question = Question(content=question_text)  # Create a Question object
-        node.questions.append(question)  # Associate the question with the node
-
-def _generate_title(assistant_id: str, thread_id: str):
+async def _generate_questions(assistant_id: str, thread_id: str, hub_id: Optional[str] = None) -> List[str]:
+    response = await _message_and_wait_for_reply(assistant_id, thread_id, SUGGESTED_QUESTION_PROMPT, hub_id, stage="questions")
+    return re.findall(rf'{DELIMITER}(.*?){DELIMITER}', response.text_list[0])
+
+async def _generate_title(assistant_id: str, thread_id: str, hub_id: Optional[str] = None):
     # Determine the concise title of the node
     one_liner_prompt = ONE_LINER
     if SURPRISING.get("enabled"):
         one_liner_prompt += SURPRISING.get("prompt")
-    title = _message_and_wait_for_reply(assistant_id, thread_id, one_liner_prompt).text_list[0]
+    title = (await _message_and_wait_for_reply(assistant_id, thread_id, one_liner_prompt, hub_id, stage="title")).text_list[0]
     return title
 
-def _l1_create_node(hub: Hub, thread_id: str, prompt: str, db: Session = next(get_db())):
-    # Process the prompt for the new node
-    response = _message_and_wait_for_reply(hub.assistant_id, thread_id, prompt)
+def _parse_node_content(response: Response) -> Optional[NodeContent]:
+    # The reply should be exactly the JSON object, but tolerate prose or code fences around it
     text = "\n".join(response.text_list)
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    try:
+        return NodeContent.model_validate_json(match.group(0) if match else text)
+    except ValidationError:
+        return None
+
+
+class _JsonStringField:
+    """Pulls the decoded value of one string field out of a JSON object that is still being streamed."""
+
+    def __init__(self, field: str):
+        self._pattern = re.compile(rf'"{field}"\s*:\s*"')
+        self._buffer = ""
+        self._pos = None  # start of the not yet decoded part of the value
+        self._done = False
+
+    def feed(self, delta: str) -> str:
+        """Add a delta of the JSON text and return the newly completed part of the field's value."""
+        self._buffer += delta
+        if self._done:
+            return ""
+        if self._pos is None:
+            match = self._pattern.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        decoded = []
+        i, buffer = self._pos, self._buffer
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self._done = True
+                break
+            if char == "\\":
+                # Wait for the whole escape sequence before decoding it
+                end = i + (6 if buffer[i + 1:i + 2] == "u" else 2)
+                if end > len(buffer):
+                    break
+                decoded.append(json.loads(f'"{buffer[i:end]}"'))
+                i = end
+                continue
+            decoded.append(char)
+            i += 1
+        self._pos = i
+        return "".join(decoded)
+
+
+async def _node_content(assistant_id: str, thread_id: str, message: str, hub_id: Optional[str] = None,
+                        stage: str = "other") -> Tuple[NodeContent, Response]:
+    """
+    Ask `message` and get everything a node needs. In structured mode that is one run returning
+    a JSON object; otherwise (or if that JSON does not validate) the title and the follow-up
+    questions are asked for in two more runs on the same thread.
+    """
+    if STRUCTURED_NODES:
+        response = await _message_and_wait_for_reply(assistant_id, thread_id, message + STRUCTURED_NODE_SUFFIX,
+                                                     hub_id, response_format=NODE_CONTENT_FORMAT, stage=stage)
+        content = _parse_node_content(response)
+        if content is not None:
+            return content, response
+    else:
+        response = await _message_and_wait_for_reply(assistant_id, thread_id, message, hub_id, stage=stage)
 
-    # Determine the concise title of the node
-    one_liner_prompt = ONE_LINER
-    if SURPRISING.get("enabled"):
-        one_liner_prompt += SURPRISING.get("prompt")
-
-    title = _message_and_wait_for_reply(hub.assistant_id, thread_id, one_liner_prompt).text_list[0]
+    title = await _generate_title(assistant_id, thread_id, hub_id)
+    questions = await _generate_questions(assistant_id, thread_id, hub_id)
+    return NodeContent(body="\n".join(response.text_list), title=title, questions=questions), response
 
-    # Create the base of the Node in DB
-    new_node = Node(
-        prompt=prompt,
-        text=text,
-        title=title,
-        thread_id=thread_id,
-        hub_id=hub.id
-    )
 
-    # Process the images (if any) for the Node
-    images = []
-    for image_data in response.image_list:
-        # Create the image object
-        image = Image(data=image_data)
+async def _l1_create_node(hub: Hub, thread_id: str, prompt: str, context: str = "",
+                          node_id: Optional[str] = None) -> Optional[Node]:
+    # Process the prompt (plus any dataset profile) for the new node, with its title and follow-up questions
+    content, response = await _node_content(hub.assistant_id, thread_id, prompt + context, hub.id, stage="l1")
 
-        # Add the image to the session so it gets an id upon commit
-        db.add(image)
+    # Only a structured run scores the finding
+    if SURPRISING.get("enabled") and content.surprising is not None and content.surprising <= 2:
+        return None
 
-        # Commit to generate the ID and get the URL
-        db.commit()
-        db.refresh(image)  # Ensure the ID is generated
+    # Write the image bytes (and their renditions) to the blob store, the DB only keeps the hashes
+    image_hashes = [await asyncio.to_thread(store_image, image_data) for image_data in response.image_list]
 
-        # Generate the URL based on the image ID
-        image.generate_url()
+    # Build the whole node graph in memory, then write it in one transaction
+    new_node = build_node(prompt, content.body, content.title, thread_id, hub.id, image_hashes=image_hashes,
+                          questions=content.questions, node_id=node_id)
+    await asyncio.to_thread(save_nodes, [new_node])
 
-        # Commit again to save the URL
-        db.commit()
+    # Push the finished node to anyone streaming the hub
+    hub_events.publish(hub.id, "node", NodeResponse.model_validate(new_node, from_attributes=True).model_dump())
 
-        # Append the image to the new_node's images relationship
-        new_node.images.append(image)
-        images.append(image)  # Optionally collect them for further processing
+    return new_node
 
-    _generate_questions(new_node, hub.assistant_id, thread_id)
 
-    # Save Node to DB
-    db.add(new_node)
-    db.commit()
+def _profile_context(hub: Hub) -> str:
+    # The dataset profile computed at upload and how the attached file was reduced, formatted for a prompt
+    if not hub.dataset_sha256:
+        return ""
+    with session_scope() as db:
+        dataset = db.get(Dataset, hub.dataset_sha256)
+        profile = dataset.profile if dataset else None
+    context = PROFILE_PROMPT.format(profile=format_profile(json.loads(profile))) if profile else ""
+    if hub.reduction:
+        context += REDUCTION_PROMPT.format(summary=format_reduction(json.loads(hub.reduction)))
+    return context
 
 
-def l1_init(hub: Hub, initial_thread: str):
-    # Determine the five initial prompts per node
-    response = _message_and_wait_for_reply(hub.assistant_id, initial_thread, INITIAL_PROMPT)
+async def l1_prompts(hub: Hub, initial_thread: str, context: str) -> List[str]:
+    """Ask for the analyses the hub's L1 nodes will each run, announcing them to the hub's listeners."""
+    response = await _message_and_wait_for_reply(hub.assistant_id, initial_thread, INITIAL_PROMPT + context, hub.id,
+                                                 stage="initial")
     next_prompts = re.findall(rf'{DELIMITER}(.*?){DELIMITER}', response.text_list[0])
-
-    # Extract and create threads per node
-    prompts_with_threads = [(prompt + LEVEL_ONE_PROMPT_SUFFIX + prompt, client.beta.threads.create().id) for prompt in
-                            next_prompts]
-
-    # Run each l1 node creation in parallel
-    with multiprocessing.Pool() as pool:
-        pool.starmap(_l1_create_node, [
-            (hub, thread_id, prompt) for prompt, thread_id in prompts_with_threads
-        ])
-
-def create_level_one_half_node(question: Question, node: Node, db: Session = next(get_db())):
+    hub_events.publish(hub.id, "prompts_generated", {"prompts": next_prompts})
+    return next_prompts
+
+
+async def l1_create_node(hub: Hub, prompt: str, context: str, node_id: Optional[str] = None) -> Optional[Node]:
+    """Build and save one L1 node for a prompt from `l1_prompts` in a thread of its own."""
+    thread_id = await create_thread()
+    return await _l1_create_node(hub, thread_id, prompt + LEVEL_ONE_PROMPT_SUFFIX + prompt, context=context,
+                                 node_id=node_id)
+
+
+# L1.5 answers continue their parent node's thread, and a thread takes one run at a time:
+# answers to several questions about the same node are asked one after the other.
+# The locks are per process: with several worker processes, two different questions about one node
+# can still reach its thread at the same time. OpenAI refuses a message on a thread with an active run,
+# so the second job's attempt fails and the queue retries it with backoff.
+_thread_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _thread_lock(thread_id: str) -> asyncio.Lock:
+    lock = _thread_locks.get(thread_id)
+    if lock is None:
+        lock = _thread_locks[thread_id] = asyncio.Lock()
+    return lock
+
+
+async def _fork_thread(source_thread_id: str) -> str:
+    """A new thread holding a copy of another thread's conversation, read from the mirror (or the API)."""
+    history = [(message["role"], message["content"]) for message in await asyncio.to_thread(transcript, source_thread_id)]
+    if not history:
+        # Threads from another server's snapshot are not mirrored here
+        history = [
+            (message.role, [image_part(content.image_file.file_id) if hasattr(content, "image_file")
+                            else text_part(content.text.value) for content in message.content])
+            async for message in client.beta.threads.messages.list(thread_id=source_thread_id, order="asc")
+        ]
+
+    thread_id = await create_thread()
+    for role, parts in history:
+        # Charts cannot be posted back, the mirror keeps them
+        content = "\n".join(part["text"] for part in parts if part["type"] == "text") or "(chart)"
+        message = await client.beta.threads.messages.create(thread_id=thread_id, role=role, content=content)
+        await asyncio.to_thread(mirror_messages, thread_id, [new_message(message.id, role, parts)])
+    await asyncio.to_thread(llm_cache.fork, source_thread_id, thread_id)
+    return thread_id
+
+
+async def _own_thread(node: Node) -> str:
+    """
+    The thread to ask about the node in. An imported node shares its thread with the node it was copied
+    from until then, so it first gets its own copy of the conversation and the original is left alone.
+    """
+    if not node.thread_shared:
+        return node.thread_id
+    async with _thread_lock(node.id):
+        thread_id, shared = await asyncio.to_thread(_node_thread, node.id)
+        if shared:
+            thread_id = await asyncio.to_thread(_set_node_thread, node.id, await _fork_thread(thread_id))
+    node.thread_id, node.thread_shared = thread_id, False
+    return thread_id
+
+
+def _node_thread(node_id: str) -> Tuple[str, bool]:
+    with session_scope() as db:
+        return tuple(db.query(Node.thread_id, Node.thread_shared).filter(Node.id == node_id).one())
+
+
+def _set_node_thread(node_id: str, thread_id: str) -> str:
+    # Give a shared node its forked thread, unless another process forked it first: its copy wins
+    with session_scope() as db:
+        updated = (db.query(Node).filter(Node.id == node_id, Node.thread_shared.is_(True))
+                   .update({Node.thread_id: thread_id, Node.thread_shared: False}))
+        if not updated:
+            thread_id = db.query(Node.thread_id).filter(Node.id == node_id).scalar()
+    return thread_id
+
+async def create_level_one_half_node(question: Question, node: Node, node_id: Optional[str] = None) -> Node:
     prompt = question.content + LEVEL_ONE_HALF_PROMPT
-    response = _message_and_wait_for_reply(node.hub.assistant_id, node.thread_id, prompt)
-    title = _generate_title(node.hub.assistant_id, node.thread_id)
+    return await _create_level_one_half_node(prompt, prompt, node, node_id)
 
-    new_thread = client.beta.threads.create()
+async def create_level_one_half_node_prompted(prompt: str, node: Node, node_id: Optional[str] = None) -> Node:
+    return await _create_level_one_half_node(prompt + LEVEL_ONE_HALF_PROMPT, prompt, node, node_id)
 
-    new_node = Node(
-        prompt=prompt,
-        text=response.text_list[0],
-        title=title,
-        thread_id=new_thread.id,
-        hub_id=node.hub.id,
-    )
-    _generate_questions(new_node, node.hub.assistant_id, node.thread_id)
+async def _create_level_one_half_node(message: str, prompt: str, node: Node, node_id: Optional[str] = None) -> Node:
+    await _own_thread(node)
+    async with _thread_lock(node.thread_id):
+        content, _ = await _node_content(node.hub.assistant_id, node.thread_id, message, stage="l1_5")
 
-    # Save Node to DB
-    db.add(new_node)
-    db.commit()
-    return new_node
+    new_thread_id = await create_thread()
 
-def create_level_one_half_node_prompted(prompt: str, node: Node, db: Session = next(get_db())):
-    response = _message_and_wait_for_reply(node.hub.assistant_id, node.thread_id, prompt + LEVEL_ONE_HALF_PROMPT)
-    title = _generate_title(node.hub.assistant_id, node.thread_id)
+    # Save Node to DB
+    new_node = build_node(prompt, content.body, content.title, new_thread_id, node.hub.id, questions=content.questions,
+                          node_id=node_id)
+    return (await asyncio.to_thread(save_nodes, [new_node]))[0]
 
-    new_thread = client.beta.threads.create()
+async def stream_level_one_half_node(question: Question, node: Node, node_id: Optional[str] = None):
+    prompt = question.content + LEVEL_ONE_HALF_PROMPT
+    async for event in _stream_level_one_half_node(prompt, prompt, node, node_id):
+        yield event
 
-    new_node = Node(
-        prompt=prompt,
-        text=response.text_list[0],
-        title=title,
-        thread_id=new_thread.id,
-        hub_id=node.hub.assistant_id,
+async def stream_level_one_half_node_prompted(prompt: str, node: Node, node_id: Optional[str] = None):
+    async for event in _stream_level_one_half_node(prompt + LEVEL_ONE_HALF_PROMPT, prompt, node, node_id):
+        yield event
 
-    )
-    _generate_questions(new_node, node.hub.assistant_id, node.thread_id)
+async def _stream_level_one_half_node(message: str, prompt: str, node: Node,
+                                      node_id: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Build an L1.5 node while streaming it: answer tokens as they arrive, then the title,
+    then the suggested questions, and finally the saved node.
+    """
+    await _own_thread(node)
+    async with _thread_lock(node.thread_id):
+        async for event in _stream_level_one_half_node_content(message, prompt, node, node_id):
+            yield event
+
+async def _stream_level_one_half_node_content(message: str, prompt: str, node: Node,
+                                              node_id: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+    assistant_id = node.hub.assistant_id
+    content = None
+    if STRUCTURED_NODES:
+        # Only the body of the JSON object is streamed as tokens
+        body = _JsonStringField("body")
+        async for event, data in _stream_message_and_reply(assistant_id, node.thread_id, message + STRUCTURED_NODE_SUFFIX,
+                                                           NODE_CONTENT_FORMAT, stage="l1_5"):
+            if event == "token":
+                text = body.feed(data)
+                if text:
+                    yield "token", {"text": text}
+            else:
+                response = data
+        content = _parse_node_content(response)
+    else:
+        async for event, data in _stream_message_and_reply(assistant_id, node.thread_id, message, stage="l1_5"):
+            if event == "token":
+                yield "token", {"text": data}
+            else:
+                response = data
+
+    if content is not None:
+        title, questions = content.title, content.questions
+        yield "title", {"title": title}
+    else:
+        title = await _generate_title(assistant_id, node.thread_id)
+        yield "title", {"title": title}
+        questions = await _generate_questions(assistant_id, node.thread_id)
+
+    new_thread_id = await create_thread()
+    text = content.body if content is not None else "\n".join(response.text_list)
 
     # Save Node to DB
-    db.add(new_node)
-    db.commit()
-    return new_node
+    new_node = build_node(prompt, text, title, new_thread_id, node.hub.id, questions=questions, node_id=node_id)
+    await asyncio.to_thread(save_nodes, [new_node])
+
+    node_response = NodeResponse.model_validate(new_node, from_attributes=True).model_dump()
+    yield "questions", {"questions": node_response["questions"]}
+    yield "node", node_response
 
 # Define exa search function
-def exa_search(query: str) -> ExaSearchResponse:
-    # Perform the Exa search (assumed to return a list of dicts or similar)
-    raw_results = exa.search_and_contents(query=query, type='auto', summary=True, num_results=L2_OUTPUT)
+async def exa_search(query: str, num_results: int = L2_OUTPUT) -> ExaSearchResponse:
+    """
+    Search through the cache (see search_cache.py): a new query is searched and summarized in one
+    request that fills both caches; a known query skips the search, and only its URLs without a
+    cached summary are summarized.
+    """
+    results = search_cache.get_results(query, num_results)
+    if results is None:
+        # The Exa SDK is synchronous, so run it off the event loop
+        with stage_timings.timed("search", "exa_search"):
+            raw_results = await asyncio.to_thread(
+                exa.search_and_contents, query=query, type='auto', summary=True, num_results=num_results
+            )
+        search_cache.put_results(query, num_results,
+                                 [{"title": result.title, "url": result.url} for result in raw_results.results])
+        search_cache.put_summaries({result.url: result.summary for result in raw_results.results if result.summary})
+        formatted_results = [
+            SearchResult(title=result.title or "", url=result.url, summary=result.summary)
+            for result in raw_results.results
+        ]
+        return ExaSearchResponse(results=formatted_results, total_results=len(formatted_results))
+
+    urls = [result["url"] for result in results]
+    summaries = search_cache.get_summaries(urls)
+    missing = [url for url in urls if url not in summaries]
+    if missing:
+        with stage_timings.timed("search", "exa_summaries"):
+            contents = await asyncio.to_thread(exa.get_contents, missing, summary=True)
+        fetched = {result.url: result.summary for result in contents.results if result.summary}
+        search_cache.put_summaries(fetched)
+        summaries.update(fetched)
 
-    # Example of how you would format the results into the Pydantic model
     formatted_results = [
-        SearchResult(
-            title=result.title,
-            url=result.url,
-            summary=result.summary
-        )
-        for result in raw_results.results
+        SearchResult(title=result["title"] or "", url=result["url"], summary=summaries.get(result["url"]))
+        for result in results
     ]
-
-    return ExaSearchResponse(results=formatted_results, total_results=len(raw_results.results))
+    return ExaSearchResponse(results=formatted_results, total_results=len(formatted_results))
 
 # Create L2 node
-def _l2_create_node(hub: Hub, thread_id: str, prompt: str, parent_node: Node, url: str, article_title: str, db: Session = next(get_db())):
+async def _l2_create_node(hub: Hub, thread_id: str, prompt: str, parent_node: Node, url: str, article_title: str) -> Node:
     
     # Create the unified contextual summary with title
-    response = _message_and_wait_for_reply(hub.assistant_id, thread_id, prompt)
-    summary, title = tuple(re.findall(rf'{DELIMITER}(.*?){DELIMITER}', response.text_list[0]))
+    if STRUCTURED_NODES:
+        response = await _message_and_wait_for_reply(hub.assistant_id, thread_id, prompt + STRUCTURED_NODE_SUFFIX,
+                                                     response_format=NODE_CONTENT_FORMAT, stage="l2")
+        content = _parse_node_content(response)
+        if content is None:
+            raise ValueError(f"Invalid structured reply for L2 node: {response.text_list}")
+        summary, title, questions = content.body, content.title, content.questions
+    else:
+        response = await _message_and_wait_for_reply(hub.assistant_id, thread_id, prompt + L2_SUMMARY_FORMAT, stage="l2")
+        summary, title = tuple(re.findall(rf'{DELIMITER}(.*?){DELIMITER}', response.text_list[0]))
+        # TODO: Stretch goal would be to add questions so someone could do more layers
+        questions = []
     # print(f"For the following prompt: {prompt}\nTitle: {title}\nSummary: {summary}\n\n\n")
 
     final_summary = f"[{article_title}]({url})\n\n\n{summary}"
-    # Create the base of the Node in DB
-    new_node = Node(
-        prompt=prompt,
-        text=final_summary,
-        title=title,
-        thread_id=thread_id,
-        hub_id=hub.id,
-        parent_node_id=parent_node.id
-    )
 
-    # TODO: Stretch goal would be to add questions so someone could do more layers
+    # Build the Node in memory, l2_init saves all siblings together
+    return build_node(prompt, final_summary, title, thread_id, hub.id, parent_node_id=parent_node.id, questions=questions,
+                      source_url=url)
+
+# L2 nodes saved before nodes.source_url only carry their source in the leading markdown link
+_SOURCE_LINK = re.compile(r"^\[.*?\]\((.*?)\)")
+
+def _expanded_sources(node_id: str) -> set:
+    """URLs of the sources a node already has L2 nodes for."""
+    with session_scope() as db:
+        children = db.query(Node.source_url, Node.text).filter(Node.parent_node_id == node_id).all()
+    urls = set()
+    for source_url, text in children:
+        match = None if source_url else _SOURCE_LINK.match(text or "")
+        urls.add(source_url or (match.group(1) if match else None))
+    urls.discard(None)
+    return urls
+
+async def _l2_query(hub: Hub, prev_node: Node) -> str:
+    """The Exa query for a node's L2 nodes, generated once and stored on the node."""
+    if prev_node.l2_query:
+        return prev_node.l2_query
 
-    # Save Node to DB
-    db.add(new_node)
-    db.commit()
-    db.refresh(new_node)
-
-    # def to_dict(obj):
-    #     return {column.name: getattr(obj, column.name) for column in obj.__table__.columns}
-
-    # print(to_dict(new_node))
-
-    return new_node
-
-# Create L2 node
-def l2_init(hub: Hub, prev_node: Node):
     # Use the findings from level one to prompt OpenAI for a query that Exa can use, and incorporate Exa prompt guidelines for better query formulation
     level_two_prompt = (
         f"""Our findings about {prev_node.title} suggest the following trends: 
@@ -344,29 +833,51 @@ def l2_init(hub: Hub, prev_node: Node):
         """
     )
 
-    # Send this prompt to OpenAI to generate a search query for Exa
-    generated_query = _message_and_wait_for_reply(hub.assistant_id, prev_node.thread_id, level_two_prompt)
+    # Send this prompt to OpenAI to generate a search query for Exa (on the node's thread, like its answers)
+    await _own_thread(prev_node)
+    async with _thread_lock(prev_node.thread_id):
+        generated_query = await _message_and_wait_for_reply(hub.assistant_id, prev_node.thread_id, level_two_prompt,
+                                                            stage="l2_query")
 
     # Parse the generated search query
     search_query = generated_query.text_list[0]  # (Assuming first response contains the search query)
+    await asyncio.to_thread(_save_l2_query, prev_node.id, search_query)
+    prev_node.l2_query = search_query
+    return search_query
 
-    # Use the search query to call Exa's search function and fetch relevant papers and resources
-    search_results = exa_search(query=search_query)
+def _save_l2_query(node_id: str, query: str):
+    with session_scope() as db:
+        db.query(Node).filter(Node.id == node_id).update({Node.l2_query: query})
+
+# Create L2 nodes
+async def l2_init(hub: Hub, prev_node: Node, count: int = L2_OUTPUT) -> List[str]:
+    """
+    Add up to `count` L2 nodes to `prev_node`, on sources it does not have L2 nodes for yet.
+    Returns the IDs of the new nodes (fewer than `count` once Exa runs out of new results).
+    """
+    search_query = await _l2_query(hub, prev_node)
+
+    # Ask for enough results to get `count` new ones past the sources already expanded
+    seen = _expanded_sources(prev_node.id)
+    search_results = await exa_search(query=search_query, num_results=len(seen) + count)
+    new_results = [result for result in search_results.results if result.url not in seen][:count]
+    if not new_results:
+        return []
 
     # Extract and create threads per node
+    threads = await asyncio.gather(*[create_thread() for _ in new_results])
     prompts_with_threads = []
-    for result in search_results.results:
-        prompt = f"You have a summary for a new source, {result.title} which has the summary {result.summary}. Explain how this relates to the previous information {prev_node.title} with text {prev_node.text}. Output a summary enclosed in ~ and then a title based on this summary that is one sentence <= 50 characters also surrounded by ~ (don't forget that both the summary and the title should be enclosed in ~). Heavily emphasize the connection to the previous information. Provide a little bit of the context for the new source summary as well."
-        prompts_with_threads.append((prompt, client.beta.threads.create().id, result.url, result.title))
-
-    # Run each l2 node creation in parallel
-    with multiprocessing.Pool() as pool:
-        results = pool.starmap(_l2_create_node, [
-            (hub, thread_id, prompt, prev_node, url, title) for prompt, thread_id, url, title in prompts_with_threads
-        ])
-
-    pool.close()
-    pool.join()
+    for result, thread_id in zip(new_results, threads):
+        prompt = f"You have a summary for a new source, {result.title} which has the summary {result.summary}. Explain how this relates to the previous information {prev_node.title} with text {prev_node.text}. Heavily emphasize the connection to the previous information. Provide a little bit of the context for the new source summary as well."
+        prompts_with_threads.append((prompt, thread_id, result.url, result.title))
+
+    # Run each l2 node creation through the shared scheduler
+    results = await scheduler.starmap(hub.id, _l2_create_node, [
+        (hub, thread_id, prompt, prev_node, url, title) for prompt, thread_id, url, title in prompts_with_threads
+    ])
+
+    # Save all L2 nodes in one transaction
+    await asyncio.to_thread(save_nodes, results)
 
     # print(results)
     # print([result.id for result in results])
@@ -0,0 +1,118 @@
+"""
+Runs jobs from the durable queue (jobs.py).
+
+The API process runs one of these on its own event loop unless JOBS_IN_PROCESS=false;
+more can be started as separate processes, on any host sharing the database:
+
+python worker.py --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import socket
+import time
+import traceback
+import uuid
+from typing import Dict, Optional
+
+import jobs
+from consts import (JOB_CONCURRENCY, JOB_HEARTBEAT_INTERVAL, JOB_POLL_INTERVAL, JOB_STALE_AFTER, RETRY_BACKOFF_BASE,
+                    RETRY_BACKOFF_MAX)
+from database import Job, create_db_and_tables
+from tasks import HANDLERS, on_finished
+from utils import thread_pool
+
+
+class Worker:
+    """Claims jobs by priority and runs up to `concurrency` of them at once on the event loop."""
+
+    def __init__(self, concurrency: int = JOB_CONCURRENCY, worker_id: Optional[str] = None):
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self._running: Dict[str, asyncio.Task] = {}
+        self._stopping = False
+
+    async def run(self):
+        last_heartbeat = last_recovery = 0.0
+        errors = 0
+        while not self._stopping:
+            try:
+                now = time.monotonic()
+                if now - last_recovery >= JOB_STALE_AFTER / 2:
+                    # Jobs of crashed workers (including a previous run of this one) go back in the queue
+                    jobs.recover_stale()
+                    last_recovery = now
+                if now - last_heartbeat >= JOB_HEARTBEAT_INTERVAL:
+                    jobs.heartbeat(list(self._running))
+                    last_heartbeat = now
+
+                while len(self._running) < self.concurrency:
+                    job = jobs.claim(self.worker_id)
+                    if job is None:
+                        break
+                    self._running[job.id] = asyncio.create_task(self._run_job(job))
+                errors = 0
+            except Exception:
+                # The database is busy or unreachable for a moment: keep the loop alive and try again
+                traceback.print_exc()
+                errors += 1
+                await asyncio.sleep(min(RETRY_BACKOFF_BASE * 2 ** (errors - 1), RETRY_BACKOFF_MAX))
+                continue
+
+            await jobs.wait_for_work(JOB_POLL_INTERVAL)
+
+    async def _run_job(self, job: Job):
+        handler = HANDLERS.get(job.kind)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for job kind {job.kind}")
+            result = await handler(job, json.loads(job.payload))
+        except Exception as e:
+            traceback.print_exc()
+            jobs.fail(job, f"{type(e).__name__}: {e}")
+        else:
+            jobs.complete(job, result)
+        finally:
+            # Free the slot and let the loop claim the next job right away
+            self._running.pop(job.id, None)
+            jobs.notify()
+
+        if job.status in jobs.FINISHED:
+            on_finished(job)
+
+    async def stop(self):
+        """Stop claiming, cancel the running jobs and put them back in the queue for the next worker."""
+        self._stopping = True
+        jobs.notify()
+        running = dict(self._running)
+        for task in running.values():
+            task.cancel()
+        await asyncio.gather(*running.values(), return_exceptions=True)
+        try:
+            jobs.release(list(running))
+        except Exception:
+            # They are requeued by recover_stale once their heartbeats are overdue
+            traceback.print_exc()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=JOB_CONCURRENCY)
+    args = parser.parse_args()
+
+    create_db_and_tables()
+
+    async def run():
+        thread_pool.refill()
+        worker = Worker(args.concurrency)
+        try:
+            await worker.run()
+        finally:
+            # Interrupted (Ctrl-C, SIGTERM): hand the running jobs back to the queue
+            await worker.stop()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
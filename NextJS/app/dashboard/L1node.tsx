@@ -164,7 +164,7 @@ function L1Node({ data }: NodeProps<{
         </div>
         <div style={{ marginTop: 5 }} className="flex flex-col gap-4">
             {data.images && data.images.map((url) => (
-              <Image key={url} src={url} alt={url} width={300} height={300} className="justify-center self-center" />
+              <Image key={url} src={`${url}?size=display`} alt={url} width={300} height={300} className="justify-center self-center" />
             ))}
           {MarkdownRenderer(data.text)}
         </div>
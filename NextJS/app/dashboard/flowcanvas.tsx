@@ -28,7 +28,7 @@ import L0node from './L0node';
 import L2Node from './L2node';
 import Papa, { ParseResult } from 'papaparse';  // Import the type definitions from PapaParse
 import { set } from 'zod';
-import {type ApiResponseItem, createSession, pollApiUntilNItems, type SessionResponse, fetchQuestionNode, fetchExaNodes, fetchQuestionNodePrompted} from "@/lib/api";
+import {type ApiResponseItem, createSession, streamHubNodes, type SessionResponse, fetchQuestionNode, fetchExaNodes, fetchQuestionNodePrompted} from "@/lib/api";
 
 const nodeTypes = {
   L0: L0node,
@@ -571,9 +571,10 @@ function FlowCanvas() {
   }
 };
 
-  // Poll API to fetch nodes and update progressively
+  // Stream hub nodes from the API and update progressively
   const pollHubNodes = useCallback(async (hubId: string) => {
-    const url = `http://localhost:8001/hubs/${hubId}/nodes`;
+    const url = `http://localhost:8001/hubs/${hubId}/events`;
+    const pollUrl = `http://localhost:8001/hubs/${hubId}/nodes`;
 
     // Callback to handle partial data updates
     const handlePartialResult = (items: ApiResponseItem[]) => {
@@ -638,7 +639,7 @@ function FlowCanvas() {
 
 
     try {
-      await pollApiUntilNItems(url, 5, handlePartialResult); // Pass the callback to handle partial data
+      streamHubNodes(url, pollUrl, 5, handlePartialResult); // Pass the callback to handle partial data
     } catch (error) { /* empty */
     }
   }, [setNodes]);
@@ -50,18 +50,17 @@ export const pollApiUntilNItems = async (
   interval = 1000 // Default interval of 5 seconds
 ): Promise<void> => {
   let currentData: ApiResponseItem[] = []; // Keep track of the data we have
+  let cursor: string | null = null; // Only ask for nodes created after the last poll
 
   const poll = async () => {
     try {
-      const response = await fetch(url);
+      const response = await fetch(cursor ? `${url}?since=${encodeURIComponent(cursor)}` : url);
       if (!response.ok) {
         throw new Error(`Failed to fetch. Status: ${response.status}`);
       }
 
-      const newData = (await response.json()) as ApiResponseItem[];
-
-      // Compare new data with current data to find new items
-      const additionalItems = newData.slice(currentData.length);
+      cursor = response.headers.get("X-Next-Cursor") ?? cursor;
+      const additionalItems = (await response.json()) as ApiResponseItem[];
 
       if (additionalItems.length > 0) {
         currentData = [...currentData, ...additionalItems]; // Update current data
@@ -82,6 +81,45 @@ export const pollApiUntilNItems = async (
   await poll(); // Start polling immediately
 };
 
+// Stream hub nodes over server-sent events, falling back to polling if the stream fails
+export const streamHubNodes = (
+  url: string,
+  pollUrl: string,
+  n: number,
+  onPartialResult: (data: ApiResponseItem[]) => void, // callback for partial results
+  onProgress?: (event: string, data: unknown) => void // optional callback for stage progress
+): (() => void) => {
+  let currentData: ApiResponseItem[] = [];
+  const source = new EventSource(url);
+
+  source.addEventListener("node", (event: MessageEvent<string>) => {
+    const item = JSON.parse(event.data) as ApiResponseItem;
+    if (currentData.some((existing) => existing.id === item.id)) return;
+
+    currentData = [...currentData, item];
+    onPartialResult(currentData);
+
+    if (currentData.length >= n) source.close();
+  });
+
+  ["prompts_generated", "run_started", "image_fetched", "error"].forEach((name) => {
+    source.addEventListener(name, (event: MessageEvent<string>) => {
+      onProgress?.(name, JSON.parse(event.data));
+    });
+  });
+
+  source.addEventListener("done", () => source.close());
+
+  source.onerror = () => {
+    source.close();
+    if (currentData.length < n) {
+      void pollApiUntilNItems(pollUrl, n, onPartialResult);
+    }
+  };
+
+  return () => source.close();
+};
+
 export const fetchQuestionNode = async (url: string, id: string): Promise<ApiResponseItem | null> => {
   try {
     const response = await fetch(`${url}/${id}`);